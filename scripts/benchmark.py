@@ -0,0 +1,456 @@
+import argparse
+import gc
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from lxml import html
+
+from pipeline_metrics import metrics
+from sentence_score import PairEncoder, SentenceScorer, load_mention_map, set_context_for_sentences
+from wiki_mongo_db import WikiMongoDB, article_id_for, target_id_for
+from wiki_sentence_utils import extract_section_texts, get_sentences, group_sections
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Words of the synthetic articles, with abbreviations the sentence tokenizer has to keep inside a sentence
+WORDS = (
+    "the of and in to a is was for on as by with from that at its are an were which also this be has had first "
+    "river species water north south city century war government population history region fish salmon system "
+    "world national university known called used between during after early several including however"
+).split()
+ABBREVIATIONS = ("e.g.", "i.e.", "approx.", "St.", "Dr.", "c.")
+SECTION_TITLES = ("History", "Etymology", "Geography", "Biology", "Distribution", "Economy", "Culture", "Ecology",
+                  "Taxonomy", "Description", "Behaviour", "Conservation", "Research", "In popular culture")
+
+
+def synthetic_article_html(title: str, num_sections: int = 12, paragraphs: int = 4, sentences: int = 5,
+                           seed: int = 0) -> str:
+    """
+    Build the HTML of a Wikipedia article with the structure of a Parsoid page: hatnote, infobox, lead, table of
+    contents, h2/h3 headings with edit links, references, figures and navboxes, so every exclusion rule of the
+    section extraction is exercised.
+    """
+    rng = random.Random(f"{title}:{seed}")
+
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 30))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(ABBREVIATIONS))
+        words[0] = words[0].capitalize()
+        text = " ".join(words)
+        if rng.random() < 0.3:
+            text += f'<sup class="reference"><a href="#cite_note-{rng.randint(1, 99)}">[{rng.randint(1, 99)}]</a></sup>'
+        return text + "."
+
+    def paragraph():
+        return f"<p>{' '.join(sentence() for _ in range(sentences))}</p>\n"
+
+    titles = [rng.choice(SECTION_TITLES) + (f" {i}" if i >= len(SECTION_TITLES) else "") for i in range(num_sections)]
+    body = [
+        f'<div role="note" class="hatnote navigation-not-searchable">For other uses, see {title} '
+        f'(disambiguation).</div>',
+        f'<table class="infobox"><tbody><tr><th>{title}</th></tr><tr><td>{sentence()}</td></tr></tbody></table>',
+        "".join(paragraph() for _ in range(2)),
+        '<div id="toc" class="toc" role="navigation"><h2 id="mw-toc-heading">Contents</h2><ul>'
+        + "".join(f"<li>{section_title}</li>" for section_title in titles) + "</ul></div>",
+    ]
+    for section_title in titles:
+        body.append(f'<div class="mw-heading mw-heading2"><h2 id="{section_title}">{section_title}</h2>'
+                    f'<span class="mw-editsection">[<a>edit</a>]</span></div>\n')
+        for i in range(paragraphs):
+            if i and rng.random() < 0.3:
+                body.append(f'<div class="mw-heading mw-heading3"><h3>{rng.choice(SECTION_TITLES)}</h3></div>\n')
+            if rng.random() < 0.2:
+                body.append(f'<figure typeof="mw:File/Thumb"><img src="x.jpg"><figcaption>{sentence()}'
+                            f'</figcaption></figure>\n')
+            body.append(paragraph())
+    body.append('<div class="mw-heading mw-heading2"><h2 id="References">References</h2></div>\n'
+                '<div class="reflist"><ol class="references">'
+                + "".join(f"<li><cite>{sentence()}</cite></li>" for _ in range(20)) + "</ol></div>")
+    body.append(f'<div role="navigation" class="navbox"><table><tr><td>{sentence()}</td></tr></table></div>')
+    return (f'<!DOCTYPE html><html><head><title>{title} - Wikipedia</title></head><body>'
+            f'<div id="content"><h1>{title}</h1><div id="bodyContent"><div id="mw-content-text">'
+            f'<div class="mw-content-ltr mw-parser-output" lang="en">{"".join(body)}</div></div></div></div>'
+            f'</body></html>')
+
+
+def synthetic_fixtures(num_articles: int = 10, num_sections: int = 12, seed: int = 0) -> List[Tuple[str, str]]:
+    return [(f"Article {i}", synthetic_article_html(f"Article {i}", num_sections, seed=seed))
+            for i in range(num_articles)]
+
+
+def write_synthetic_mention_map(path: str, num_targets: int, seed: int = 0) -> int:
+    """
+    Write a mention map parquet of `num_targets` targets and return its number of rows. Most targets have a few
+    mentions, one in ten between 11 and 60 with short and repeated ones in other cases, like popular targets.
+    """
+    rng = random.Random(seed)
+    titles, mentions = [], []
+    for i in range(num_targets):
+        count = rng.randint(11, 60) if rng.random() < 0.1 else rng.randint(1, 6)
+        for _ in range(count):
+            mention = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+            titles.append(f"Target {i}")
+            mentions.append(mention.upper() if rng.random() < 0.2 else mention)
+    pd.DataFrame({"target_title": titles, "mention": mentions}).to_parquet(path)
+    return len(titles)
+
+
+def load_fixtures(fixtures_dir: str) -> List[Tuple[str, str]]:
+    """
+    Load saved article HTML, one `<title>.html` file per article.
+    """
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            fixtures.append((os.path.splitext(os.path.basename(path))[0].replace("_", " "), f.read()))
+    if not fixtures:
+        raise SystemExit(f"No .html fixtures in {fixtures_dir}")
+    return fixtures
+
+
+def save_fixtures(titles: List[str], lang: str, fixtures_dir: str) -> None:
+    """
+    Download the current HTML of Wikipedia articles once, so later benchmark runs work offline on real pages.
+    """
+    from wiki_sentence_utils import fetch_article_html
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for title in titles:
+        path = os.path.join(fixtures_dir, f"{title.replace(' ', '_').replace('/', '_')}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(fetch_article_html(lang, title, None))
+        logging.info(f"Saved {title} to {path}")
+
+
+def build_tiny_model(model_dir: str, texts: List[str], hidden_size: int = 64, num_layers: int = 2,
+                     vocab_size: int = 4000, seed: int = 0) -> str:
+    """
+    Write a randomly initialised BERT encoder, its tokenizer and a classification head in the directory layout of
+    `load_model`. The vocabulary holds the most frequent words of `texts`, so token counts stay close to those of a
+    real WordPiece vocabulary.
+    """
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    torch.manual_seed(seed)
+    special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    characters = sorted({char for text in texts for char in text.lower() if not char.isspace()})
+    words = Counter(word for text in texts for word in text.lower().split())
+    vocab = special_tokens + characters + [f"##{char}" for char in characters]
+    vocab += [word for word, _ in words.most_common(max(0, vocab_size - len(vocab))) if word not in vocab]
+    os.makedirs(os.path.join(model_dir, "tokenizer"), exist_ok=True)
+    vocab_path = os.path.join(model_dir, "tokenizer", "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab))
+    BertTokenizerFast(vocab_path).save_pretrained(os.path.join(model_dir, "tokenizer"))
+
+    config = BertConfig(vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=max(1, hidden_size // 32), intermediate_size=hidden_size * 4,
+                        max_position_embeddings=512)
+    BertModel(config).save_pretrained(os.path.join(model_dir, "model"))
+    head = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU(), nn.Linear(hidden_size, 1))
+    torch.save(head.state_dict(), os.path.join(model_dir, "classification_head.pth"))
+    return model_dir
+
+
+def in_memory_db(bulk_writes: bool = False) -> WikiMongoDB:
+    """
+    WikiMongoDB on an in-memory mongomock client.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        raise ImportError("The benchmark database requires the mongomock package: pip install mongomock")
+    return WikiMongoDB(db_name="wikinsert_benchmark", bulk_writes=bulk_writes, client=mongomock.MongoClient())
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb() -> Optional[float]:
+    """
+    Return the resident memory of the process now, after a garbage collection, or None where /proc is missing.
+    """
+    gc.collect()
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak RSS of the process (VmHWM) to its current RSS, return whether it could be reset (Linux 4.0+).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def stage_peak_rss_mb() -> Optional[float]:
+    # The peak RSS since the last reset_peak_rss, in kilobytes in /proc/self/status
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def time_stage(name: str, run: Callable[[], Any], repeat: int, items: int, unit: str) -> Tuple[Dict[str, Any], Any]:
+    """
+    Run a stage `repeat` times and report its fastest run, with the throughput in `unit`s per second and its memory:
+    the peak RSS during the stage and how far it rose above the RSS before the stage, the increase of the RSS the
+    stage leaves behind (including its result) and the peak RSS of the process so far.
+
+    The stage peak needs /proc/self/clear_refs to reset the high-water mark, elsewhere it is None and only the
+    cumulative process peak is reported.
+    """
+    timings = []
+    result = None
+    rss_before = current_rss_mb()
+    peak_reset = reset_peak_rss()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - started)
+    peak = stage_peak_rss_mb() if peak_reset else None
+    rss_after = current_rss_mb()
+    seconds = min(timings)
+    stage = {
+        "seconds": seconds,
+        "mean_seconds": sum(timings) / len(timings),
+        unit: items,
+        f"{unit}_per_second": items / seconds if seconds else None,
+        "peak_rss_mb": peak,
+        "peak_rss_increase_mb": peak - rss_before if peak is not None and rss_before is not None else None,
+        "rss_increase_mb": rss_after - rss_before if rss_before is not None else None,
+        "process_peak_rss_mb": peak_rss_mb(),
+    }
+
+    def mb(key):
+        return f"{stage[key]:+.1f} MB" if stage[key] is not None else "unknown"
+
+    logging.info(f"{name}: {seconds:.4f}s, {stage[f'{unit}_per_second'] or 0:.1f} {unit}/s, "
+                 f"peak RSS {mb('peak_rss_increase_mb')}, RSS increase {mb('rss_increase_mb')}, "
+                 f"process peak RSS {stage['process_peak_rss_mb']:.0f} MB")
+    return stage, result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(fixtures: List[Tuple[str, str]], model_dir: str = None, targets_per_article: int = 3,
+                  repeat: int = 3, backend: str = "eager", lang: str = "en", context_size: int = 5,
+                  work_dir: str = None, mention_targets: int = 100000) -> Dict[str, Any]:
+    """
+    Time the ingest and scoring stages on `fixtures`, a list of (title, html) articles: HTML parsing, section
+    extraction (the single-pass walker used by parse_article_html), sentence segmentation, context windows, scoring
+    against `targets_per_article` targets per article and the database writes, one by one and buffered. Without
+    `model_dir` a tiny random model is built in `work_dir`. Loading the mention map, the bulk of the scorer's startup,
+    is timed on a generated map of `mention_targets` targets.
+    """
+    titles = [title for title, _ in fixtures]
+    if len(titles) < 2:
+        raise ValueError("The benchmark needs at least two articles, the targets of an article are the other ones")
+    if targets_per_article > len(titles) - 1:
+        # A target scored twice against the same source would write the same pair twice
+        logging.warning(f"Scoring {len(titles) - 1} instead of {targets_per_article} targets per article, "
+                        f"the other articles are the targets")
+        targets_per_article = len(titles) - 1
+    work_dir = work_dir or tempfile.mkdtemp(prefix="wikinsert-benchmark-")
+    stages = {}
+
+    stages["parse_html"], trees = time_stage(
+        "parse_html", lambda: [html.fromstring(content) for _, content in fixtures], repeat,
+        sum(len(content) for _, content in fixtures), "bytes")
+    stages["build_sections"], sections_dfs = time_stage(
+        "build_sections", lambda: [group_sections(extract_section_texts(tree)) for tree in trees], repeat,
+        len(trees), "articles")
+    num_texts = sum(len(sections_df) for sections_df in sections_dfs)
+    stages["get_sentences"], articles = time_stage(
+        "get_sentences", lambda: [get_sentences(sections_df, lang) for sections_df in sections_dfs], repeat,
+        num_texts, "sections")
+    num_sentences = sum(len(section["sentences"]) for sections in articles for section in sections)
+
+    def set_contexts():
+        for sections in articles:
+            for section in sections:
+                set_context_for_sentences(section, context_size)
+
+    stages["set_context_for_sentences"], _ = time_stage(
+        "set_context_for_sentences", set_contexts, repeat, num_sentences, "sentences")
+    for sections in articles:
+        for section in sections:
+            for sentence in section["sentences"]:
+                sentence.pop("context", None)
+
+    mention_map_path = os.path.join(work_dir, "mention_map.parquet")
+    num_mentions = write_synthetic_mention_map(mention_map_path, mention_targets)
+    stages["load_mention_map"], _ = time_stage(
+        "load_mention_map", lambda: load_mention_map(mention_map_path), repeat, num_mentions, "rows")
+
+    model_name = model_dir or "tiny-random"
+    if model_dir is None:
+        texts = [sentence["sentence"] for sections in articles for section in sections
+                 for sentence in section["sentences"]]
+        model_dir = build_tiny_model(os.path.join(work_dir, "model"), texts)
+    scorer = SentenceScorer(model_dir, os.path.join(work_dir, "no_mention_map.parquet"), backend=backend,
+                            score_cache=False)
+    jobs = []
+    for i, ((title, _), sections) in enumerate(zip(fixtures, articles)):
+        lead = " ".join(sentence["sentence"] for sentence in sections[0]["sentences"][:3]) if sections else ""
+        for j in range(targets_per_article):
+            jobs.append({"sections": sections, "article_title": title,
+                         "target_title": titles[(i + j + 1) % len(titles)], "target_lead": lead})
+    num_pairs = sum(len(section["sentences"]) for job in jobs for section in job["sections"])
+
+    def score():
+        # A fresh tokenization cache per run, otherwise only the first run tokenizes
+        scorer.encoder = PairEncoder(scorer.model["tokenizer"])
+        return scorer.get_sentence_scores_batch(jobs, context_size)
+
+    # Warm up, the first batches include one-off allocations and graph optimizations
+    scorer.get_sentence_scores_batch(jobs[:1], context_size)
+    stages["get_sentence_scores"], results = time_stage("get_sentence_scores", score, repeat, num_pairs, "sentences")
+    prepared = {}
+    num_tokens = 0
+    for job in jobs:
+        if id(job["sections"]) not in prepared:
+            prepared[id(job["sections"])] = scorer.window_inputs(job["sections"], context_size)
+        inputs = list(prepared[id(job["sections"])].values())
+        prefix = scorer._build_prefix(job["target_title"], job["target_lead"])
+        num_tokens += sum(len(ids) for ids in scorer.encoder.encode_pairs([prefix] * len(inputs), inputs)["input_ids"])
+    scoring = stages["get_sentence_scores"]
+    scoring["tokens"] = num_tokens
+    scoring["tokens_per_second"] = num_tokens / scoring["seconds"] if scoring["seconds"] else None
+
+    def write(bulk_writes):
+        db = in_memory_db(bulk_writes)
+        for (title, _), sections in zip(fixtures, articles):
+            article_id = db.add_article_meta_data(lang, title, 1, {}, "")
+            db.add_sections(article_id, sections)
+        db.add_targets_meta([{"target_title": title, "lang": lang, "lead": "", "thumbnail": {}, "description": ""}
+                             for title in titles])
+        for job, scores in zip(jobs, results):
+            source_id = article_id_for(lang, job["article_title"], 1)
+            db.add_scores(source_id, target_id_for(lang, job["target_title"]), scores.to_dict("records"), lang)
+            db.update_article_targets(source_id, job["target_title"])
+        db.close()
+
+    num_documents = 2 * len(fixtures) + len(titles) + 2 * len(jobs)
+    stages["db_writes"], _ = time_stage("db_writes", lambda: write(False), repeat, num_documents, "operations")
+    stages["db_writes_bulk"], _ = time_stage("db_writes_bulk", lambda: write(True), repeat, num_documents,
+                                             "operations")
+
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "config": {
+            "articles": len(fixtures),
+            "sentences": num_sentences,
+            "targets_per_article": targets_per_article,
+            "mention_targets": mention_targets,
+            "repeat": repeat,
+            "backend": backend,
+            "model": model_name,
+            # Only with CASCADE_SCORING, the scoring stage then includes the prefilter and skips pruned sentences
+            **({"cascade": scorer.cascade.config()} if scorer.cascade else {}),
+        },
+        "stages": stages,
+        # Totals of the pipeline's own stage timers over all runs, e.g. the split of scoring into tokenize/forward
+        "metrics": metrics.snapshot(),
+    }
+
+
+def compare_reports(report: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """
+    Log the throughput of every stage relative to a baseline report, above 1.0 is faster.
+    """
+    if report["config"] != baseline.get("config"):
+        logging.warning(f"The baseline ran with another configuration: {baseline.get('config')}")
+    for name, stage in report["stages"].items():
+        base = baseline.get("stages", {}).get(name, {})
+        rate_key = next((key for key in stage if key.endswith("_per_second")), None)
+        if base.get(rate_key) and stage[rate_key]:
+            logging.info(f"{name}: {stage[rate_key] / base[rate_key]:.2f}x the throughput of "
+                         f"{baseline.get('commit')} ({base[rate_key]:.1f} -> {stage[rate_key]:.1f} "
+                         f"{rate_key.replace('_', ' ')})")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest and scoring stages offline, without network, GPU or MongoDB")
+    parser.add_argument("--fixtures", help="directory of saved article HTML, synthetic articles if not given")
+    parser.add_argument("--save-fixtures", nargs="+", metavar="TITLE",
+                        help="download these articles into --fixtures and exit (needs network)")
+    parser.add_argument("--articles", type=int, default=10, help="number of synthetic articles")
+    parser.add_argument("--sections", type=int, default=12, help="sections per synthetic article")
+    parser.add_argument("--targets", type=int, default=3,
+                        help="targets scored per article, the other articles, at most one less than there are")
+    parser.add_argument("--mention-targets", type=int, default=100000,
+                        help="targets of the generated mention map whose loading is timed")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest one is reported")
+    parser.add_argument("--model-dir", help="model to score with instead of a tiny random one")
+    parser.add_argument("--backend", default="eager")
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if args.save_fixtures:
+        if not args.fixtures:
+            parser.error("--save-fixtures needs --fixtures")
+        save_fixtures(args.save_fixtures, args.lang, args.fixtures)
+        return
+
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else synthetic_fixtures(args.articles, args.sections)
+    report = run_benchmark(fixtures, args.model_dir, args.targets, args.repeat, args.backend, args.lang,
+                           mention_targets=args.mention_targets)
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Wrote the benchmark report to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
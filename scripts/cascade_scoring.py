@@ -0,0 +1,235 @@
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Weights of the target terms by where they come from, a term found in several places keeps the highest one
+TITLE_WEIGHT = 3.0
+MENTION_WEIGHT = 2.0
+LEAD_WEIGHT = 1.0
+# Share of the weight of a term that is only found in the context window of a sentence and not in the sentence
+CONTEXT_WEIGHT = 0.5
+# Words shorter than this are not used as terms, they are mostly function words
+MIN_TERM_LENGTH = 3
+
+_TERM_PATTERN = re.compile(r'\w+')
+
+
+def text_terms(text: str) -> Set[str]:
+    return {term for term in _TERM_PATTERN.findall(text.casefold()) if len(term) >= MIN_TERM_LENGTH}
+
+
+class CascadeFilter:
+    """
+    First stage of cascade scoring: ranks the sentences of a source by their lexical overlap with a target and picks
+    the ones the cross-encoder scores, the others get a floor score.
+
+    The target terms are the words of its title, of its mentions and the `lead_keywords` most frequent words of its
+    lead, weighted by TITLE_WEIGHT, MENTION_WEIGHT and LEAD_WEIGHT and by their inverse document frequency among the
+    sentences of the source. A sentence scores the weights of the target terms it contains, plus CONTEXT_WEIGHT of
+    the weights of the terms only found in its context window. Per section, the `top_k` best sentences with any
+    overlap go to the model, and so do all sentences scoring at least `threshold` times the best sentence of the
+    section. Every pair sends at least its best sentence.
+
+    Pruned sentences get `floor_score`, by default the lowest model score of the same (source, target) pair, so the
+    range of the scores and the ranking of the scored sentences stay the same.
+    """
+
+    def __init__(self, top_k: int = 3, threshold: Optional[float] = None, floor_score: Optional[float] = None,
+                 lead_keywords: int = 30):
+        self.top_k = top_k
+        self.threshold = threshold
+        self.floor_score = floor_score
+        self.lead_keywords = lead_keywords
+
+    @classmethod
+    def from_env(cls) -> Optional["CascadeFilter"]:
+        """
+        Build a filter from CASCADE_TOP_K, CASCADE_THRESHOLD and CASCADE_FLOOR_SCORE, or return None when
+        CASCADE_SCORING is not set.
+        """
+        if os.environ.get("CASCADE_SCORING", "").lower() not in ("1", "true", "yes"):
+            return None
+        threshold = os.environ.get("CASCADE_THRESHOLD")
+        floor_score = os.environ.get("CASCADE_FLOOR_SCORE")
+        return cls(int(os.environ.get("CASCADE_TOP_K", "3")), float(threshold) if threshold else None,
+                   float(floor_score) if floor_score else None)
+
+    def config(self) -> str:
+        # Part of the prefix hash of the scores, scores of different cascade settings are not interchangeable
+        return f"top_k={self.top_k},threshold={self.threshold},floor={self.floor_score},lead={self.lead_keywords}"
+
+    def prepare(self, sentences: List[Dict[str, Any]], section_sizes: Sequence[int]) -> Dict[str, Any]:
+        """
+        Index the sentence rows of a source, with their 'sentence' and 'context', once for all of its targets.
+        `section_sizes` are the numbers of sentences of its sections, in row order.
+        """
+        sentence_terms = [text_terms(row['sentence']) for row in sentences]
+        context_terms = [text_terms(row['context']) - terms for row, terms in zip(sentences, sentence_terms)]
+        document_frequency = {}
+        for terms in sentence_terms:
+            for term in terms:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        bounds = np.cumsum([0] + list(section_sizes))
+        return {
+            'sentence_terms': sentence_terms,
+            'context_terms': context_terms,
+            'document_frequency': document_frequency,
+            'sections': list(zip(bounds[:-1], bounds[1:])),
+        }
+
+    def target_weights(self, prepared: Dict[str, Any], target_title: str, target_lead: str,
+                       mentions: str = "") -> Dict[str, float]:
+        lead_counts = {}
+        for term in _TERM_PATTERN.findall(target_lead.casefold()):
+            if len(term) >= MIN_TERM_LENGTH:
+                lead_counts[term] = lead_counts.get(term, 0) + 1
+        weights = {term: LEAD_WEIGHT for term in sorted(lead_counts, key=lead_counts.get, reverse=True)
+                   [:self.lead_keywords]}
+        weights.update({term: MENTION_WEIGHT for term in text_terms(mentions)})
+        weights.update({term: TITLE_WEIGHT for term in text_terms(target_title.replace('_', ' '))})
+        num_sentences = max(len(prepared['sentence_terms']), 1)
+        document_frequency = prepared['document_frequency']
+        # Terms in most sentences of the source tell little about where the target fits
+        return {term: weight * math.log(1 + num_sentences / (1 + document_frequency.get(term, 0)))
+                for term, weight in weights.items()}
+
+    def lexical_scores(self, prepared: Dict[str, Any], weights: Dict[str, float]) -> np.ndarray:
+        scores = np.zeros(len(prepared['sentence_terms']), dtype=np.float32)
+        for i, (terms, context) in enumerate(zip(prepared['sentence_terms'], prepared['context_terms'])):
+            scores[i] = (sum(weights.get(term, 0.0) for term in terms)
+                         + CONTEXT_WEIGHT * sum(weights.get(term, 0.0) for term in context))
+        return scores
+
+    def select(self, prepared: Dict[str, Any], target_title: str, target_lead: str, mentions: str = "") -> np.ndarray:
+        """
+        Return a mask of the sentences of a prepared source to score with the model against a target.
+        """
+        scores = self.lexical_scores(prepared, self.target_weights(prepared, target_title, target_lead, mentions))
+        selected = np.zeros(len(scores), dtype=bool)
+        if not len(scores):
+            return selected
+        for start, end in prepared['sections']:
+            section_scores = scores[start:end]
+            if not len(section_scores):
+                continue
+            if self.top_k:
+                # Best first, earlier sentences first on ties
+                ranked = start + np.argsort(-section_scores, kind='stable')[:self.top_k]
+                selected[ranked[scores[ranked] > 0]] = True
+            # Relative to the best sentence of the section, so short or off-topic sections keep their best matches
+            best = section_scores.max()
+            if self.threshold is not None and best > 0:
+                selected[start:end] |= section_scores >= self.threshold * best
+        selected[int(np.argmax(scores))] = True
+        return selected
+
+    def floor(self, model_scores: np.ndarray) -> float:
+        if self.floor_score is not None:
+            return self.floor_score
+        return float(model_scores.min()) if len(model_scores) else 0.0
+
+
+def _timed_scores(scorer, jobs: List[Dict[str, Any]]) -> Tuple[List[np.ndarray], float]:
+    from sentence_score import PairEncoder
+
+    # Every run starts with an empty tokenizer cache, so later operating points are not favoured
+    scorer.encoder = PairEncoder(scorer.model['tokenizer'])
+    started = time.perf_counter()
+    results = scorer.get_sentence_scores_batch(jobs)
+    return [result['score'].to_numpy(dtype=np.float64) for result in results], time.perf_counter() - started
+
+
+def _recall_at(scores: np.ndarray, reference: np.ndarray, n: int) -> float:
+    n = min(n, len(reference))
+    top = set(np.argsort(-scores, kind='stable')[:n])
+    return len(top & set(np.argsort(-reference, kind='stable')[:n])) / n
+
+
+def evaluate_cascade(scorer, jobs: List[Dict[str, Any]], operating_points: List[Tuple[int, Optional[float]]],
+                     recall_at: int = 5) -> List[Dict[str, Any]]:
+    """
+    Score `jobs` exhaustively and with the cascade at every (top_k, threshold) operating point, and report for each
+    the share of the sentences the model scored, the speedup over the exhaustive run, the recall of the exhaustive
+    top `recall_at` sentences of every pair among the cascade's top `recall_at` and the share of pairs whose best
+    sentence is the same.
+
+    The scorer should not have a score cache, cached scores would hide the cost of the exhaustive run.
+    """
+    from pipeline_metrics import metrics
+
+    num_sentences = sum(len(section['sentences']) for job in jobs for section in job['sections'])
+    scorer.cascade = None
+    # Warm up, the first batches include one-off allocations
+    scorer.get_sentence_scores_batch(jobs[:1])
+    reference, reference_seconds = _timed_scores(scorer, jobs)
+    logging.info(f"Exhaustive: {num_sentences} sentences of {len(jobs)} pairs in {reference_seconds:.2f}s")
+    report = []
+    for top_k, threshold in operating_points:
+        scorer.cascade = CascadeFilter(top_k, threshold)
+        pruned_before = metrics.snapshot()['counters'].get('sentences_pruned', 0)
+        scores, seconds = _timed_scores(scorer, jobs)
+        pruned = metrics.snapshot()['counters'].get('sentences_pruned', 0) - pruned_before
+        pairs = [(s, r) for s, r in zip(scores, reference) if len(r)]
+        entry = {
+            'top_k': top_k,
+            'threshold': threshold,
+            'model_share': 1 - pruned / num_sentences if num_sentences else 0.0,
+            'seconds': seconds,
+            'speedup': reference_seconds / seconds if seconds else None,
+            f'recall_at_{recall_at}': float(np.mean([_recall_at(s, r, recall_at) for s, r in pairs])),
+            'top1_agreement': float(np.mean([np.argmax(s) == np.argmax(r) for s, r in pairs])),
+        }
+        report.append(entry)
+        logging.info(f"top_k={top_k} threshold={threshold}: {entry['model_share']:.1%} of the sentences scored, "
+                     f"{entry['speedup']:.2f}x faster, recall@{recall_at} {entry[f'recall_at_{recall_at}']:.1%}, "
+                     f"top-1 agreement {entry['top1_agreement']:.1%}")
+    scorer.cascade = None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate cascade scoring against exhaustive scoring on articles stored in the database")
+    parser.add_argument("--model-dir", default=os.environ.get("MODEL_DIR", "/path/to/model_dir"))
+    parser.add_argument("--mention-map", default=os.environ.get("MENTION_MAP_PATH", "/path/to/mention_map.parquet"))
+    parser.add_argument("--backend", default=None, help="scoring backend, SCORER_BACKEND by default")
+    parser.add_argument("--articles", type=int, default=5, help="number of stored articles to score")
+    parser.add_argument("--top-k", type=int, nargs="*", default=[1, 2, 3, 5],
+                        help="sentences per section sent to the model, one operating point each")
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[0.25, 0.5],
+                        help="shares of the best lexical score of a section sent to the model, "
+                             "one operating point each")
+    parser.add_argument("--recall-at", type=int, default=5)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    from inference_backends import sample_jobs
+    from sentence_score import SentenceScorer
+    from wiki_mongo_db import WikiMongoDB
+
+    with WikiMongoDB() as db:
+        jobs = sample_jobs(db, args.articles)
+    if not jobs:
+        raise SystemExit("No scored articles in the database to evaluate the cascade on")
+    scorer = SentenceScorer(args.model_dir, args.mention_map, backend=args.backend, score_cache=False, cascade=False)
+    operating_points = [(top_k, None) for top_k in args.top_k] + [(0, threshold) for threshold in args.thresholds]
+    report = evaluate_cascade(scorer, jobs, operating_points, args.recall_at)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
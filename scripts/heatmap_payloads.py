@@ -0,0 +1,54 @@
+import gzip
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+PAYLOAD_ENCODINGS = ("gzip", "br")
+
+
+def heatmap_json(records: List[Dict[str, Any]]) -> bytes:
+    """
+    Serialize score records exactly like the backend's /heatmap response: a compact JSON list of
+    {id, startOffset, endOffset, score} objects in sentence order. Scores stay raw, the extension normalizes them
+    with the scale selected by the user.
+    """
+    sentences = [
+        {"id": int(record["idx"]), "startOffset": int(record["start"]), "endOffset": int(record["end"]),
+         "score": float(record["score"])}
+        for record in records
+    ]
+    return json.dumps(sentences, separators=(",", ":")).encode("utf-8")
+
+
+def compress(data: bytes, encoding: str = "gzip") -> bytes:
+    if encoding == "gzip":
+        # A fixed header timestamp keeps the bytes, and so the stored payload, identical across rebuilds
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        try:
+            import brotli
+        except ImportError:
+            raise ImportError("Brotli heatmap payloads require the brotli package: pip install brotli")
+        return brotli.compress(data, quality=11)
+    raise ValueError(f"Unknown payload encoding '{encoding}', expected one of {', '.join(PAYLOAD_ENCODINGS)}")
+
+
+def build_heatmap_payload(records: List[Dict[str, Any]], encoding: str = "gzip") -> Dict[str, Any]:
+    """
+    Build the ready-to-serve heatmap of one pair: the compressed JSON body, its Content-Encoding and a strong ETag
+    derived from the uncompressed content.
+    """
+    body = heatmap_json(records)
+    return {
+        "encoding": encoding,
+        "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        "content_type": "application/json",
+        "size": len(body),
+        "payload": compress(body, encoding),
+    }
@@ -0,0 +1,272 @@
+import argparse
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# eager: the PyTorch model as loaded, on the GPU if there is one
+# int8: dynamic int8 quantization of the linear layers of the encoder and the classification head
+# torchscript: traced and frozen TorchScript graph of the encoder and the classification head
+# onnx / onnx-int8: the same graph exported to ONNX and run with ONNX Runtime, optionally int8 quantized
+INFERENCE_BACKENDS = ('eager', 'int8', 'torchscript', 'onnx', 'onnx-int8')
+
+# Maps a padded batch of tokenizer features to one score per row
+ForwardFn = Callable[[Dict[str, torch.Tensor]], np.ndarray]
+
+
+class CrossEncoder(nn.Module):
+    """
+    The encoder and the classification head as a single module taking the tokenizer outputs as positional tensors,
+    so it can be quantized, traced and exported as one graph.
+    """
+
+    def __init__(self, encoder: nn.Module, head: nn.Module, input_names: List[str]):
+        super().__init__()
+        self.encoder = encoder
+        self.head = head
+        self.input_names = list(input_names)
+
+    def forward(self, *inputs):
+        features = dict(zip(self.input_names, inputs))
+        embeddings = self.encoder(**features, return_dict=False)[0][:, 0, :]
+        return self.head(embeddings).squeeze(-1)
+
+
+def configure_threads(intra_op_threads: int = None, inter_op_threads: int = None) -> None:
+    """
+    Set the number of PyTorch threads used within an operator and across operators, 0 or None keeps the default.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # Can only be set once per process, before any inter-op parallel work
+            logging.warning(f"Could not set the inter-op thread count to {inter_op_threads}: {e}")
+
+
+def _input_names(tokenizer) -> List[str]:
+    return [name for name in tokenizer.model_input_names if name in ('input_ids', 'token_type_ids', 'attention_mask')]
+
+
+def _example_inputs(tokenizer, input_names):
+    features = tokenizer([("example target", "example section and context")] * 2, padding=True, return_tensors='pt')
+    return tuple(features[name] for name in input_names)
+
+
+def _cpu_cross_encoder(model) -> CrossEncoder:
+    return CrossEncoder(model['model'], model['classification_head'], _input_names(model['tokenizer'])).cpu().eval()
+
+
+def _eager_forward(model) -> ForwardFn:
+    encoder = model['model']
+    head = model['classification_head']
+    device = next(encoder.parameters()).device
+
+    def forward(features):
+        with torch.no_grad():
+            features = {key: value.to(device) for key, value in features.items()}
+            embeddings = encoder(**features)['last_hidden_state'][:, 0, :]
+            return head(embeddings).squeeze(-1).float().cpu().numpy()
+
+    return forward
+
+
+def _module_forward(module: nn.Module, input_names: List[str]) -> ForwardFn:
+    def forward(features):
+        with torch.no_grad():
+            return module(*(features[name].cpu() for name in input_names)).float().numpy()
+
+    return forward
+
+
+def _int8_forward(model) -> ForwardFn:
+    cross_encoder = _cpu_cross_encoder(model)
+    quantized = torch.quantization.quantize_dynamic(cross_encoder, {nn.Linear}, dtype=torch.qint8)
+    return _module_forward(quantized, cross_encoder.input_names)
+
+
+def _torchscript_forward(model) -> ForwardFn:
+    cross_encoder = _cpu_cross_encoder(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(cross_encoder, _example_inputs(model['tokenizer'], cross_encoder.input_names),
+                                 check_trace=False)
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    return _module_forward(traced, cross_encoder.input_names)
+
+
+def export_onnx(model, path: str, quantize: bool = False) -> str:
+    """
+    Export the encoder and the classification head to an ONNX graph with dynamic batch and sequence axes, optionally
+    int8 quantized, and return its path. An existing export at `path` is reused, delete it after a model update.
+    """
+    if os.path.exists(path):
+        logging.info(f"Using the ONNX export at {path}")
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fp32_path = path.replace('.int8.onnx', '.onnx') if quantize else path
+    if not os.path.exists(fp32_path):
+        cross_encoder = _cpu_cross_encoder(model)
+        input_names = cross_encoder.input_names
+        logging.info(f"Exporting the scoring model to {fp32_path}")
+        with torch.no_grad():
+            torch.onnx.export(
+                cross_encoder,
+                _example_inputs(model['tokenizer'], input_names),
+                fp32_path,
+                input_names=input_names,
+                output_names=['score'],
+                dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names}, 'score': {0: 'batch'}},
+                opset_version=17,
+                dynamo=False,
+            )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logging.info(f"Quantizing {fp32_path} to {path}")
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+    return path
+
+
+def _onnx_forward(model, export_dir: str, quantize: bool, intra_op_threads: int = None,
+                  inter_op_threads: int = None) -> ForwardFn:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx scoring backends require the onnxruntime package: pip install onnxruntime")
+    path = export_onnx(model, os.path.join(export_dir, 'scorer.int8.onnx' if quantize else 'scorer.onnx'), quantize)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    input_names = [node.name for node in session.get_inputs()]
+
+    def forward(features):
+        inputs = {name: features[name].cpu().numpy().astype(np.int64) for name in input_names}
+        return session.run(None, inputs)[0].astype(np.float32)
+
+    return forward
+
+
+def load_inference_backend(model, backend: str = 'eager', export_dir: str = None, intra_op_threads: int = None,
+                           inter_op_threads: int = None) -> ForwardFn:
+    """
+    Build the forward function of the `backend` for a model loaded with `load_model`.
+
+    All backends but 'eager' run on the CPU. The onnx backends export the model to `export_dir` on first use.
+    """
+    if backend == 'eager':
+        return _eager_forward(model)
+    if backend == 'int8':
+        return _int8_forward(model)
+    if backend == 'torchscript':
+        return _torchscript_forward(model)
+    if backend in ('onnx', 'onnx-int8'):
+        return _onnx_forward(model, export_dir, backend == 'onnx-int8', intra_op_threads, inter_op_threads)
+    raise ValueError(f"Unknown scoring backend '{backend}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+
+def sample_jobs(db, max_articles: int = 5) -> List[Dict[str, Any]]:
+    """
+    Build scoring jobs from articles already stored in the database, one per stored (source, target) pair.
+    """
+    from wiki_mongo_db import target_id_for
+
+    jobs = []
+    for article in db.articles_collection.find({"targets.0": {"$exists": True}}).limit(max_articles):
+        sections = db.get_sections(article["_id"])
+        for target_title in article["targets"]:
+            target = db.targets_collection.find_one({"_id": target_id_for(article["lang"], target_title)})
+            if target:
+                jobs.append({
+                    'sections': sections,
+                    'article_title': article["title"],
+                    'target_title': target_title,
+                    'target_lead': target["lead"],
+                })
+    return jobs
+
+
+def compare_backends(model_dir: str, mention_map_path: str, jobs: List[Dict[str, Any]], backends: List[str],
+                     intra_op_threads: int = None, inter_op_threads: int = None,
+                     export_dir: Optional[str] = None) -> List[Dict[str, float]]:
+    """
+    Score `jobs` with the eager model and with every backend, and report the throughput and the deviation of the
+    scores from the eager ones: maximum and mean absolute difference, Pearson correlation and the share of jobs whose
+    best sentence is the same.
+    """
+    from sentence_score import SentenceScorer
+
+    configure_threads(intra_op_threads, inter_op_threads)
+    threads = torch.get_num_threads()
+    num_sentences = sum(len(section['sentences']) for job in jobs for section in job['sections'])
+    reference = None
+    report = []
+    for backend in ['eager'] + [backend for backend in backends if backend != 'eager']:
+        scorer = SentenceScorer(model_dir, mention_map_path, backend=backend, intra_op_threads=intra_op_threads,
+                                inter_op_threads=inter_op_threads, export_dir=export_dir, score_cache=False)
+        # Warm up, the first batches include one-off graph optimizations
+        scorer.get_sentence_scores_batch(jobs[:1])
+        started = time.perf_counter()
+        results = scorer.get_sentence_scores_batch(jobs)
+        elapsed = time.perf_counter() - started
+        scores = [result['score'].to_numpy(dtype=np.float64) for result in results]
+        if reference is None:
+            reference = scores
+        flat, flat_reference = np.concatenate(scores), np.concatenate(reference)
+        diff = np.abs(flat - flat_reference)
+        top1 = np.mean([np.argmax(s) == np.argmax(r) for s, r in zip(scores, reference) if len(r)])
+        entry = {
+            'backend': backend,
+            'seconds': elapsed,
+            'sentences_per_second': num_sentences / elapsed,
+            'sentences_per_second_per_thread': num_sentences / elapsed / threads,
+            'max_abs_diff': float(diff.max()),
+            'mean_abs_diff': float(diff.mean()),
+            'pearson': float(np.corrcoef(flat, flat_reference)[0, 1]) if len(flat) > 1 else 1.0,
+            'top1_agreement': float(top1),
+        }
+        report.append(entry)
+        logging.info(f"{backend}: {entry['sentences_per_second']:.1f} sentences/s "
+                     f"({entry['sentences_per_second_per_thread']:.1f} per thread), max |diff| "
+                     f"{entry['max_abs_diff']:.4g}, mean |diff| {entry['mean_abs_diff']:.4g}, "
+                     f"pearson {entry['pearson']:.5f}, top-1 agreement {entry['top1_agreement']:.1%}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the scoring backends with the eager model on articles stored in the database")
+    parser.add_argument("--model-dir", default=os.environ.get("MODEL_DIR", "/path/to/model_dir"))
+    parser.add_argument("--mention-map", default=os.environ.get("MENTION_MAP_PATH", "/path/to/mention_map.parquet"))
+    parser.add_argument("--backends", nargs="+", default=list(INFERENCE_BACKENDS[1:]), choices=INFERENCE_BACKENDS)
+    parser.add_argument("--articles", type=int, default=5, help="number of stored articles to score")
+    parser.add_argument("--intra-op-threads", type=int, default=None)
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    from wiki_mongo_db import WikiMongoDB
+
+    with WikiMongoDB() as db:
+        jobs = sample_jobs(db, args.articles)
+    if not jobs:
+        raise SystemExit("No scored articles in the database to compare the backends on")
+    compare_backends(args.model_dir, args.mention_map, jobs, args.backends, args.intra_op_threads,
+                     args.inter_op_threads)
+
+
+if __name__ == "__main__":
+    main()
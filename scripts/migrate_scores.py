@@ -0,0 +1,31 @@
+import argparse
+import logging
+
+from wiki_mongo_db import PACKED_DTYPES, WikiMongoDB
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the article_scores documents between the records and the packed score schema")
+    parser.add_argument("--to", choices=("packed", "records"), default="packed",
+                        help="schema to convert to, 'records' converts packed documents back")
+    parser.add_argument("--dtype", choices=PACKED_DTYPES, default=None,
+                        help="float type of packed scores (default: SCORE_PACKED_DTYPE or float32)")
+    parser.add_argument("--batch-size", type=int, default=500, help="documents per bulk write")
+    parser.add_argument("--dry-run", action="store_true", help="only report how many documents and bytes change")
+    args = parser.parse_args()
+
+    with WikiMongoDB() as db:
+        stats = db.migrate_scores(args.to, args.dtype, args.batch_size, args.dry_run)
+    if stats["bytes_before"]:
+        logging.info(f"Converted documents take {stats['bytes_after'] / stats['bytes_before']:.1%} "
+                     f"of their previous size.")
+
+
+if __name__ == "__main__":
+    main()
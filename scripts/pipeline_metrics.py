@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# fetch: HTML and metadata downloads, parse: HTML parsing and section extraction, segment: sentence splitting,
+# context: context windows, tokenize: tokenization and padding, forward: model inference, write: database writes
+STAGES = ('fetch', 'parse', 'segment', 'context', 'tokenize', 'forward', 'write')
+METRICS_FORMATS = ('prometheus', 'jsonl')
+
+
+class Metrics:
+    """
+    Thread-safe registry of the stage timers, counters and gauges of a pipeline process.
+
+    A stage accumulates its calls, the items they processed and the seconds they took. Gauges are callables read
+    when a snapshot is taken, e.g. queue depths and cache hit rates, so the instrumented code does not push them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # stage -> [calls, items, seconds, slowest call]
+        self.stages = {}
+        self.counters = {}
+        # (name, labels) -> callable
+        self.gauges = {}
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, items)
+
+    def observe(self, stage: str, seconds: float, items: int = 1) -> None:
+        with self._lock:
+            totals = self.stages.setdefault(stage, [0, 0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += items
+            totals[2] += seconds
+            totals[3] = max(totals[3], seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def register_gauge(self, name: str, read: Callable[[], float], **labels: str) -> None:
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = read
+
+    def unregister_gauges(self, name: str) -> None:
+        with self._lock:
+            self.gauges = {key: read for key, read in self.gauges.items() if key[0] != name}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {stage: list(totals) for stage, totals in self.stages.items()}
+            counters = dict(self.counters)
+            gauges = list(self.gauges.items())
+        gauge_values = []
+        for (name, labels), read in gauges:
+            try:
+                gauge_values.append({"name": name, "labels": dict(labels), "value": float(read())})
+            except Exception as e:
+                logging.debug(f"Could not read gauge {name}{dict(labels)}: {e}")
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": time.time() - self.started,
+            "stages": {
+                stage: {"calls": calls, "items": items, "seconds": seconds, "max_seconds": slowest,
+                        "items_per_second": items / seconds if seconds else None}
+                for stage, (calls, items, seconds, slowest) in stages.items()
+            },
+            "counters": counters,
+            "gauges": gauge_values,
+        }
+
+
+# Process-wide registry shared by the pipeline modules
+metrics = Metrics()
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def to_prometheus(snapshot: Dict[str, Any], prefix: str = "wikinsert") -> str:
+    """
+    Render a snapshot in the Prometheus text exposition format, e.g. for the node_exporter textfile collector.
+    """
+    lines = []
+    stage_metrics = (
+        ("stage_calls_total", "counter", "Calls of the stage", "calls"),
+        ("stage_items_total", "counter", "Items processed by the stage", "items"),
+        ("stage_seconds_total", "counter", "Seconds spent in the stage", "seconds"),
+        ("stage_max_seconds", "gauge", "Slowest call of the stage", "max_seconds"),
+    )
+    for name, kind, help_text, key in stage_metrics:
+        lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} {kind}"]
+        lines += [f'{prefix}_{name}{{stage="{stage}"}} {values[key]}'
+                  for stage, values in sorted(snapshot["stages"].items())]
+    for name, value in sorted(snapshot["counters"].items()):
+        lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+    declared = set()
+    for gauge in sorted(snapshot["gauges"], key=lambda gauge: gauge["name"]):
+        if gauge["name"] not in declared:
+            lines.append(f"# TYPE {prefix}_{gauge['name']} gauge")
+            declared.add(gauge["name"])
+        lines.append(f"{prefix}_{gauge['name']}{_labels(gauge['labels'])} {gauge['value']}")
+    lines.append(f"# TYPE {prefix}_uptime_seconds gauge")
+    lines.append(f"{prefix}_uptime_seconds {snapshot['uptime_seconds']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """
+    Writes snapshots of a Metrics registry to a file every `interval` seconds from a daemon thread, and a last one
+    when stopped.
+
+    The 'prometheus' format replaces the file atomically with the current totals, the 'jsonl' format appends one
+    snapshot per line.
+    """
+
+    def __init__(self, path: str, metrics_format: str = "prometheus", interval: float = 30.0,
+                 registry: Metrics = None):
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(f"Unknown metrics format '{metrics_format}', expected 'prometheus' or 'jsonl'")
+        self.path = path
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.registry = registry or metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, registry: Metrics = None) -> Optional["MetricsReporter"]:
+        """
+        Build a reporter from METRICS_PATH, METRICS_FORMAT and METRICS_INTERVAL, or return None when METRICS_PATH is
+        not set.
+        """
+        path = os.environ.get("METRICS_PATH")
+        if not path:
+            return None
+        return cls(path, os.environ.get("METRICS_FORMAT", "prometheus"),
+                   float(os.environ.get("METRICS_INTERVAL", "30")), registry)
+
+    def write(self) -> None:
+        snapshot = self.registry.snapshot()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.metrics_format == "jsonl":
+            with open(self.path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+            return
+        # Collectors must never read a partly written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(to_prometheus(snapshot))
+        os.replace(tmp_path, self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            logging.info(f"Writing {self.metrics_format} metrics to {self.path} every {self.interval:g}s")
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        # Like the periodic writes, a failed last write must not keep the caller from shutting down
+        try:
+            self.write()
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {self.path}: {e}")
+
+
+def trace_sampled() -> bool:
+    """
+    Whether to log a detailed trace of the current item, for a TRACE_SAMPLE_RATE share of the items (default 0.01).
+    """
+    rate = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+    return rate > 0 and random.random() < rate
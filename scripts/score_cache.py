@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Rows per SQLite statement, below the default limit of bound parameters
+QUERY_CHUNK_SIZE = 900
+
+# Weight files transformers' from_pretrained looks for in model/, in its order of preference
+MODEL_WEIGHT_NAMES = ('model.safetensors', 'model.safetensors.index.json', 'pytorch_model.bin',
+                      'pytorch_model.bin.index.json')
+WEIGHT_SUFFIXES = ('.bin', '.pth', '.pt', '.safetensors', '.h5', '.msgpack', '.ckpt')
+# An explicit version of the model, which stands for the whole model directory when present
+MODEL_VERSION_FILE = 'VERSION'
+# Content hashes of the model files, kept next to them so the weights are only read again when they change
+CONTENT_HASHES_FILE = 'content_hashes.json'
+# A recorded hash is only trusted for a file last modified this long before it was hashed, a file written again
+# within the same timestamp tick would otherwise keep its size and modification time
+RACY_SECONDS = 2
+
+
+def _loaded_weight_files(model_subdir: str) -> List[str]:
+    # The first of MODEL_WEIGHT_NAMES present, with the shards of an index
+    for name in MODEL_WEIGHT_NAMES:
+        path = os.path.join(model_subdir, name)
+        if not os.path.exists(path):
+            continue
+        if not name.endswith('.index.json'):
+            return [path]
+        with open(path) as f:
+            shards = sorted(set(json.load(f)['weight_map'].values()))
+        return [path] + [os.path.join(model_subdir, shard) for shard in shards]
+    return []
+
+
+def model_files(model_dir: str) -> List[str]:
+    """
+    Return the files load_model reads from a model directory: the config files and the weights from_pretrained picks
+    in model/, the tokenizer files and the classification head load_classification_head_state picks.
+    """
+    model_subdir = os.path.join(model_dir, 'model')
+    files = []
+    if os.path.isdir(model_subdir):
+        files += [os.path.join(model_subdir, name) for name in sorted(os.listdir(model_subdir))
+                  if not name.endswith(WEIGHT_SUFFIXES) and not name.endswith('.index.json')]
+        files += _loaded_weight_files(model_subdir)
+    for root, dirs, names in os.walk(os.path.join(model_dir, 'tokenizer')):
+        dirs.sort()
+        files += [os.path.join(root, name) for name in sorted(names)]
+    head_path = os.path.join(model_dir, 'classification_head.safetensors')
+    files.append(head_path if os.path.exists(head_path) else os.path.join(model_dir, 'classification_head.pth'))
+    return [path for path in files if os.path.isfile(path)]
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_hashes(model_dir: str, paths: List[str]) -> Dict[str, str]:
+    """
+    Return the sha256 of the content of `paths` by their path relative to `model_dir`.
+
+    Hashes recorded in CONTENT_HASHES_FILE are reused for files whose size and modification time are unchanged, the
+    new ones are recorded when the model directory is writable.
+    """
+    record_path = os.path.join(model_dir, CONTENT_HASHES_FILE)
+    try:
+        with open(record_path) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        recorded = {}
+    entries = {}
+    for path in paths:
+        name = os.path.relpath(path, model_dir)
+        stat = os.stat(path)
+        entry = recorded.get(name, {})
+        if (entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns
+                or stat.st_mtime_ns >= entry.get('hashed_at_ns', 0) - RACY_SECONDS * 1_000_000_000):
+            # Taken before reading, a file modified while it is hashed is hashed again next time
+            hashed_at_ns = time.time_ns()
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hashed_at_ns': hashed_at_ns,
+                     'sha256': _file_hash(path)}
+        entries[name] = entry
+    if entries != recorded:
+        tmp_path = f"{record_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(tmp_path, record_path)
+        except OSError as e:
+            logging.warning(f"Could not record the content hashes of {model_dir}, they are computed on every start: "
+                            f"{e}")
+    return {name: entry['sha256'] for name, entry in entries.items()}
+
+
+def model_fingerprint(model_dir: str, backend: str = 'eager') -> str:
+    """
+    Fingerprint the model load_model reads from `model_dir` and the inference backend, which changes the scores of
+    the quantized backends.
+
+    With a VERSION file in the model directory, the fingerprint is its content. Otherwise it hashes the content of
+    the loaded config, tokenizer, weight and classification head files, so copies of a model on several hosts have
+    the same fingerprint. Files that are not loaded, like the ONNX exports or weights another format takes
+    precedence over, are left out.
+    """
+    digest = hashlib.sha256(backend.encode())
+    version_path = os.path.join(model_dir, MODEL_VERSION_FILE)
+    if os.path.exists(version_path):
+        with open(version_path, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+    for name, content_hash in content_hashes(model_dir, model_files(model_dir)).items():
+        digest.update(f"{name}\x1f{content_hash}\x1f".encode())
+    return digest.hexdigest()
+
+
+class ScoreCache:
+    """
+    Persistent cache of sentence scores in a SQLite file.
+
+    A score is keyed by a hash of the model fingerprint, the target prefix and the section+context input, so
+    identical sentence windows of different source revisions are scored once per target. The cache holds at most
+    `max_entries` scores; beyond that, the least recently used tenth is evicted. Several processes on a host can share
+    the file.
+    """
+
+    def __init__(self, path: str, fingerprint: str, max_entries: int = 50_000_000):
+        self.path = path
+        self.fingerprint = fingerprint.encode()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, score REAL NOT NULL, used_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS scores_used_at ON scores (used_at)")
+        self._size = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    @classmethod
+    def from_env(cls, model_dir: str, backend: str = 'eager',
+                 fingerprint: Optional[str] = None) -> Optional["ScoreCache"]:
+        """
+        Build the cache from SCORE_CACHE_PATH and SCORE_CACHE_MAX_ENTRIES, or return None when SCORE_CACHE_PATH is
+        not set. The model fingerprint is computed unless it is given.
+        """
+        path = os.environ.get("SCORE_CACHE_PATH")
+        if not path:
+            return None
+        max_entries = int(os.environ.get("SCORE_CACHE_MAX_ENTRIES", "50000000"))
+        if fingerprint is None:
+            started = time.time()
+            fingerprint = model_fingerprint(model_dir, backend)
+            logging.info(f"Model fingerprint {fingerprint[:12]} computed in {time.time() - started:.1f}s")
+        logging.info(f"Score cache at {path}, model fingerprint {fingerprint[:12]}")
+        return cls(path, fingerprint, max_entries)
+
+    def key(self, prefix: str, text: str) -> bytes:
+        return hashlib.blake2b(b"\x1f".join([self.fingerprint, prefix.encode(), text.encode()]),
+                               digest_size=16).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, float]:
+        """
+        Return the cached scores of `keys` and mark them as recently used.
+        """
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+                chunk = keys[i:i + QUERY_CHUNK_SIZE]
+                placeholders = ", ".join("?" * len(chunk))
+                found.update(self.connection.execute(
+                    f"SELECT key, score FROM scores WHERE key IN ({placeholders})", chunk))
+            if found:
+                now = time.time()
+                self.connection.executemany("UPDATE scores SET used_at = ? WHERE key = ?",
+                                            [(now, key) for key in found])
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[bytes, float]]) -> None:
+        now = time.time()
+        rows = [(key, float(score), now) for key, score in items]
+        if not rows:
+            return
+        with self._lock:
+            before = self.connection.total_changes
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR IGNORE INTO scores (key, score, used_at) VALUES (?, ?, ?)", rows)
+            self.connection.execute("COMMIT")
+            self._size += self.connection.total_changes - before
+            if self._size > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used scores until the cache is back under 90% of its capacity.
+        """
+        started = time.time()
+        to_remove = self._size - int(self.max_entries * 0.9)
+        self.connection.execute(
+            "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY used_at LIMIT ?)", (to_remove,))
+        self._size = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        logging.info(f"Evicted {to_remove} cached scores in {time.time() - started:.2f}s, "
+                     f"{self._size} scores left")
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self) -> None:
+        self.connection.close()
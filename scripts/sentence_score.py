@@ -1,14 +1,24 @@
+import hashlib
 import logging
 import os
-import random
-from typing import Dict, Any, List
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import torch
 import torch.nn as nn
+from safetensors.torch import load_file as load_safetensors, save_file as save_safetensors
 from tqdm import tqdm
 from transformers import AutoModel, AutoTokenizer
 
+from cascade_scoring import CascadeFilter
+from inference_backends import configure_threads, load_inference_backend
+from pipeline_metrics import metrics, trace_sampled
+from score_cache import ScoreCache, model_fingerprint
+
 # Import utility functions from the common module
 
 # Configure logging
@@ -21,50 +31,127 @@ logging.basicConfig(
 )
 
 
-def get_context_for_sentence(sentences, sentence, context_size=5):
-    sentence_ids = [sentence['idx'] for sentence in sentences]
-    current_sentence_pos = sentence['idx']
+def build_context_windows(sentences, context_size=5, as_offsets=False):
+    """
+    Build the context window of every sentence of a section in a single pass.
 
-    start_pos = max(0, current_sentence_pos - context_size)
-    end_pos = min(len(sentence_ids) - 1, current_sentence_pos + context_size)
+    The window of the sentence at position i of the section spans the sentences at positions
+    i - context_size to i + context_size, joined by single spaces. With `as_offsets` the windows are
+    returned as (start, end) character offsets into the joined section text instead of copied strings.
+    """
+    texts = [sentence['sentence'] for sentence in sentences]
+    # Offset of every sentence in the section text joined by single spaces
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + 1
 
-    context_indices = sentence_ids[start_pos:end_pos + 1]
+    last_pos = len(texts) - 1
+    windows = []
+    for pos in range(len(texts)):
+        first = max(0, pos - context_size)
+        last = min(last_pos, pos + context_size)
+        windows.append((starts[first], starts[last] + len(texts[last])))
+    if as_offsets:
+        return windows
 
-    # Get the context sentences
-    context_sentences = [sentence for sentence in sentences if sentence['idx'] in context_indices]
-    # Join the context sentences into a single string
-    context_text = " ".join([sentence['sentence'] for sentence in context_sentences])
-    return context_text
+    joined = " ".join(texts)
+    return [joined[start:end] for start, end in windows]
 
 
 def set_context_for_sentences(section, context_size=5):
     sentences = section['sentences']
-    for sentence in sentences:
-        context = get_context_for_sentence(sentences, sentence, context_size)
+    for sentence, context in zip(sentences, build_context_windows(sentences, context_size)):
         sentence['context'] = context
 
 
-def load_mention_map(mention_map_path):
+MAX_MENTIONS = 10
+MIN_MENTION_LENGTH = 3
+
+
+def load_mention_map(mention_map_path, lang=None, seed=0, lang_column='lang'):
+    """
+    Load the mentions of every target title as one space-separated string.
+
+    Mentions are lowercased and deduplicated per title. Titles with more than 10 mentions keep the 10 shortest
+    after dropping mentions shorter than 3 characters (as long as more than 10 remain), in an order shuffled with
+    `seed`; titles with fewer mentions keep them in the order of the file. Only the target_title and mention columns
+    are read, and with `lang` only the rows of that language in `lang_column`.
+    """
+    started = time.time()
+    columns = ['target_title', 'mention']
+    filters = None
     try:
-        mention_df = pd.read_parquet(mention_map_path)
-        mention_map = {}
-        for _, row in mention_df.iterrows():
-            title = row.get('target_title')
-            mention_map.setdefault(title, []).append(row.get('mention', '').lower())
-        for title, mentions in mention_map.items():
-            mentions = list(set(mentions))
-            if len(mentions) > 10:
-                mentions.sort(key=len)
-                while len(mentions) > 10 and len(mentions[0]) < 3:
-                    mentions.pop(0)
-                mentions = mentions[:10]
-                random.shuffle(mentions)
-            mention_map[title] = ' '.join(mentions)
-    except Exception:
-        mention_map = {}
+        schema_names = pq.read_schema(mention_map_path).names
+    except FileNotFoundError:
+        logging.warning(f"No mention map at {mention_map_path}, targets are scored without mentions")
+        return {}
+    if lang:
+        if lang_column in schema_names:
+            columns.append(lang_column)
+            filters = [(lang_column, '=', lang)]
+        else:
+            logging.warning(f"Mention map has no '{lang_column}' column, loading the mentions of all languages")
+    mention_df = pd.read_parquet(mention_map_path, columns=columns, filters=filters)
+    num_rows = len(mention_df)
+
+    mention_df = mention_df.dropna(subset=['target_title', 'mention'])
+    mention_df = pd.DataFrame({
+        'target_title': mention_df['target_title'].to_numpy(),
+        'mention': mention_df['mention'].astype(str).str.lower().to_numpy(),
+    }).drop_duplicates()
+    mention_df['length'] = mention_df['mention'].str.len()
+    titles = mention_df.groupby('target_title', sort=False)
+    count = titles['mention'].transform('size')
+
+    # Targets with many mentions: sort by length, drop short mentions while more than 10 remain, keep 10
+    many = mention_df[count > MAX_MENTIONS].sort_values(['target_title', 'length'], kind='stable')
+    if len(many):
+        by_title = many.groupby('target_title', sort=False)
+        rank = by_title.cumcount()
+        num_short = (many['length'] < MIN_MENTION_LENGTH).groupby(many['target_title'], sort=False).transform('sum')
+        dropped = np.minimum(num_short, by_title['mention'].transform('size') - MAX_MENTIONS)
+        many = many[(rank >= dropped) & (rank < dropped + MAX_MENTIONS)]
+        # Shuffle the kept mentions of every title reproducibly
+        many = many.assign(order=np.random.default_rng(seed).random(len(many)))
+        many = many.sort_values(['target_title', 'order'], kind='stable')
+
+    mentions = pd.concat([mention_df[count <= MAX_MENTIONS], many])
+    # Joining in plain Python is much faster than a groupby aggregation over many small groups
+    mention_map = {}
+    for title, mention in zip(mentions['target_title'].tolist(), mentions['mention'].tolist()):
+        mention_map.setdefault(title, []).append(mention)
+    mention_map = {title: ' '.join(title_mentions) for title, title_mentions in mention_map.items()}
+    logging.info(f"Loaded the mentions of {len(mention_map)} targets from {num_rows} rows "
+                 f"in {time.time() - started:.2f}s")
     return mention_map
 
 
+def load_classification_head_state(model_dir):
+    """
+    Load the state dict of the classification head, memory-mapped from classification_head.safetensors when the
+    model directory has one and from classification_head.pth otherwise.
+    """
+    safetensors_path = os.path.join(model_dir, 'classification_head.safetensors')
+    if os.path.exists(safetensors_path):
+        return load_safetensors(safetensors_path, device='cpu')
+    return torch.load(os.path.join(model_dir, 'classification_head.pth'), map_location='cpu')
+
+
+def convert_to_safetensors(model_dir):
+    """
+    Rewrite the weights of a model directory as safetensors, which are memory-mapped when loaded instead of being
+    read and copied into memory: model/model.safetensors and classification_head.safetensors.
+    """
+    model = AutoModel.from_pretrained(os.path.join(model_dir, 'model'))
+    model.save_pretrained(os.path.join(model_dir, 'model'), safe_serialization=True)
+    head_state = torch.load(os.path.join(model_dir, 'classification_head.pth'), map_location='cpu')
+    save_safetensors({key: tensor.contiguous() for key, tensor in head_state.items()},
+                     os.path.join(model_dir, 'classification_head.safetensors'))
+    logging.info(f"Wrote the weights of {model_dir} as safetensors")
+
+
 def load_model(model_dir, use_cuda=True):
     logging.info(f"Loading model from {model_dir}")
 
@@ -78,8 +165,7 @@ def load_model(model_dir, use_cuda=True):
         nn.ReLU(),
         nn.Linear(model['model'].config.hidden_size, 1)
     )
-    model['classification_head'].load_state_dict(torch.load(
-        os.path.join(model_dir, 'classification_head.pth'), map_location='cpu'))
+    model['classification_head'].load_state_dict(load_classification_head_state(model_dir))
     model['classification_head'].eval()
 
     if use_cuda:
@@ -88,12 +174,289 @@ def load_model(model_dir, use_cuda=True):
             'cuda' if torch.cuda.is_available() else 'cpu')
     return model
 
+
+def build_token_budget_batches(lengths: List[int], max_batch_tokens: int = 16384, max_batch_size: int = 64):
+    """
+    Group item positions into batches of similar token length.
+
+    Items are visited shortest first so every batch is padded only up to its longest member. A batch is
+    closed once adding the next item would exceed `max_batch_tokens` padded tokens or `max_batch_size` items.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    current = []
+    for i in order:
+        # Sorted order means the new item is always the longest of the batch
+        if current and (lengths[i] * (len(current) + 1) > max_batch_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+def _truncated_lengths(len_a: int, len_b: int, budget: int, fast: bool) -> Tuple[int, int]:
+    """
+    Lengths of the two sequences of a pair after 'longest_first' truncation to `budget` tokens, following the rule
+    of the fast (Rust) tokenizers or of the slow (Python) ones.
+    """
+    if len_a + len_b <= budget:
+        return len_a, len_b
+    if fast:
+        # The shorter sequence is kept if it fits in half the budget, otherwise both get half and the second one
+        # the odd token
+        short, long_ = sorted((len_a, len_b))
+        n_short = short
+        n_long = short if short > budget else max(short, budget - short)
+        if n_short + n_long > budget:
+            n_short = budget // 2
+            n_long = n_short + budget % 2
+        if len_a > len_b:
+            return n_long, n_short
+        return n_short, n_long
+    # Tokens are removed from the longer sequence, from the second one on ties
+    to_remove = len_a + len_b - budget
+    first_remove = min(abs(len_a - len_b), to_remove)
+    second_remove = to_remove - first_remove
+    if len_a > len_b:
+        return len_a - first_remove - second_remove // 2, len_b - (second_remove - second_remove // 2)
+    return len_a - second_remove // 2, len_b - first_remove - (second_remove - second_remove // 2)
+
+
+class PairEncoder:
+    """
+    Tokenizes (target prefix, section+context) pairs like `tokenizer(pairs, truncation=True, max_length=...)`, but
+    encodes every distinct text only once.
+
+    The token ids of each text are kept in an LRU cache of `cache_size` entries, so a target prefix shared by all
+    sentences of a pair and a context window shared by all targets of a source are tokenized once. Paired inputs are
+    then built by truncating and concatenating the cached ids with the special tokens of the tokenizer.
+    """
+
+    def __init__(self, tokenizer, max_length: int = 512, cache_size: int = None):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.cache_size = cache_size or int(os.environ.get("SCORER_TOKEN_CACHE_SIZE", "20000"))
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.return_token_type_ids = 'token_type_ids' in tokenizer.model_input_names
+        self._learn_template()
+
+    def _learn_template(self):
+        """
+        Find where the tokenizer puts its special tokens around a pair, e.g. [CLS] a [SEP] b [SEP] for BERT or
+        <s> a </s></s> b </s> for XLM-R, from one encoded pair.
+        """
+        ids_a = self.tokenizer("a", add_special_tokens=False)['input_ids']
+        ids_b = self.tokenizer("b", add_special_tokens=False)['input_ids']
+        encoded = self.tokenizer("a", "b", return_token_type_ids=True)
+        ids = encoded['input_ids']
+        types = encoded.get('token_type_ids') or [0] * len(ids)
+        start_a = next(i for i in range(len(ids)) if ids[i:i + len(ids_a)] == ids_a)
+        end_a = start_a + len(ids_a)
+        start_b = next(i for i in range(end_a, len(ids)) if ids[i:i + len(ids_b)] == ids_b)
+        end_b = start_b + len(ids_b)
+        self.template_ids = (ids[:start_a], ids[end_a:start_b], ids[end_b:])
+        self.template_types = (types[:start_a], types[start_a], types[end_a:start_b], types[start_b], types[end_b:])
+        self.budget = self.max_length - (start_a + start_b - end_a + len(ids) - end_b)
+
+    def encode_texts(self, texts: List[str]) -> Dict[str, List[int]]:
+        """
+        Return the token ids without special tokens of every distinct text, tokenizing only those not cached yet.
+        """
+        ids = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            cached = self.cache.get(text)
+            if cached is None:
+                missing.append(text)
+            else:
+                self.cache.move_to_end(text)
+                ids[text] = cached
+        self.hits += len(ids)
+        self.misses += len(missing)
+        if missing:
+            encoded = self.tokenizer(missing, add_special_tokens=False)['input_ids']
+            for text, text_ids in zip(missing, encoded):
+                ids[text] = text_ids
+                self.cache[text] = text_ids
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ids
+
+    def encode_pairs(self, input0: List[str], input1: List[str]) -> Dict[str, List[List[int]]]:
+        ids = self.encode_texts(input0 + input1)
+        pre, mid, post = self.template_ids
+        pre_types, type_a, mid_types, type_b, post_types = self.template_types
+        fast = self.tokenizer.is_fast
+        encoded = {'input_ids': [], 'attention_mask': []}
+        if self.return_token_type_ids:
+            encoded['token_type_ids'] = []
+        for text0, text1 in zip(input0, input1):
+            ids_a, ids_b = ids[text0], ids[text1]
+            len_a, len_b = _truncated_lengths(len(ids_a), len(ids_b), self.budget, fast)
+            input_ids = pre + ids_a[:len_a] + mid + ids_b[:len_b] + post
+            encoded['input_ids'].append(input_ids)
+            encoded['attention_mask'].append([1] * len(input_ids))
+            if self.return_token_type_ids:
+                encoded['token_type_ids'].append(pre_types + [type_a] * len_a + mid_types + [type_b] * len_b
+                                                 + post_types)
+        return encoded
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _log_score_trace(job: Dict[str, Any], scored_df: pd.DataFrame, num_rows: int = 3) -> None:
+    best = scored_df.nlargest(num_rows, 'score')
+    rows = "; ".join(f"#{row.idx} {row.score:.3f} [{row.section}] {row.sentence[:100]!r}"
+                     for row in best.itertuples())
+    logging.info(f"Trace: {job['article_title']} against {job['target_title']}, {len(scored_df)} sentences, "
+                 f"mean score {scored_df['score'].mean():.3f}, best: {rows}")
+
+
 class SentenceScorer:
-    def __init__(self, model_path, mention_map_path):
+    def __init__(self, model_path, mention_map_path, backend=None, intra_op_threads=None, inter_op_threads=None,
+                 export_dir=None, score_cache=None, cascade=None):
+        """
+        The inference backend and thread counts default to SCORER_BACKEND, SCORER_INTRA_OP_THREADS and
+        SCORER_INTER_OP_THREADS, exported graphs are written to SCORER_EXPORT_DIR (default: the model directory).
+        `score_cache` defaults to the SCORE_CACHE_PATH cache, False disables it. MENTION_MAP_LANG restricts the
+        mention map to one language and MENTION_MAP_SEED seeds the order of the mentions. `cascade` defaults to the
+        CASCADE_SCORING prefilter, False disables it.
+        """
+        backend = backend or os.environ.get("SCORER_BACKEND", "eager")
+        intra_op_threads = intra_op_threads or int(os.environ.get("SCORER_INTRA_OP_THREADS", "0"))
+        inter_op_threads = inter_op_threads or int(os.environ.get("SCORER_INTER_OP_THREADS", "0"))
+        export_dir = export_dir or os.environ.get("SCORER_EXPORT_DIR", model_path)
+        configure_threads(intra_op_threads, inter_op_threads)
         logging.info(f"Loading mention map from {mention_map_path}")
-        self.mention_map = load_mention_map(mention_map_path)
+        self.mention_map = load_mention_map(mention_map_path, os.environ.get("MENTION_MAP_LANG") or None,
+                                            int(os.environ.get("MENTION_MAP_SEED", "0")))
         logging.info(f"Loading model from {model_path}")
-        self.model = load_model(model_path)
+        self.model = load_model(model_path, use_cuda=backend == 'eager')
+        logging.info(f"Using the {backend} scoring backend")
+        self.backend = backend
+        self.forward = load_inference_backend(self.model, backend, export_dir, intra_op_threads, inter_op_threads)
+        self.encoder = PairEncoder(self.model['tokenizer'])
+        # Computed once for the score cache keys and the prefix hashes of the stored scores
+        started = time.time()
+        self.model_fingerprint = model_fingerprint(model_path, backend)
+        logging.info(f"Model fingerprint {self.model_fingerprint[:12]} computed in {time.time() - started:.1f}s")
+        self.score_cache = (score_cache if score_cache is not None
+                            else ScoreCache.from_env(model_path, backend, self.model_fingerprint))
+        self.cascade = cascade if cascade is not None else CascadeFilter.from_env()
+        if self.cascade:
+            logging.info(f"Cascade scoring with {self.cascade.config()}")
+        metrics.register_gauge("cache_hit_rate", lambda: self.encoder.hit_rate(), cache="tokenizer")
+        if self.score_cache:
+            metrics.register_gauge("cache_hit_rate", self.score_cache.hit_rate, cache="scores")
+
+    def _score_pairs(self, input0: List[str], input1: List[str], max_batch_tokens: int, max_batch_size: int):
+        """
+        Score (target prefix, section+context) pairs and return the scores in input order.
+
+        Identical pairs are scored once and, with a score cache, only pairs without a cached score reach the model.
+        """
+        scores = np.zeros(len(input0), dtype=np.float32)
+        # Positions of every distinct pair
+        positions = {}
+        for i, pair in enumerate(zip(input0, input1)):
+            positions.setdefault(pair, []).append(i)
+        pairs = list(positions)
+
+        if self.score_cache:
+            keys = {pair: self.score_cache.key(*pair) for pair in pairs}
+            cached = self.score_cache.get_many(list(keys.values()))
+            for pair in pairs:
+                if keys[pair] in cached:
+                    scores[positions[pair]] = cached[keys[pair]]
+            pairs = [pair for pair in pairs if keys[pair] not in cached]
+            logging.info(f"Score cache: {len(cached)} of {len(keys)} pairs cached, "
+                         f"hit rate {self.score_cache.hit_rate():.1%} so far")
+
+        if pairs:
+            pair_scores = self._run_model([prefix for prefix, _ in pairs], [text for _, text in pairs],
+                                          max_batch_tokens, max_batch_size)
+            for pair, score in zip(pairs, pair_scores):
+                scores[positions[pair]] = score
+            if self.score_cache:
+                self.score_cache.put_many((keys[pair], score) for pair, score in zip(pairs, pair_scores))
+        return scores
+
+    def _run_model(self, input0: List[str], input1: List[str], max_batch_tokens: int, max_batch_size: int):
+        """
+        Run the model on (target prefix, section+context) pairs and return the scores in input order.
+
+        Pairs are tokenized without padding, bucketed by token length and padded per batch only.
+        """
+        tokenizer = self.model['tokenizer']
+        with metrics.timer('tokenize', len(input0)):
+            encoded = self.encoder.encode_pairs(input0, input1)
+        lengths = [len(ids) for ids in encoded['input_ids']]
+        scores = np.zeros(len(lengths), dtype=np.float32)
+
+        for batch in tqdm(build_token_budget_batches(lengths, max_batch_tokens, max_batch_size)):
+            # Padding is counted as tokenization, without items so the stage's rate stays pairs per second
+            with metrics.timer('tokenize', 0):
+                features = tokenizer.pad(
+                    {key: [encoded[key][i] for i in batch] for key in encoded.keys()},
+                    return_tensors='pt'
+                )
+            with metrics.timer('forward', len(batch)):
+                scores[batch] = self.forward(features)
+            metrics.count('tokens', sum(lengths[i] for i in batch))
+            metrics.count('padded_tokens', features['input_ids'].numel())
+        return scores
+
+    def _build_prefix(self, target_title: str, target_lead: str) -> str:
+        sep = self.model['tokenizer'].sep_token
+        # Prepend mentions into the target context if available
+        mention_str = self.mention_map.get(target_title, "")
+        return (
+            f"{target_title} {mention_str}{sep}{target_lead}"
+            if mention_str else
+            f"{target_title}{sep}{target_lead}"
+        )
+
+    def prefix_hash(self, target_title: str, target_lead: str) -> str:
+        """
+        Hash of the target side of the model input and of the model fingerprint, which covers the backend, scores of
+        the same sentence window are interchangeable between pairs with the same prefix hash.
+        """
+        prefix = f"{self.model_fingerprint}\x1f{self._build_prefix(target_title, target_lead)}"
+        if self.cascade:
+            prefix = f"{prefix}\x1fcascade:{self.cascade.config()}"
+        return hashlib.md5(prefix.encode('utf-8')).hexdigest()
+
+    def _prepare_sections(self, sections: List[Dict[str, Any]], context_size: int):
+        """
+        Return the rows of all sentences of the sections, with their context and section title, and the
+        section+context model input of every row.
+        """
+        sep = self.model['tokenizer'].sep_token
+        started = time.perf_counter()
+        # make all the sentences into a single data fram withouth section separator, the sentences of
+        # the caller are left untouched since they may still be queued for writing
+        sentences = []
+        for section in sections:
+            section_title = section.get('title', '')
+            contexts = build_context_windows(section['sentences'], context_size)
+            for sentence, context in zip(section['sentences'], contexts):
+                sentences.append({**sentence, 'context': context, 'section': section_title})
+        metrics.observe('context', time.perf_counter() - started, len(sentences))
+        # The model inputs of the sentences are the same for every target
+        inputs = [f"{sentence['section']}{sep}{sentence['context']}" for sentence in sentences]
+        return sentences, inputs
+
+    def window_inputs(self, sections: List[Dict[str, Any]], context_size: int = 5) -> Dict[int, str]:
+        """
+        Return the section+context model input of every sentence of the sections, keyed by sentence idx.
+        """
+        sentences, inputs = self._prepare_sections(sections, context_size)
+        return {sentence['idx']: text for sentence, text in zip(sentences, inputs)}
 
     def get_sentence_scores(
             self,
@@ -102,60 +465,89 @@ class SentenceScorer:
             target_title: str,
             target_lead: str,
             context_size: int = 5,
-            batch_size: int = 8
+            batch_size: int = 64,
+            max_batch_tokens: int = 16384
     ):
-        logging.info(f"Scoring {article_title} with context size {context_size}")
+        job = {
+            'sections': sections,
+            'article_title': article_title,
+            'target_title': target_title,
+            'target_lead': target_lead,
+        }
+        return self.get_sentence_scores_batch([job], context_size, batch_size, max_batch_tokens)[0]
 
-        for section in sections:
-            set_context_for_sentences(section, context_size)
-        # make all the sentences into a single data fram withouth section separator
-        sentences = []
-        for section in sections:
-            section_title = section.get('title', '')
-            for sentence in section['sentences']:
-                sentence['section'] = section_title
-                sentences.append(sentence)
-
-        scored_df = pd.DataFrame(sentences)
-        scored_df['score'] = 0.0
-        sep = self.model['tokenizer'].sep_token
+    def get_sentence_scores_batch(
+            self,
+            jobs: List[Dict[str, Any]],
+            context_size: int = 5,
+            batch_size: int = 64,
+            max_batch_tokens: int = 16384
+    ) -> List[pd.DataFrame]:
+        """
+        Score many (source sections, target title, target lead) jobs in a single inference stream.
 
+        Each job is a dict with the keys 'sections', 'article_title', 'target_title' and 'target_lead'.
+        The sentences of all jobs share the same batches, and one scored DataFrame is returned per job,
+        in the order of `jobs`. A job may also have 'known_scores', scores of section+context inputs against
+        the same target prefix, e.g. from an earlier revision of the article; only its other sentences are scored.
+        In cascade mode, only the sentences picked by the lexical prefilter are scored and the others get its floor
+        score.
+        """
+        frames = []
+        input0 = []
+        input1 = []
+        # Sources scored against several targets share their sections, build their rows only once
+        prepared_sections = {}
+        prepared_cascade = {}
+        for job in jobs:
+            logging.info(f"Scoring {job['article_title']} against {job['target_title']} "
+                         f"with context size {context_size}")
+            sections = job['sections']
+            if id(sections) not in prepared_sections:
+                prepared_sections[id(sections)] = self._prepare_sections(sections, context_size)
+            sentences, inputs = prepared_sections[id(sections)]
 
-        # Score sentences in batches
-        with torch.no_grad():
-            for i in tqdm(range(0, len(scored_df), batch_size)):
-                batch_df = scored_df.iloc[i:i + batch_size]
-                logging.info(f"Batch copied, now getting context for sentences")
+            scored_df = pd.DataFrame(sentences, columns=['idx', 'start', 'end', 'sentence', 'context', 'section'])
+            prefix = self._build_prefix(job['target_title'], job['target_lead'])
+            known = job.get('known_scores') or {}
+            reused = [known.get(text) for text in inputs]
+            missing = [i for i, score in enumerate(reused) if score is None]
+            if known:
+                logging.info(f"Reusing {len(inputs) - len(missing)} of {len(inputs)} sentence scores "
+                             f"of an earlier revision")
+                metrics.count('sentences_reused', len(inputs) - len(missing))
+            pruned = []
+            if self.cascade:
+                if id(sections) not in prepared_cascade:
+                    prepared_cascade[id(sections)] = self.cascade.prepare(
+                        sentences, [len(section['sentences']) for section in sections])
+                selected = self.cascade.select(prepared_cascade[id(sections)], job['target_title'], job['target_lead'],
+                                               self.mention_map.get(job['target_title'], ""))
+                pruned = [i for i in missing if not selected[i]]
+                missing = [i for i in missing if selected[i]]
+                metrics.count('sentences_pruned', len(pruned))
+            input0.extend([prefix] * len(missing))
+            input1.extend(inputs[i] for i in missing)
+            frames.append((scored_df, reused, missing, pruned))
 
-                # Prepend mentions into the target context if available
-                mention_str = self.mention_map.get(target_title, "")
-                prefix = (
-                    f"{target_title} {mention_str}{sep}{target_lead}"
-                    if mention_str else
-                    f"{target_title}{sep}{target_lead}"
-                )
+        # Score sentences of all jobs in length-bucketed batches, the scores come back in input order
+        scores = self._score_pairs(input0, input1, max_batch_tokens, batch_size) if input1 else []
 
-                input0 = [prefix] * len(batch_df)
-                input1 = [f"{row['section']}{sep}{row['context']}" for _, row in batch_df.iterrows()]
-
-                input_tokens = self.model['tokenizer'](
-                    list(zip(input0, input1)),
-                    return_tensors='pt', padding='max_length',
-                    truncation=True, max_length=512
-                ).to('cpu')
-
-                embeddings = self.model['model'](**input_tokens)['last_hidden_state'][:, 0, :]
-                prediction = self.model['classification_head'](embeddings).squeeze().detach().cpu().numpy()
-
-                # Handle case where prediction is a single value
-                if len(batch_df) == 1:
-                    prediction = [float(prediction)]
-                # Store predictions in the DataFrame
-                scored_df.iloc[i:i + batch_size, scored_df.columns.get_loc('score')] = prediction
-        # drop the sentences and the context
-        logging.info("Final scored rows with context and sentence columns retained:")
-        for idx, row in scored_df.iterrows():
-            logging.info(row.to_dict())
-        scored_df = scored_df.drop(columns=['context'])
-        scored_df = scored_df.drop(columns=['sentence'])
-        return scored_df
+        results = []
+        offset = 0
+        for job, (scored_df, reused, missing, pruned) in zip(jobs, frames):
+            job_scores = np.array([np.nan if score is None else score for score in reused], dtype=np.float32)
+            job_scores[missing] = scores[offset:offset + len(missing)]
+            if pruned:
+                job_scores[pruned] = self.cascade.floor(job_scores[~np.isnan(job_scores)])
+            scored_df['score'] = job_scores
+            offset += len(missing)
+            metrics.count('sentences_scored', len(scored_df))
+            # Log the best rows of a sample of the jobs instead of every row
+            if trace_sampled():
+                _log_score_trace(job, scored_df)
+            # drop the sentences and the context
+            scored_df = scored_df.drop(columns=['context'])
+            scored_df = scored_df.drop(columns=['sentence'])
+            results.append(scored_df)
+        return results
@@ -0,0 +1,20 @@
+from cascade_scoring import CascadeFilter
+
+SENTENCES = ["Salmon swim up the river, salmon after salmon.", "Salmon are fish.", "The cat sat down.",
+             "The river bank.", "A river."]
+
+
+def select(cascade, section_sizes):
+    prepared = cascade.prepare([{"sentence": sentence, "context": ""} for sentence in SENTENCES], section_sizes)
+    return cascade.select(prepared, "Salmon", "Salmon live in the river.").tolist()
+
+
+def test_threshold_is_relative_to_the_best_sentence_of_each_section():
+    # The river sentences score far below the salmon sentences of the first section but are the best of their own
+    assert select(CascadeFilter(top_k=0, threshold=0.5), [3, 2]) == [True, True, False, True, True]
+    assert select(CascadeFilter(top_k=0, threshold=0.5), [5]) == [True, True, False, False, False]
+
+
+def test_top_k_per_section_and_the_best_sentence():
+    assert select(CascadeFilter(top_k=1), [3, 2]) == [True, False, False, True, False]
+    assert select(CascadeFilter(top_k=0), [3, 2]) == [True, False, False, False, False]
@@ -0,0 +1,133 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import wiki_sentence_utils
+from wiki_fetch import WikiFetcher
+from wiki_sentence_utils import fetch_article_html
+
+# Status codes the stub answers with before it serves a title, per title
+FAILURES = {
+    "Flaky": [429, 503, 503],
+    "Down": [503] * 10,
+}
+
+
+class StubWiki(ThreadingHTTPServer):
+    """
+    Local stand-in for the wiki: serves /w/index.php after the failures planned for the title, recording when every
+    request arrived and how many were handled at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.delay = delay
+        self.requests = {}
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        title = parse_qs(urlparse(self.path).query)["title"][0]
+        with server.lock:
+            arrivals = server.requests.setdefault(title, [])
+            arrivals.append(time.monotonic())
+            attempt = len(arrivals) - 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            failures = FAILURES.get(title, [])
+            if attempt < len(failures):
+                self.send_response(failures[attempt])
+                if failures[attempt] == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = f"<html><body><p>{title}</p></body></html>".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def stub_wiki(monkeypatch):
+    servers = []
+
+    def start(delay=0.0):
+        server = StubWiki(delay)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        # WIKI_URL_TEMPLATE is read when the module is imported
+        monkeypatch.setattr(wiki_sentence_utils, "WIKI_URL_TEMPLATE", server.url)
+        return server
+
+    monkeypatch.delenv("WIKI_CACHE_DIR", raising=False)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_retries_with_backoff_until_the_stub_succeeds(stub_wiki):
+    server = stub_wiki()
+    fetcher = WikiFetcher(concurrency=1, retries=3, backoff=0.1, timeout=5)
+    assert "Flaky" in fetch_article_html("en", "Flaky", 1, fetcher)
+    arrivals = server.requests["Flaky"]
+    assert len(arrivals) == len(FAILURES["Flaky"]) + 1
+    # No backoff after the first failure, then backoff * 2 ** (failures - 1)
+    gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    assert gaps[1] >= 0.2 * 0.9
+    assert gaps[2] >= 0.4 * 0.9
+    fetcher.close()
+
+
+def test_fetch_gives_up_after_the_retries(stub_wiki):
+    server = stub_wiki()
+    fetcher = WikiFetcher(concurrency=1, retries=2, backoff=0.0, timeout=5)
+    with pytest.raises(requests.RequestException):
+        fetch_article_html("en", "Down", 1, fetcher)
+    assert len(server.requests["Down"]) == 3
+    fetcher.close()
+
+
+def test_fetch_concurrency_is_bounded(stub_wiki):
+    server = stub_wiki(delay=0.1)
+    fetcher = WikiFetcher(concurrency=3, retries=0, timeout=5)
+    titles = [f"Article {i}" for i in range(12)]
+    results = list(fetcher.imap_unordered(lambda title: fetch_article_html("en", title, 1, fetcher), titles))
+    assert sorted(title for title, _, _ in results) == sorted(titles)
+    assert [error for _, _, error in results if error] == []
+    assert server.max_active == 3
+    fetcher.close()
+
+
+def test_fetch_rate_limit_spaces_requests(stub_wiki):
+    server = stub_wiki()
+    fetcher = WikiFetcher(concurrency=4, requests_per_second=20, retries=0, timeout=5)
+    titles = [f"Article {i}" for i in range(8)]
+    list(fetcher.imap_unordered(lambda title: fetch_article_html("en", title, 1, fetcher), titles))
+    arrivals = sorted(arrival for title in titles for arrival in server.requests[title])
+    assert arrivals[-1] - arrivals[0] >= (len(titles) - 1) / 20 * 0.9
+    fetcher.close()
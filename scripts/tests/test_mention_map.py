@@ -0,0 +1,71 @@
+import random
+from collections import Counter
+
+import pandas as pd
+
+from sentence_score import MAX_MENTIONS, load_mention_map
+
+
+def reference_load_mention_map(mention_df):
+    """
+    The row by row loop load_mention_map replaced, returning the mention lists instead of joining them. It
+    deduplicated through a set, so the mentions of equal length kept for titles with many mentions, and the order,
+    depended on the set order.
+    """
+    mention_map = {}
+    for _, row in mention_df.iterrows():
+        mention_map.setdefault(row.get('target_title'), []).append(row.get('mention', '').lower())
+    for title, mentions in mention_map.items():
+        mentions = list(set(mentions))
+        if len(mentions) > 10:
+            mentions.sort(key=len)
+            while len(mentions) > 10 and len(mentions[0]) < 3:
+                mentions.pop(0)
+            mentions = mentions[:10]
+            random.shuffle(mentions)
+        mention_map[title] = mentions
+    return mention_map
+
+
+def random_mention_df(seed, num_titles=60):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_titles):
+        # Few mentions, exactly the limit, or many with short and repeated ones
+        count = rng.choice([1, 3, MAX_MENTIONS, MAX_MENTIONS + 1, 15, 40])
+        for _ in range(count):
+            mention = "".join(rng.choice("abcD") for _ in range(rng.randint(1, 6)))
+            rows.append((f"Title {i}", mention))
+    rows.sort(key=lambda row: rng.random())
+    return pd.DataFrame(rows, columns=["target_title", "mention"])
+
+
+def test_load_mention_map_keeps_the_mentions_of_the_row_loop(tmp_path):
+    for seed in range(5):
+        mention_df = random_mention_df(seed)
+        path = str(tmp_path / f"mentions_{seed}.parquet")
+        mention_df.to_parquet(path)
+        mention_map = load_mention_map(path)
+        reference = reference_load_mention_map(mention_df)
+        assert set(mention_map) == set(reference)
+        for title, mentions in reference.items():
+            loaded = mention_map[title].split(" ")
+            deduplicated = set(mention_df.loc[mention_df["target_title"] == title, "mention"].str.lower())
+            assert len(loaded) == len(set(loaded))
+            assert set(loaded) <= deduplicated
+            assert Counter(map(len, loaded)) == Counter(map(len, mentions))
+            if len(deduplicated) <= MAX_MENTIONS:
+                assert set(loaded) == set(mentions)
+
+
+def test_load_mention_map_order_is_seeded(tmp_path):
+    mention_df = random_mention_df(0)
+    path = str(tmp_path / "mentions.parquet")
+    mention_df.to_parquet(path)
+    assert load_mention_map(path, seed=7) == load_mention_map(path, seed=7)
+    many = [title for title, mentions in reference_load_mention_map(mention_df).items()
+            if len(set(mention_df.loc[mention_df["target_title"] == title, "mention"].str.lower())) > MAX_MENTIONS]
+    assert many
+    orders = [load_mention_map(path, seed=seed) for seed in (7, 8)]
+    assert any(orders[0][title] != orders[1][title] for title in many)
+    assert all(sorted(orders[0][title].split(" ")) == sorted(orders[1][title].split(" ")) for title in many)
@@ -0,0 +1,109 @@
+import os
+import shutil
+
+import score_cache
+from score_cache import CONTENT_HASHES_FILE, model_fingerprint
+
+
+def write(path, content=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def make_model(model_dir):
+    write(os.path.join(model_dir, "model", "config.json"), b'{"hidden_size": 8}')
+    write(os.path.join(model_dir, "model", "pytorch_model.bin"), b"bin weights")
+    write(os.path.join(model_dir, "tokenizer", "vocab.txt"), b"[PAD]\n[UNK]\n")
+    write(os.path.join(model_dir, "classification_head.pth"), b"pth head")
+
+
+def test_model_fingerprint_follows_the_loaded_files(tmp_path):
+    model_dir = str(tmp_path)
+    make_model(model_dir)
+    fingerprint = model_fingerprint(model_dir)
+    assert model_fingerprint(model_dir, "onnx-int8") != fingerprint
+
+    # ONNX exports and their external data are not loaded
+    write(os.path.join(model_dir, "scorer.onnx"))
+    write(os.path.join(model_dir, "scorer.onnx.data"))
+    assert model_fingerprint(model_dir) == fingerprint
+
+    write(os.path.join(model_dir, "model", "config.json"), b'{"hidden_size": 16}')
+    assert model_fingerprint(model_dir) != fingerprint
+
+
+def test_model_fingerprint_prefers_safetensors_like_the_loaders(tmp_path):
+    model_dir = str(tmp_path)
+    make_model(model_dir)
+    # The layout convert_to_safetensors leaves: the safetensors files are loaded, the originals are not
+    write(os.path.join(model_dir, "model", "model.safetensors"), b"converted weights")
+    write(os.path.join(model_dir, "classification_head.safetensors"), b"converted head")
+    converted = model_fingerprint(model_dir)
+
+    write(os.path.join(model_dir, "model", "pytorch_model.bin"), b"stale weights")
+    write(os.path.join(model_dir, "classification_head.pth"), b"stale head")
+    assert model_fingerprint(model_dir) == converted
+
+    write(os.path.join(model_dir, "model", "model.safetensors"), b"retrained weights")
+    retrained = model_fingerprint(model_dir)
+    assert retrained != converted
+    write(os.path.join(model_dir, "classification_head.safetensors"), b"replaced head")
+    assert model_fingerprint(model_dir) != retrained
+
+
+def test_model_fingerprint_hashes_content_once(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / "model_a")
+    make_model(model_dir)
+    weights = os.path.join(model_dir, "model", "pytorch_model.bin")
+    fingerprint = model_fingerprint(model_dir)
+    assert os.path.exists(os.path.join(model_dir, CONTENT_HASHES_FILE))
+
+    # A copy has other modification times but the same content
+    copy_dir = str(tmp_path / "model_b")
+    shutil.copytree(model_dir, copy_dir)
+    os.remove(os.path.join(copy_dir, CONTENT_HASHES_FILE))
+    assert model_fingerprint(copy_dir) == fingerprint
+
+    # Files last modified well before they were hashed are not read again
+    old = os.stat(weights).st_mtime_ns - 60 * 1_000_000_000
+    for path in score_cache.model_files(model_dir):
+        os.utime(path, ns=(old, old))
+    model_fingerprint(model_dir)
+    hashed = []
+    original_hash = score_cache._file_hash
+    monkeypatch.setattr(score_cache, "_file_hash", lambda path: hashed.append(path) or original_hash(path))
+    assert model_fingerprint(model_dir) == fingerprint
+    assert hashed == []
+
+    # A file hashed right after it was written is hashed again, an overwrite within the same timestamp tick keeps
+    # its size and modification time
+    write(weights, b"bin weights")
+    written = os.stat(weights).st_mtime_ns
+    assert model_fingerprint(model_dir) == fingerprint
+    write(weights, b"BIN WEIGHTS")
+    os.utime(weights, ns=(written, written))
+    assert model_fingerprint(model_dir) != fingerprint
+
+
+def test_model_fingerprint_uses_the_version_file(tmp_path):
+    model_dir = str(tmp_path)
+    make_model(model_dir)
+    write(os.path.join(model_dir, "VERSION"), b"2024-05-01")
+    versioned = model_fingerprint(model_dir)
+    write(os.path.join(model_dir, "model", "pytorch_model.bin"), b"newer weights")
+    assert model_fingerprint(model_dir) == versioned
+
+
+def test_scorers_on_model_copies_share_prefix_hashes(tmp_path, monkeypatch):
+    from benchmark import build_tiny_model, synthetic_article_html
+    from sentence_score import SentenceScorer
+
+    model_dir = build_tiny_model(str(tmp_path / "host_a"), [synthetic_article_html("Salmon", num_sections=2)])
+    copy_dir = str(tmp_path / "host_b")
+    shutil.copytree(model_dir, copy_dir)
+    monkeypatch.setenv("SCORE_CACHE_PATH", str(tmp_path / "scores.sqlite"))
+    mention_map = str(tmp_path / "no_mention_map.parquet")
+    scorers = [SentenceScorer(path, mention_map, cascade=False) for path in (model_dir, copy_dir)]
+    assert scorers[0].prefix_hash("Fish", "Fish lead") == scorers[1].prefix_hash("Fish", "Fish lead")
+    assert scorers[0].score_cache.fingerprint == scorers[0].model_fingerprint.encode()
@@ -0,0 +1,67 @@
+import os
+import random
+
+import pytest
+from lxml import html
+
+from conftest import FIXTURES_DIR
+from wiki_sentence_utils import build_sections, extract_section_texts, group_sections, xpath_condition, xpath_section
+
+HTML_FIXTURES = sorted(name for name in os.listdir(os.path.join(FIXTURES_DIR, "html")) if name.endswith(".html"))
+
+# Tags and attributes that switch the exclusion rules of xpath_condition and xpath_section on and off
+RANDOM_TAGS = ['div', 'p', 'span', 'h2', 'h3', 'table', 'sup', 'cite', 'style', 'figure', 'noscript', 'section', 'i']
+RANDOM_ATTRIBUTES = [
+    {}, {}, {}, {'class': 'thumb tright'}, {'class': 'mw-headline'}, {'class': 'mw-editsection'},
+    {'class': 'navbox'}, {'class': 'reflist'}, {'class': 'infobox'}, {'role': 'note'}, {'role': 'navigation'},
+    {'style': 'float:right'}, {'style': 'display:none'}, {'class': 'mw-heading mw-heading2'},
+]
+
+
+def reference_sections(tree):
+    return build_sections(tree.xpath(xpath_condition), xpath_section)
+
+
+def walker_sections(tree):
+    return group_sections(extract_section_texts(tree))
+
+
+def random_tree(rng, depth=4):
+    def element(level):
+        node = html.Element(rng.choice(RANDOM_TAGS), rng.choice(RANDOM_ATTRIBUTES))
+        node.text = rng.choice(['', ' ', f'text {rng.randrange(100)} ', 'Heading'])
+        if level < depth:
+            for _ in range(rng.randrange(4)):
+                child = element(level + 1)
+                child.tail = rng.choice(['', '\n', f' tail {rng.randrange(100)}'])
+                node.append(child)
+        return node
+
+    body = html.fromstring('<html><body><div id="mw-content-text"></div></body></html>')
+    content = body.find('.//div')
+    content.text = rng.choice(['', 'lead text '])
+    for _ in range(rng.randrange(1, 6)):
+        child = element(1)
+        child.tail = rng.choice(['', f' root tail {rng.randrange(100)}'])
+        content.append(child)
+    return body
+
+
+@pytest.mark.parametrize("name", HTML_FIXTURES)
+def test_walker_matches_xpath_reference_on_fixtures(name):
+    with open(os.path.join(FIXTURES_DIR, "html", name), encoding="utf-8") as f:
+        tree = html.fromstring(f.read())
+
+    expected = reference_sections(tree)
+    actual = walker_sections(tree)
+
+    assert len(expected) > 1
+    assert actual.to_dict('records') == expected.to_dict('records')
+
+
+def test_walker_matches_xpath_reference_on_random_trees():
+    rng = random.Random(0)
+    for _ in range(300):
+        tree = random_tree(rng)
+        expected = reference_sections(tree).to_dict('records')
+        assert walker_sections(tree).to_dict('records') == expected, html.tostring(tree, encoding='unicode')
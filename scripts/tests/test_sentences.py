@@ -0,0 +1,71 @@
+import json
+import os
+import random
+
+import pandas as pd
+import pytest
+
+from conftest import FIXTURES_DIR
+from wiki_sentence_utils import get_sentences, normalize_html_text
+
+SENTENCE_FIXTURES = sorted(name for name in os.listdir(os.path.join(FIXTURES_DIR, "sentences"))
+                           if name.endswith(".json"))
+
+
+def reference_normalize_html_text(text):
+    """
+    The line by line normalization normalize_html_text replaced.
+    """
+    text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    lines = [line.strip() for line in lines]
+    text = ' '.join(lines)
+    text = text.replace('\t', ' ')
+    while '  ' in text:
+        text = text.replace('  ', ' ')
+    return text.strip()
+
+
+@pytest.mark.parametrize("name", SENTENCE_FIXTURES)
+def test_get_sentences_matches_expected_offsets(name):
+    """
+    The expected sentences were segmented section by section with a tokenizer per call, the fixtures cover Latin,
+    CJK, Arabic and Devanagari scripts.
+    """
+    with open(os.path.join(FIXTURES_DIR, "sentences", name), encoding="utf-8") as f:
+        fixture = json.load(f)
+    sections_df = pd.DataFrame(fixture["sections"], columns=["title", "text"])
+    assert get_sentences(sections_df, fixture["lang"]) == fixture["expected"]
+
+
+def test_sentence_fixtures_cover_languages():
+    assert {os.path.splitext(name)[0] for name in SENTENCE_FIXTURES} >= {"en", "de", "fr", "ja", "zh", "ar", "hi"}
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    " \t\n\r\n ",
+    "Line one\r\nLine two",
+    "Line one \r\n\r\n  Line two\r",
+    "a\rb",
+    "tab\tseparated\t\tcolumns",
+    " \t mixed \t\t runs \t ",
+    "no\xa0break\xa0space",
+    "\xa0leading and trailing\xa0",
+    "before\xa0\nafter\xa0\n\xa0next",
+    "ideographic　space　\n　line",
+    "em space   and thin space",
+    "line separator and next\u0085line",
+    "vertical\x0btab\x0c\nform feed",
+])
+def test_normalize_html_text_matches_line_loop(text):
+    assert normalize_html_text(text) == reference_normalize_html_text(text)
+
+
+def test_normalize_html_text_matches_line_loop_on_random_whitespace():
+    rng = random.Random(0)
+    alphabet = [" ", "  ", "\t", "\n", "\r", "\r\n", "\xa0", " ", "　", "\x0b", "\x0c", "\x1c", "\u0085",
+                " ", "a", "b", "."]
+    for _ in range(20000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+        assert normalize_html_text(text) == reference_normalize_html_text(text), repr(text)
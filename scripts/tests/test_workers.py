@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import wiki_mongo_db
+import wikinsert_main
+from benchmark import build_tiny_model, synthetic_article_html
+from wiki_ledger import PAIR, SOURCE, STORED
+
+SOURCES = ["Salmon", "Trout", "Carp", "Pike"]
+TARGETS = ["Fish", "River", "Lake"]
+
+
+def fake_metadata(lang, title, fetcher=None):
+    return {"thumbnail": {}, "description": f"Description of {title}"}
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    texts = [synthetic_article_html(title, num_sections=3, paragraphs=2) for title in SOURCES]
+    return build_tiny_model(str(tmp_path_factory.mktemp("model")), texts)
+
+
+@pytest.fixture
+def pipeline_env(tmp_path, model_dir, monkeypatch):
+    """
+    Input files, a tiny model, a shared in-memory database and fetch functions that serve synthetic articles.
+    """
+    source_path = tmp_path / "sources_en.parquet"
+    pairs_path = tmp_path / "pairs.parquet"
+    pd.DataFrame({"source_title": SOURCES, "first_version": range(len(SOURCES))}).to_parquet(source_path)
+    pd.DataFrame(
+        [(title, revid, target, f"{target} lead") for revid, title in enumerate(SOURCES) for target in TARGETS],
+        columns=["source_title", "first_version", "target_title", "target_lead"],
+    ).to_parquet(pairs_path)
+    for name in ("SCORE_CACHE_PATH", "WIKI_CACHE_DIR", "WIKI_OFFLINE", "METRICS_PATH", "CASCADE_SCORING",
+                 "INCREMENTAL_SCORING", "WORK_LEDGER"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("SOURCE_ARTICLES_PATH", str(source_path))
+    monkeypatch.setenv("SCORED_DATA_PATH", str(pairs_path))
+    monkeypatch.setenv("MODEL_DIR", model_dir)
+    monkeypatch.setenv("MENTION_MAP_PATH", str(tmp_path / "no_mention_map.parquet"))
+    monkeypatch.setenv("WORKER_POLL_SECONDS", "0.2")
+    monkeypatch.setenv("PAIRS_PER_CHUNK", "2")
+    monkeypatch.setenv("TRACE_SAMPLE_RATE", "0")
+
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(wiki_mongo_db, "MongoClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr(wikinsert_main, "fetch_article_html",
+                        lambda lang, title, revid, fetcher=None: synthetic_article_html(title, num_sections=3,
+                                                                                        paragraphs=2))
+    monkeypatch.setattr(wikinsert_main, "fetch_article_metadata", fake_metadata)
+    monkeypatch.setattr(wikinsert_main, "fetch_articles_metadata",
+                        lambda lang, titles, fetcher=None: {title: fake_metadata(lang, title) for title in titles})
+    return {"ledger": f"sqlite:{tmp_path / 'ledger.db'}", "db": client["wikinsert"]}
+
+
+def run_in_thread(target, *args):
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, errors
+
+
+def test_coordinator_and_two_workers_store_every_pair(pipeline_env):
+    """
+    A coordinator and two workers share a SQLite ledger and one database. The workers run as threads because the
+    in-memory database lives in this process; each has its own pipeline, ledger connection, owner and scorer.
+    """
+    def open_pipeline(load_model):
+        return wikinsert_main.WikiPipeline(ledger_spec=pipeline_env["ledger"], lease_seconds=5, bulk_writes=True,
+                                           load_model=load_model)
+
+    coordinator = open_pipeline(load_model=False)
+    # Seed before the workers start, otherwise they could find an empty ledger and exit
+    coordinator.seed_ledger(testing=False)
+    workers = [open_pipeline(load_model=True) for _ in range(2)]
+    assert len({worker.ledger.owner for worker in workers}) == 2
+
+    threads = [run_in_thread(coordinator.coordinate, False, 0.2)]
+    threads += [run_in_thread(worker.run_worker) for worker in workers]
+    deadline = time.monotonic() + 300
+    for thread, _ in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    for pipeline in [coordinator] + workers:
+        pipeline.close()
+
+    assert not any(thread.is_alive() for thread, _ in threads)
+    assert [error for _, errors in threads for error in errors] == []
+    num_pairs = len(SOURCES) * len(TARGETS)
+    assert coordinator.ledger.counts(SOURCE)[STORED] == len(SOURCES)
+    assert coordinator.ledger.counts(PAIR) == {"pending": 0, "fetched": 0, "parsed": 0, "scored": 0,
+                                               STORED: num_pairs, "failed": 0}
+    db = pipeline_env["db"]
+    assert db.article_scores.count_documents({}) == num_pairs
+    assert sorted(sorted(article["targets"]) for article in db.articles.find()) == [sorted(TARGETS)] * len(SOURCES)
@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+
+class CacheMiss(LookupError):
+    """
+    Raised in offline mode when a requested resource is not in the cache.
+    """
+
+
+class WikiCache:
+    """
+    Persistent on-disk cache for Wikipedia responses.
+
+    Entries are addressed by a hash of their namespace and key, e.g. ('html', lang, title, revid), gzip-compressed
+    and sharded into two levels of sub-directories. The modification time of an entry is bumped on every read, and
+    once the cache grows past `max_bytes` the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 1024 ** 3, offline: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["WikiCache"]:
+        """
+        Build the cache from WIKI_CACHE_DIR, WIKI_CACHE_MAX_BYTES and WIKI_OFFLINE, or return None when
+        WIKI_CACHE_DIR is not set.
+        """
+        cache_dir = os.environ.get("WIKI_CACHE_DIR")
+        offline = os.environ.get("WIKI_OFFLINE", "").lower() in ("1", "true", "yes")
+        if not cache_dir:
+            if offline:
+                raise ValueError("WIKI_OFFLINE requires WIKI_CACHE_DIR to be set")
+            return None
+        max_bytes = int(os.environ.get("WIKI_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+        return cls(cache_dir, max_bytes, offline)
+
+    def _path(self, namespace: str, *key: Any) -> str:
+        digest = hashlib.sha256("\x1f".join([namespace, *map(str, key)]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, namespace, digest[:2], digest[2:4], f"{digest}.gz")
+
+    def get(self, namespace: str, *key: Any) -> Optional[bytes]:
+        path = self._path(namespace, *key)
+        try:
+            with open(path, 'rb') as f:
+                data = gzip.decompress(f.read())
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+        # Mark the entry as recently used, eviction removes the oldest modification times first
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, namespace: str, *key: Any, data: bytes) -> None:
+        if self.offline:
+            return
+        path = self._path(namespace, *key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = gzip.compress(data)
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(compressed)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_text(self, namespace: str, *key: Any) -> Optional[str]:
+        data = self.get(namespace, *key)
+        return data.decode('utf-8') if data is not None else None
+
+    def put_text(self, namespace: str, *key: Any, text: str) -> None:
+        self.put(namespace, *key, data=text.encode('utf-8'))
+
+    def get_json(self, namespace: str, *key: Any) -> Any:
+        data = self.get(namespace, *key)
+        return json.loads(data) if data is not None else None
+
+    def put_json(self, namespace: str, *key: Any, value: Any) -> None:
+        self.put(namespace, *key, data=json.dumps(value).encode('utf-8'))
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.gz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is back under 90% of its size cap.
+        """
+        started = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for path, entry_size, _ in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        self._size = size
+        logging.info(f"Evicted {removed} cache entries in {time.time() - started:.2f}s, cache size is now {size} bytes")
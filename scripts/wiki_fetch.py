@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wiki_cache import CacheMiss, WikiCache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+USER_AGENT = "wikinsert-data-pipeline (https://github.com/au-clan/wikinsert)"
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces requests at least 1 / requests_per_second seconds apart.
+    """
+
+    def __init__(self, requests_per_second: float = 0.0):
+        self.interval = 1.0 / requests_per_second if requests_per_second and requests_per_second > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class WikiFetcher:
+    """
+    Shared HTTP layer for Wikipedia requests: one pooled session with retries and backoff, a global rate limit
+    and a bounded worker pool for concurrent fetches.
+
+    Settings default to the FETCH_CONCURRENCY, FETCH_RATE_LIMIT, FETCH_RETRIES, FETCH_BACKOFF and FETCH_TIMEOUT
+    environment variables. `cache` defaults to the WIKI_CACHE_DIR cache; in offline mode no request is sent and
+    everything must come from the cache.
+    """
+
+    def __init__(self, concurrency: int = None, requests_per_second: float = None, retries: int = None,
+                 backoff: float = None, timeout: float = None, cache: Optional[WikiCache] = None):
+        self.concurrency = concurrency or int(os.environ.get("FETCH_CONCURRENCY", "8"))
+        requests_per_second = (requests_per_second if requests_per_second is not None
+                               else float(os.environ.get("FETCH_RATE_LIMIT", "0")))
+        retries = retries if retries is not None else int(os.environ.get("FETCH_RETRIES", "3"))
+        backoff = backoff if backoff is not None else float(os.environ.get("FETCH_BACKOFF", "0.5"))
+        self.timeout = timeout or float(os.environ.get("FETCH_TIMEOUT", "30"))
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.cache = cache if cache is not None else WikiCache.from_env()
+
+    @property
+    def offline(self) -> bool:
+        return bool(self.cache and self.cache.offline)
+
+    def get(self, url: str) -> requests.Response:
+        if self.offline:
+            raise CacheMiss(f"{url} is not cached and the fetcher is offline")
+        self.rate_limiter.wait()
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def get_text(self, url: str) -> str:
+        return self.get(url).text
+
+    def get_json(self, url: str) -> Any:
+        return self.get(url).json()
+
+    def imap_unordered(self, fn: Callable[[Any], Any], items: Iterable[Any]) \
+            -> Iterator[Tuple[Any, Any, Optional[BaseException]]]:
+        """
+        Run `fn` over `items` on the worker pool and yield (item, result, error) as calls complete.
+
+        At most twice the concurrency limit is in flight, so `items` can be a long lazy iterable and the caller
+        can process results (e.g. parse HTML) while the remaining requests are still running.
+        """
+        items = iter(items)
+        max_in_flight = self.concurrency * 2
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="wiki-fetch") as executor:
+            in_flight = {}
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    item = next(items, StopIteration)
+                    if item is StopIteration:
+                        exhausted = True
+                        break
+                    in_flight[executor.submit(fn, item)] = item
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    error = future.exception()
+                    yield item, None if error else future.result(), error
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher() -> WikiFetcher:
+    """
+    Return the process-wide WikiFetcher, created on first use.
+    """
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = WikiFetcher()
+        return _default_fetcher
@@ -0,0 +1,71 @@
+import hashlib
+import logging
+import os
+from typing import Iterator, List, Tuple
+
+import pyarrow.parquet as pq
+
+from wiki_sentence_utils import fix_title
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+SOURCE_COLUMNS = ['source_title', 'first_version']
+PAIR_COLUMNS = ['source_title', 'first_version', 'target_title', 'target_lead']
+
+
+def input_batch_size() -> int:
+    # Rows per record batch read from an input file, and pairs per planning window of the pipeline
+    return int(os.environ.get("INPUT_BATCH_SIZE", "10000"))
+
+
+def iter_parquet_rows(path: str, columns: List[str], batch_size: int = None) -> Iterator[Tuple]:
+    """
+    Yield the rows of `columns` of a parquet file as tuples, reading one record batch at a time.
+
+    Only the requested columns are read, so memory is bounded by the batch size and not by the file size.
+    """
+    parquet_file = pq.ParquetFile(path)
+    missing = [column for column in columns if column not in parquet_file.schema_arrow.names]
+    if missing:
+        raise ValueError(f"{path} has no column {', '.join(missing)}")
+    for batch in parquet_file.iter_batches(batch_size=batch_size or input_batch_size(), columns=columns):
+        yield from zip(*(batch.column(column).to_pylist() for column in columns))
+
+
+def iter_source_articles(path: str, limit: int = None) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the (title, revid) of the source articles, at most `limit` of them.
+    """
+    for i, (title, revid) in enumerate(iter_parquet_rows(path, SOURCE_COLUMNS)):
+        if limit is not None and i >= limit:
+            return
+        yield fix_title(title), str(revid)
+
+
+def pair_key(source_title: str, revid: str, target_title: str) -> bytes:
+    return hashlib.blake2b(f"{source_title}\x1f{revid}\x1f{target_title}".encode(), digest_size=16).digest()
+
+
+def iter_scoring_pairs(path: str) -> Iterator[Tuple[str, str, str, str]]:
+    """
+    Yield the unique (source_title, revid, target_title, target_lead) pairs to score.
+
+    A pair is identified by its source revision and target, the first row of a pair wins like for the stored scores.
+    Only a 16 byte hash of every pair seen is kept, not the lead texts, but the set of hashes still grows with the
+    number of unique pairs, by about 80 MB per million. Deduplicating within a window would not be enough: a repeat
+    in a later window can be planned before the first row of its pair is scored, and would then overwrite it.
+    """
+    seen = set()
+    rows = 0
+    for source_title, revid, target_title, target_lead in iter_parquet_rows(path, PAIR_COLUMNS):
+        rows += 1
+        source_title, revid = fix_title(source_title), str(revid)
+        key = pair_key(source_title, revid, fix_title(target_title))
+        if key in seen:
+            continue
+        seen.add(key)
+        yield source_title, revid, target_title, target_lead
+    logging.info(f"Read {len(seen)} unique pairs from {rows} rows of {path}")
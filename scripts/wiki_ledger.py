@@ -0,0 +1,427 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Work item states, in the order an item goes through them
+PENDING = "pending"
+FETCHED = "fetched"
+PARSED = "parsed"
+SCORED = "scored"
+STORED = "stored"
+STATES = (PENDING, FETCHED, PARSED, SCORED, STORED)
+
+# Work item kinds
+SOURCE = "source"
+PAIR = "pair"
+
+SEED_CHUNK_SIZE = 1000
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class WorkLedger(ABC):
+    """
+    Durable record of the state of every work item of a run: source revisions and (source, target) pairs.
+
+    An item is claimed before it is worked on. A claim is a lease held by `owner` for `lease_seconds`; items that
+    are not stored yet and whose lease has expired (e.g. after a crash) can be claimed again. Items that failed
+    `max_attempts` times are no longer handed out.
+
+    Several processes, also on different hosts, can share a ledger. Each claims its own items, and a process that
+    works on items for longer than the lease keeps its claims alive with heartbeats (`start_heartbeat`), so the
+    items of a process that died are handed out again soon after its last heartbeat.
+    """
+
+    def __init__(self, owner: str = None, lease_seconds: float = None, max_attempts: int = None):
+        self.owner = owner or default_owner()
+        self.lease_seconds = lease_seconds or float(os.environ.get("LEDGER_LEASE_SECONDS", "3600"))
+        self.max_attempts = max_attempts or int(os.environ.get("LEDGER_MAX_ATTEMPTS", "3"))
+        # Items claimed by this owner and not completed or released yet, their leases are extended by heartbeats
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._heartbeat_stop = None
+        self._heartbeat_thread = None
+
+    def _hold(self, item_ids: Iterable[str]) -> None:
+        with self._held_lock:
+            self._held.update(item_ids)
+
+    def _drop(self, item_ids: Iterable[str]) -> None:
+        with self._held_lock:
+            self._held.difference_update(item_ids)
+
+    @abstractmethod
+    def seed(self, kind: str, items: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """
+        Add (item_id, payload) work items as pending, leaving items already in the ledger untouched.
+        Returns the number of new items.
+        """
+
+    @abstractmethod
+    def claim(self, kind: str, limit: int) -> List[Tuple[str, Dict[str, Any], str]]:
+        """
+        Atomically claim up to `limit` unfinished items and return them as (item_id, payload, state).
+        """
+
+    @abstractmethod
+    def advance(self, item_ids: List[str], state: str) -> None:
+        """
+        Record that claimed items reached `state`, keeping the claim.
+        """
+
+    @abstractmethod
+    def complete(self, item_ids: List[str]) -> None:
+        """
+        Mark claimed items as stored and release them.
+        """
+
+    @abstractmethod
+    def release(self, item_ids: List[str], error: str = None) -> None:
+        """
+        Give up the claim on failed items so they can be retried, counting the attempt.
+        """
+
+    @abstractmethod
+    def defer(self, item_ids: List[str], seconds: float) -> None:
+        """
+        Give up the claim on items that cannot be worked on yet without counting an attempt. They are not handed out
+        again for `seconds`.
+        """
+
+    @abstractmethod
+    def _extend(self, item_ids: List[str], lease_until: float) -> Set[str]:
+        """
+        Extend the leases of items still claimed by this owner and return their ids.
+        """
+
+    def heartbeat(self) -> None:
+        """
+        Extend the leases of all held items. Items whose lease expired and that were claimed by another owner in the
+        meantime are dropped, the other owner's writes win.
+        """
+        with self._held_lock:
+            item_ids = list(self._held)
+        if not item_ids:
+            return
+        kept = self._extend(item_ids, time.time() + self.lease_seconds)
+        lost = [item_id for item_id in item_ids if item_id not in kept]
+        if lost:
+            logging.warning(f"Lost the lease on {len(lost)} work items to other workers.")
+            self._drop(lost)
+
+    def start_heartbeat(self, interval: float = None) -> None:
+        """
+        Send heartbeats from a background thread, by default three times per lease.
+        """
+        if self._heartbeat_thread:
+            return
+        interval = interval or self.lease_seconds / 3
+        self._heartbeat_stop = threading.Event()
+
+        def beat():
+            while not self._heartbeat_stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logging.error(f"Work ledger heartbeat failed: {e}")
+
+        self._heartbeat_thread = threading.Thread(target=beat, name="ledger-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self) -> None:
+        if self._heartbeat_thread:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    @abstractmethod
+    def unfinished_ids(self, item_ids: List[str]) -> Set[str]:
+        """
+        Return the ids of the given items that are not stored yet and have attempts left.
+        """
+
+    @abstractmethod
+    def unfinished(self, kind: str) -> int:
+        """
+        Return the number of items of `kind` that are not stored yet and have attempts left, claimed or not.
+        """
+
+    @abstractmethod
+    def retry_failed(self, kind: str) -> None:
+        """
+        Reset the attempt count of unfinished items, so a new run retries items that failed in earlier runs.
+        """
+
+    @abstractmethod
+    def counts(self, kind: str = None) -> Dict[str, int]:
+        """
+        Return the number of items in each state, and under 'failed' the number of unfinished items that ran out of
+        attempts.
+        """
+
+
+class MongoWorkLedger(WorkLedger):
+    """
+    Work ledger stored in a MongoDB collection, shared by every process using the same database.
+    """
+
+    def __init__(self, collection, **kwargs):
+        super().__init__(**kwargs)
+        self.collection = collection
+        self.collection.create_index([("kind", 1), ("state", 1), ("lease_until", 1)])
+
+    def seed(self, kind, items):
+        inserted = 0
+        operations = []
+        for item_id, payload in items:
+            operations.append(UpdateOne(
+                {"_id": item_id},
+                {"$setOnInsert": {"kind": kind, "state": PENDING, "payload": payload, "owner": None,
+                                  "lease_until": 0.0, "attempts": 0, "error": None, "updated_at": time.time()}},
+                upsert=True
+            ))
+            if len(operations) >= SEED_CHUNK_SIZE:
+                inserted += self.collection.bulk_write(operations, ordered=False).upserted_count
+                operations = []
+        if operations:
+            inserted += self.collection.bulk_write(operations, ordered=False).upserted_count
+        return inserted
+
+    def claim(self, kind, limit):
+        claimed = []
+        for _ in range(limit):
+            now = time.time()
+            item = self.collection.find_one_and_update(
+                {"kind": kind, "state": {"$ne": STORED}, "lease_until": {"$lt": now},
+                 "attempts": {"$lt": self.max_attempts}},
+                {"$set": {"owner": self.owner, "lease_until": now + self.lease_seconds, "updated_at": now}},
+                return_document=ReturnDocument.AFTER
+            )
+            if item is None:
+                break
+            claimed.append((item["_id"], item["payload"], item["state"]))
+        self._hold(item_id for item_id, _, _ in claimed)
+        return claimed
+
+    def advance(self, item_ids, state):
+        self.collection.update_many({"_id": {"$in": list(item_ids)}, "owner": self.owner},
+                                    {"$set": {"state": state, "updated_at": time.time()}})
+
+    def complete(self, item_ids):
+        self._drop(item_ids)
+        self.collection.update_many({"_id": {"$in": list(item_ids)}, "owner": self.owner},
+                                    {"$set": {"state": STORED, "owner": None, "lease_until": 0.0,
+                                              "error": None, "updated_at": time.time()}})
+
+    def release(self, item_ids, error=None):
+        self._drop(item_ids)
+        self.collection.update_many({"_id": {"$in": list(item_ids)}, "owner": self.owner},
+                                    {"$set": {"owner": None, "lease_until": 0.0, "error": error,
+                                              "updated_at": time.time()},
+                                     "$inc": {"attempts": 1}})
+
+    def defer(self, item_ids, seconds):
+        self._drop(item_ids)
+        now = time.time()
+        self.collection.update_many({"_id": {"$in": list(item_ids)}, "owner": self.owner},
+                                    {"$set": {"owner": None, "lease_until": now + seconds, "updated_at": now}})
+
+    def _extend(self, item_ids, lease_until):
+        query = {"_id": {"$in": list(item_ids)}, "owner": self.owner}
+        self.collection.update_many(query, {"$set": {"lease_until": lease_until}})
+        return {item["_id"] for item in self.collection.find(query, {"_id": 1})}
+
+    def unfinished_ids(self, item_ids):
+        return {item["_id"] for item in self.collection.find(
+            {"_id": {"$in": list(item_ids)}, "state": {"$ne": STORED}, "attempts": {"$lt": self.max_attempts}},
+            {"_id": 1})}
+
+    def unfinished(self, kind):
+        return self.collection.count_documents(
+            {"kind": kind, "state": {"$ne": STORED}, "attempts": {"$lt": self.max_attempts}})
+
+    def retry_failed(self, kind):
+        self.collection.update_many({"kind": kind, "state": {"$ne": STORED}, "attempts": {"$gt": 0}},
+                                    {"$set": {"attempts": 0}})
+
+    def counts(self, kind=None):
+        match = {"kind": kind} if kind else {}
+        counts = {state: 0 for state in STATES}
+        for group in self.collection.aggregate([{"$match": match}, {"$group": {"_id": "$state", "n": {"$sum": 1}}}]):
+            counts[group["_id"]] = group["n"]
+        counts["failed"] = self.collection.count_documents(
+            {**match, "state": {"$ne": STORED}, "attempts": {"$gte": self.max_attempts}})
+        return counts
+
+
+class SQLiteWorkLedger(WorkLedger):
+    """
+    Work ledger stored in a local SQLite file, a stand-in for MongoWorkLedger on a single machine. Several local
+    processes can share the same file, claims are serialized with immediate transactions.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS work_items (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                state TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS work_items_claim ON work_items (kind, state, lease_until)")
+
+    def _transaction(self, statements):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.connection)
+                self.connection.execute("COMMIT")
+                return result
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def seed(self, kind, items):
+        def insert(connection):
+            inserted = 0
+            rows = []
+            for item_id, payload in items:
+                rows.append((item_id, kind, PENDING, json.dumps(payload), time.time()))
+                if len(rows) >= SEED_CHUNK_SIZE:
+                    inserted += self._insert(connection, rows)
+                    rows = []
+            if rows:
+                inserted += self._insert(connection, rows)
+            return inserted
+
+        return self._transaction(insert)
+
+    @staticmethod
+    def _insert(connection, rows):
+        before = connection.total_changes
+        connection.executemany(
+            "INSERT OR IGNORE INTO work_items (id, kind, state, payload, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        return connection.total_changes - before
+
+    def claim(self, kind, limit):
+        def claim_rows(connection):
+            now = time.time()
+            rows = connection.execute(
+                "SELECT id, payload, state FROM work_items "
+                "WHERE kind = ? AND state != ? AND lease_until < ? AND attempts < ? LIMIT ?",
+                (kind, STORED, now, self.max_attempts, limit)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE work_items SET owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                [(self.owner, now + self.lease_seconds, now, item_id) for item_id, _, _ in rows]
+            )
+            return [(item_id, json.loads(payload), state) for item_id, payload, state in rows]
+
+        claimed = self._transaction(claim_rows)
+        self._hold(item_id for item_id, _, _ in claimed)
+        return claimed
+
+    def _update(self, sql, item_ids, *params):
+        self._transaction(lambda connection: connection.executemany(
+            sql, [(*params, item_id, self.owner) for item_id in item_ids]))
+
+    def advance(self, item_ids, state):
+        self._update("UPDATE work_items SET state = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                     item_ids, state, time.time())
+
+    def complete(self, item_ids):
+        self._drop(item_ids)
+        self._update("UPDATE work_items SET state = ?, owner = NULL, lease_until = 0, error = NULL, updated_at = ? "
+                     "WHERE id = ? AND owner = ?", item_ids, STORED, time.time())
+
+    def release(self, item_ids, error=None):
+        self._drop(item_ids)
+        self._update("UPDATE work_items SET owner = NULL, lease_until = 0, error = ?, attempts = attempts + 1, "
+                     "updated_at = ? WHERE id = ? AND owner = ?", item_ids, error, time.time())
+
+    def defer(self, item_ids, seconds):
+        self._drop(item_ids)
+        now = time.time()
+        self._update("UPDATE work_items SET owner = NULL, lease_until = ?, updated_at = ? WHERE id = ? AND owner = ?",
+                     item_ids, now + seconds, now)
+
+    def _select_ids(self, sql, item_ids, *params):
+        found = set()
+        with self._lock:
+            for i in range(0, len(item_ids), SEED_CHUNK_SIZE):
+                chunk = list(item_ids[i:i + SEED_CHUNK_SIZE])
+                placeholders = ", ".join("?" * len(chunk))
+                found.update(row[0] for row in self.connection.execute(
+                    sql.format(placeholders=placeholders), (*chunk, *params)))
+        return found
+
+    def _extend(self, item_ids, lease_until):
+        item_ids = list(item_ids)
+        self._update("UPDATE work_items SET lease_until = ? WHERE id = ? AND owner = ?", item_ids, lease_until)
+        return self._select_ids("SELECT id FROM work_items WHERE id IN ({placeholders}) AND owner = ?",
+                                item_ids, self.owner)
+
+    def unfinished_ids(self, item_ids):
+        return self._select_ids("SELECT id FROM work_items WHERE id IN ({placeholders}) AND state != ? "
+                                "AND attempts < ?", list(item_ids), STORED, self.max_attempts)
+
+    def unfinished(self, kind):
+        with self._lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM work_items WHERE kind = ? AND state != ? AND attempts < ?",
+                (kind, STORED, self.max_attempts)).fetchone()[0]
+
+    def retry_failed(self, kind):
+        self._transaction(lambda connection: connection.execute(
+            "UPDATE work_items SET attempts = 0 WHERE kind = ? AND state != ? AND attempts > 0", (kind, STORED)))
+
+    def counts(self, kind=None):
+        counts = {state: 0 for state in STATES}
+        query = "SELECT state, COUNT(*) FROM work_items" + (" WHERE kind = ?" if kind else "") + " GROUP BY state"
+        with self._lock:
+            for state, n in self.connection.execute(query, (kind,) if kind else ()):
+                counts[state] = n
+            counts["failed"] = self.connection.execute(
+                "SELECT COUNT(*) FROM work_items WHERE state != ? AND attempts >= ?"
+                + (" AND kind = ?" if kind else ""),
+                (STORED, self.max_attempts, *((kind,) if kind else ()))).fetchone()[0]
+        return counts
+
+
+def open_ledger(spec: str, db=None, **kwargs) -> WorkLedger:
+    """
+    Open the ledger described by `spec`: 'mongo' for the 'work_ledger' collection of the WikiMongoDB `db`, or
+    'sqlite:<path>' for a local SQLite file.
+    """
+    if spec == "mongo":
+        return MongoWorkLedger(db.db["work_ledger"], **kwargs)
+    if spec.startswith("sqlite:"):
+        return SQLiteWorkLedger(spec[len("sqlite:"):], **kwargs)
+    raise ValueError(f"Unknown work ledger '{spec}', expected 'mongo' or 'sqlite:<path>'")
@@ -1,8 +1,13 @@
 import logging
+import threading
+import time
 from typing import Dict, Any, List, Optional
 
 import _md5
-from pymongo import MongoClient
+import numpy as np
+from bson import Binary
+from pymongo import InsertOne, MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
 # Import utility functions from the common module
 
@@ -11,36 +16,196 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+# Maximum number of ids sent in a single $in query
+IN_QUERY_CHUNK_SIZE = 1000
+
+
+def article_id_for(lang: str, title: str, revid: str) -> str:
+    # id is hashed from title and revid with lang
+    return _md5.md5(f"{lang}{title}{revid}".encode()).hexdigest()
+
+
+def target_id_for(lang: str, target_title: str) -> str:
+    # Use lang+title for a unique ID
+    return _md5.md5(f"{lang}{target_title}".encode()).hexdigest()
+
+
+def pair_id_for(lang: str, target_id: str, source_id: str) -> str:
+    return _md5.md5(f"{lang}{target_id}{source_id}".encode()).hexdigest()
+
+
+# Versions of the article_scores schema: one {idx, start, end, section, score} record per sentence, or the scores
+# packed into a binary array aligned with the sentence order of article_contents
+SCORES_SCHEMA_RECORDS = 1
+SCORES_SCHEMA_PACKED = 2
+SCORES_SCHEMAS = {"records": SCORES_SCHEMA_RECORDS, "packed": SCORES_SCHEMA_PACKED}
+PACKED_DTYPES = ("float16", "float32")
+
+
+def pack_scores(scores, dtype: str = "float32") -> Binary:
+    """
+    Pack scores in sentence order into a little-endian float16 or float32 array.
+    """
+    return Binary(np.asarray(scores, dtype=np.dtype(dtype).newbyteorder("<")).tobytes())
+
+
+def unpack_scores(document: Dict[str, Any]) -> np.ndarray:
+    """
+    Return the scores of an article_scores document of either schema as a float32 array in sentence order.
+    """
+    if document.get("schema_version", SCORES_SCHEMA_RECORDS) == SCORES_SCHEMA_PACKED:
+        dtype = np.dtype(document["dtype"]).newbyteorder("<")
+        return np.frombuffer(document["scores_packed"], dtype=dtype).astype(np.float32)
+    return np.array([record["score"] for record in document["scores"]], dtype=np.float32)
+
+
+def score_records(document: Dict[str, Any], sections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Return the per-sentence {idx, start, end, section, score} records of an article_scores document, rebuilding them
+    from the sections of the source article for packed documents.
+    """
+    if document.get("schema_version", SCORES_SCHEMA_RECORDS) != SCORES_SCHEMA_PACKED:
+        return document["scores"]
+    scores = unpack_scores(document)
+    sentences = [(sentence, section.get("title", "")) for section in sections for sentence in section["sentences"]]
+    if len(sentences) != len(scores):
+        raise ValueError(f"Packed scores of {document['_id']} have {len(scores)} entries, "
+                         f"but the source article has {len(sentences)} sentences")
+    return [{"idx": sentence["idx"], "start": sentence["start"], "end": sentence["end"], "section": section_title,
+             "score": float(score)}
+            for (sentence, section_title), score in zip(sentences, scores)]
+
+
+# Error code of a duplicate key write, expected when a rerun inserts documents that already exist
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BulkWriter:
+    """
+    Buffers write operations per collection and sends them as unordered bulk_write batches.
+
+    A collection's buffer is flushed once it holds `batch_size` operations or when an operation is added more than
+    `flush_interval` seconds after the last flush. Duplicate key errors are ignored so reruns are idempotent.
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffers = {}
+        self._lock = threading.RLock()
+        self._last_flush = time.monotonic()
+
+    def add(self, collection, operation) -> None:
+        with self._lock:
+            _, operations = self._buffers.setdefault(collection.name, (collection, []))
+            operations.append(operation)
+            if len(operations) >= self.batch_size:
+                self.flush(collection.name)
+            elif time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def pending(self, collection_name: str) -> bool:
+        with self._lock:
+            return bool(self._buffers.get(collection_name, (None, []))[1])
+
+    def flush(self, collection_name: str = None) -> None:
+        with self._lock:
+            names = [collection_name] if collection_name else list(self._buffers)
+            for name in names:
+                collection, operations = self._buffers.pop(name, (None, []))
+                if operations:
+                    self._write(collection, operations)
+            if collection_name is None:
+                self._last_flush = time.monotonic()
+
+    @staticmethod
+    def _write(collection, operations) -> None:
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            unexpected = [error for error in errors if error.get("code") != DUPLICATE_KEY_ERROR]
+            if unexpected or e.details.get("writeConcernErrors"):
+                raise
+            logging.info(f"Skipped {len(errors)} documents already in '{collection.name}'")
+        logging.info(f"Flushed {len(operations)} operations to '{collection.name}'")
+
 
 class WikiMongoDB:
     """
     Class to handle MongoDB operations for Wikipedia article extraction and scoring.
     """
 
-    def __init__(self, mongo_uri: str = None, db_name: str = None):
+    def __init__(self, mongo_uri: str = None, db_name: str = None, bulk_writes: bool = None, score_schema: str = None,
+                 client=None):
+        """
+        `client` replaces the MongoClient built from `mongo_uri`, e.g. with an in-memory stand-in for benchmarks.
+        """
         import os
         mongo_uri = mongo_uri or os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
         db_name = db_name or os.environ.get("DB_NAME", "wikinsert")
+        if bulk_writes is None:
+            bulk_writes = os.environ.get("MONGO_BULK_WRITES", "").lower() in ("1", "true", "yes")
+        # New score documents use the records schema read by the backend unless the packed schema is asked for
+        score_schema = score_schema or os.environ.get("SCORE_SCHEMA", "records")
+        if score_schema not in SCORES_SCHEMAS:
+            raise ValueError(f"Unknown score schema '{score_schema}', expected 'records' or 'packed'")
+        self.score_schema = SCORES_SCHEMAS[score_schema]
+        self.packed_dtype = os.environ.get("SCORE_PACKED_DTYPE", "float32")
+        if self.packed_dtype not in PACKED_DTYPES:
+            raise ValueError(f"Unknown packed score dtype '{self.packed_dtype}', expected 'float16' or 'float32'")
 
-        self.client = MongoClient(mongo_uri)
+        self.client = client if client is not None else MongoClient(mongo_uri)
         self.db = self.client[db_name]
         self.articles_collection = self.db["articles"]
         self.contents_collection = self.db["article_contents"]
         self.scores_collection = self.db["article_scores"]
         self.targets_collection = self.db["targets"]
+        self.heatmaps_collection = self.db["heatmap_payloads"]
+        # Revisions of an article are looked up by title for incremental re-scoring
+        self.articles_collection.create_index([("lang", 1), ("title", 1)])
+        # In bulk-write mode every write is buffered, call flush() or close() to persist the remaining ones
+        self.writer = BulkWriter(
+            int(os.environ.get("MONGO_BULK_BATCH_SIZE", "500")),
+            float(os.environ.get("MONGO_BULK_FLUSH_SECONDS", "5"))
+        ) if bulk_writes else None
+
+    def flush(self) -> None:
+        if self.writer:
+            self.writer.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush_pending(self, collection) -> None:
+        # Reads must see buffered writes to the same collection
+        if self.writer and self.writer.pending(collection.name):
+            self.writer.flush(collection.name)
 
     def add_article_meta_data(self, lang: str, title: str, revid: str, thumbnail: Dict[str, any],
                               description: str) -> str:
-        # id is hashed from title and revid with lang
-        article_id = _md5.md5(f"{lang}{title}{revid}".encode()).hexdigest()
-        self.articles_collection.insert_one({
+        article_id = article_id_for(lang, title, revid)
+        article = {
             "_id": article_id,
             "lang": lang,
             "title": title,
             "revid": revid,
             "thumbnail": thumbnail,
             "description": description,
-        })
+        }
+        if self.writer:
+            # An unordered batch may apply the $addToSet of update_article_targets first, both are upserts on the
+            # same _id that set different fields, so either order yields the whole article
+            self.writer.add(self.articles_collection, UpdateOne({"_id": article_id}, {"$set": article}, upsert=True))
+        else:
+            self.articles_collection.insert_one(article)
         logging.info(f"Inserted article '{title}' with ID {article_id}")
         return str(article_id)
 
@@ -49,23 +214,41 @@ class WikiMongoDB:
             "_id": article_id,
             "sections": sections
         }
+        if self.writer:
+            self.writer.add(self.contents_collection, InsertOne(contents))
+            return article_id
         result = self.contents_collection.insert_one(contents)
         return str(result.inserted_id)
 
-    def add_scores(self, source_id: str, target_id: str, scores: List[Dict[str, Any]]) -> str:
-        article_meta = self.get_article_meta_data(source_id)
-        lang = article_meta["lang"]
-        hashed_id = _md5.md5(f"{lang}{target_id}{source_id}".encode()).hexdigest()
+    def add_scores(self, source_id: str, target_id: str, scores: List[Dict[str, Any]], lang: str = None,
+                   prefix_hash: str = None) -> str:
+        if lang is None:
+            article_meta = self.get_article_meta_data(source_id)
+            lang = article_meta["lang"]
+        hashed_id = pair_id_for(lang, target_id, source_id)
         contents = {
             "_id": hashed_id,
             "source_id": source_id,
             "target_id": target_id,
             "scores": scores
         }
+        if self.score_schema == SCORES_SCHEMA_PACKED:
+            contents = self.pack_scores_document(contents)
+        if prefix_hash:
+            # Hash of the target side of the model input, lets later revisions of the source reuse the scores
+            contents["prefix_hash"] = prefix_hash
+        if self.writer:
+            self.writer.add(self.scores_collection, InsertOne(contents))
+            return hashed_id
         result = self.scores_collection.insert_one(contents)
         return str(result.inserted_id)
 
     def update_article_targets(self, article_id: str, target_id: str) -> None:
+        if self.writer:
+            # Upserts like the article itself, a $addToSet applied before the article upsert must not be dropped
+            self.writer.add(self.articles_collection,
+                            UpdateOne({"_id": article_id}, {"$addToSet": {"targets": target_id}}, upsert=True))
+            return
         result = self.articles_collection.update_one(
             {"_id": article_id},
             {"$addToSet": {"targets": target_id}}
@@ -76,19 +259,169 @@ class WikiMongoDB:
             logging.info(f"No update needed for article {article_id} with target {target_id}")
 
     def get_sections(self, article_id: str = None) -> List[Dict[str, Any]]:
+        self._flush_pending(self.contents_collection)
         section = self.contents_collection.find_one({"_id": article_id})
         return section.get("sections", [])
 
     def get_article_meta_data(self, article_id: str = None) -> Optional[Dict[str, Any]]:
+        self._flush_pending(self.articles_collection)
         article = self.articles_collection.find_one({"_id": article_id})
         # article is Mapping so convert to dict
         return dict(article) if article else None
 
+    def get_articles_meta_data(self, article_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the metadata of many articles, keyed by article_id, using chunked $in queries.
+        """
+        self._flush_pending(self.articles_collection)
+        articles = {}
+        article_ids = list(dict.fromkeys(article_ids))
+        for i in range(0, len(article_ids), IN_QUERY_CHUNK_SIZE):
+            for article in self.articles_collection.find({"_id": {"$in": article_ids[i:i + IN_QUERY_CHUNK_SIZE]}}):
+                articles[article["_id"]] = dict(article)
+        return articles
+
+    def get_article_revisions(self, lang: str, title: str) -> List[Dict[str, Any]]:
+        """
+        Return the metadata of every stored revision of the article (lang, title).
+        """
+        self._flush_pending(self.articles_collection)
+        return [dict(article) for article in self.articles_collection.find({"lang": lang, "title": title})]
+
+    def _existing_ids(self, collection, ids) -> set:
+        self._flush_pending(collection)
+        existing = set()
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), IN_QUERY_CHUNK_SIZE):
+            cursor = collection.find({"_id": {"$in": ids[i:i + IN_QUERY_CHUNK_SIZE]}}, {"_id": 1})
+            existing.update(document["_id"] for document in cursor)
+        return existing
+
+    def existing_article_ids(self, article_ids: List[str]) -> set:
+        """
+        Return the subset of `article_ids` already stored in 'articles', fetching only the ids.
+        """
+        return self._existing_ids(self.articles_collection, article_ids)
+
+    def existing_pair_ids(self, pair_ids: List[str]) -> set:
+        """
+        Return the subset of `pair_ids` whose scores are already stored, fetching only the ids.
+        """
+        return self._existing_ids(self.scores_collection, pair_ids)
+
     def get_scores(self, pair_id: str) -> List[Dict[str, Any]]:
+        self._flush_pending(self.scores_collection)
         scores = list(self.scores_collection.find({"_id": pair_id}))
         return scores
 
+    def add_heatmap_payload(self, pair_id: str, source_id: str, target_id: str, payload: Dict[str, Any]) -> str:
+        """
+        Store the ready-to-serve heatmap payload of a pair (see heatmap_payloads.build_heatmap_payload), replacing
+        an earlier one.
+        """
+        contents = {
+            "_id": pair_id,
+            "source_id": source_id,
+            "target_id": target_id,
+            **payload,
+            "payload": Binary(payload["payload"]),
+        }
+        operation = ReplaceOne({"_id": pair_id}, contents, upsert=True)
+        if self.writer:
+            self.writer.add(self.heatmaps_collection, operation)
+        else:
+            self.heatmaps_collection.bulk_write([operation])
+        return pair_id
+
+    def get_heatmap_payload(self, pair_id: str) -> Optional[Dict[str, Any]]:
+        self._flush_pending(self.heatmaps_collection)
+        return self.heatmaps_collection.find_one({"_id": pair_id})
+
+    def get_score_array(self, pair_id: str) -> Optional[np.ndarray]:
+        """
+        Return the scores of a pair as a float32 array in the sentence order of article_contents, whatever the schema.
+        """
+        documents = self.get_scores(pair_id)
+        return unpack_scores(documents[0]) if documents else None
+
+    def get_score_records(self, pair_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the {idx, start, end, section, score} records of a pair, rebuilt from article_contents for documents
+        in the packed schema.
+        """
+        documents = self.get_scores(pair_id)
+        if not documents:
+            return None
+        document = documents[0]
+        if document.get("schema_version", SCORES_SCHEMA_RECORDS) != SCORES_SCHEMA_PACKED:
+            return document["scores"]
+        return score_records(document, self.get_sections(document["source_id"]))
+
+    def pack_scores_document(self, document: Dict[str, Any], dtype: str = None) -> Dict[str, Any]:
+        """
+        Convert an article_scores document in the records schema to the packed schema. The records must be in the
+        sentence order of the source's article_contents, as written by the pipeline.
+        """
+        packed = {key: value for key, value in document.items() if key != "scores"}
+        dtype = dtype or self.packed_dtype
+        packed.update({
+            "schema_version": SCORES_SCHEMA_PACKED,
+            "dtype": dtype,
+            "count": len(document["scores"]),
+            "scores_packed": pack_scores([record["score"] for record in document["scores"]], dtype),
+        })
+        return packed
+
+    def migrate_scores(self, to_schema: str = "packed", dtype: str = None, batch_size: int = 500,
+                       dry_run: bool = False) -> Dict[str, int]:
+        """
+        Rewrite the article_scores documents of the other schema in `to_schema`, in bulk batches.
+
+        Records are only packed if they line up with the sentences of the source's article_contents, other documents
+        are skipped. Returns the number of converted and skipped documents and their BSON size before and after.
+        """
+        from bson import encode
+
+        target = SCORES_SCHEMAS[to_schema]
+        if target == SCORES_SCHEMA_PACKED:
+            query = {"schema_version": {"$ne": SCORES_SCHEMA_PACKED}}
+        else:
+            query = {"schema_version": SCORES_SCHEMA_PACKED}
+        stats = {"converted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+        operations = []
+        for document in self.scores_collection.find(query, batch_size=batch_size):
+            contents = self.contents_collection.find_one({"_id": document["source_id"]})
+            if contents is None:
+                logging.warning(f"Scores {document['_id']}: source {document['source_id']} has no contents, skipped")
+                stats["skipped"] += 1
+                continue
+            sections = contents.get("sections", [])
+            if target == SCORES_SCHEMA_PACKED:
+                sentence_idx = [sentence["idx"] for section in sections for sentence in section["sentences"]]
+                if [record["idx"] for record in document["scores"]] != sentence_idx:
+                    logging.warning(f"Scores {document['_id']} are not in the sentence order of their source, skipped")
+                    stats["skipped"] += 1
+                    continue
+                converted = self.pack_scores_document(document, dtype)
+            else:
+                converted = {key: value for key, value in document.items()
+                             if key not in ("schema_version", "dtype", "count", "scores_packed")}
+                converted["scores"] = score_records(document, sections)
+            stats["converted"] += 1
+            stats["bytes_before"] += len(encode(document))
+            stats["bytes_after"] += len(encode(converted))
+            if not dry_run:
+                operations.append(ReplaceOne({"_id": document["_id"]}, converted))
+            if len(operations) >= batch_size:
+                self.scores_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            self.scores_collection.bulk_write(operations, ordered=False)
+        logging.info(f"Score migration to the {to_schema} schema{' (dry run)' if dry_run else ''}: {stats}")
+        return stats
+
     def list_articles(self) -> List[Dict[str, Any]]:
+        self._flush_pending(self.articles_collection)
         return list(self.articles_collection.find())
 
     def add_target_meta(self, target_title: str, lang: str, lead: str,
@@ -96,8 +429,7 @@ class WikiMongoDB:
         """
         Store metadata for a target article for search and display.
         """
-        # Use lang+title for a unique ID
-        target_id = _md5.md5(f"{lang}{target_title}".encode()).hexdigest()
+        target_id = target_id_for(lang, target_title)
         contents = {
             "_id": target_id,
             "title": target_title,
@@ -107,9 +439,39 @@ class WikiMongoDB:
             "description": description,
         }
         # Upsert to avoid duplicates
+        if self.writer:
+            self.writer.add(self.targets_collection, UpdateOne({"_id": target_id}, {"$set": contents}, upsert=True))
+            return target_id
         self.targets_collection.update_one(
             {"_id": target_id},
             {"$set": contents},
             upsert=True
         )
         return target_id
+
+    def add_targets_meta(self, targets: List[Dict[str, Any]]) -> List[str]:
+        """
+        Store metadata for many targets in a single bulk upsert.
+
+        Each target is a dict with the keys of add_target_meta: target_title, lang, lead, thumbnail and description.
+        """
+        target_ids = []
+        operations = []
+        for target in targets:
+            target_id = target_id_for(target['lang'], target['target_title'])
+            contents = {
+                "_id": target_id,
+                "title": target['target_title'],
+                "lang": target['lang'],
+                "lead": target['lead'],
+                "thumbnail": target['thumbnail'],
+                "description": target['description'],
+            }
+            operations.append(UpdateOne({"_id": target_id}, {"$set": contents}, upsert=True))
+            target_ids.append(target_id)
+        if self.writer:
+            for operation in operations:
+                self.writer.add(self.targets_collection, operation)
+        elif operations:
+            self.targets_collection.bulk_write(operations, ordered=False)
+        return target_ids
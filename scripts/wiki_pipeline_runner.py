@@ -0,0 +1,210 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline_metrics import metrics
+from wiki_sentence_utils import (build_article, fetch_article_html, fetch_article_metadata, parse_article_html_timed,
+                                 record_timings)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Marks the end of a stage's input
+_STOP = object()
+
+
+class StagedPipeline:
+    """
+    Streaming runner for WikiPipeline: fetch -> parse -> store article -> score -> store scores.
+
+    Every stage runs on its own workers and hands work to the next one through a bounded queue, so a slow stage
+    applies backpressure to the ones before it and end-to-end throughput is set by the slowest stage:
+    - fetch: I/O threads downloading HTML and metadata, or loading the sections of articles already in the DB
+    - parse: threads feeding a process pool that parses HTML and tokenizes sentences
+    - store: I/O threads writing articles and sections
+    - score: a single thread that packs the pairs of several sources into shared batches to keep the model busy
+    - write: I/O threads writing scores and article targets
+
+    A work item is one source article with the (target_title, target_lead) pairs still to score for it. Worker
+    counts and the queue size default to the PIPELINE_* environment variables.
+    """
+
+    def __init__(self, pipeline, fetch_workers: int = None, parse_workers: int = None, write_workers: int = None,
+                 queue_size: int = None):
+        self.pipeline = pipeline
+        self.fetch_workers = fetch_workers or int(
+            os.environ.get("PIPELINE_FETCH_WORKERS", str(pipeline.fetcher.concurrency)))
+        self.parse_workers = parse_workers or int(
+            os.environ.get("PIPELINE_PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+        self.write_workers = write_workers or int(os.environ.get("PIPELINE_WRITE_WORKERS", "2"))
+        queue_size = queue_size or int(os.environ.get("PIPELINE_QUEUE_SIZE", "32"))
+
+        self.fetch_queue = queue.Queue(queue_size)
+        self.parse_queue = queue.Queue(queue_size)
+        self.store_queue = queue.Queue(queue_size)
+        self.score_queue = queue.Queue(queue_size)
+        self.write_queue = queue.Queue(queue_size)
+
+        self._outstanding = 0
+        self._done = threading.Condition()
+        self.completed = 0
+        self.failed = 0
+
+    def queue_depths(self):
+        return {
+            'fetch': self.fetch_queue.qsize(),
+            'parse': self.parse_queue.qsize(),
+            'store': self.store_queue.qsize(),
+            'score': self.score_queue.qsize(),
+            'write': self.write_queue.qsize(),
+        }
+
+    def _finish(self, item, error=None):
+        if error is not None:
+            logging.error(f"Failed to process {item['lang']}:{item['title']}:{item['revid']}: {error}")
+        with self._done:
+            self._outstanding -= 1
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._done.notify_all()
+
+    def _stage(self, in_queue, handle):
+        """
+        Worker loop: apply `handle` to every item of `in_queue` until the stop marker arrives.
+        """
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                return
+            try:
+                handle(item)
+            except Exception as e:
+                self._finish(item, e)
+
+    def _fetch(self, item):
+        db = self.pipeline.db
+        if item['exists']:
+            item['sections'] = db.get_sections(item['article_id'])
+            self.score_queue.put(item)
+            return
+        fetcher = self.pipeline.fetcher
+        item['html'] = fetch_article_html(item['lang'], item['title'], item['revid'], fetcher)
+        item['metadata'] = fetch_article_metadata(item['lang'], item['title'], fetcher)
+        self.parse_queue.put(item)
+
+    def _parse(self, item, process_pool):
+        # The pool process times its own work, the timings are recorded in this process
+        item['sections'], timings = process_pool.submit(parse_article_html_timed, item.pop('html'),
+                                                        item['lang']).result()
+        record_timings(timings)
+        self.store_queue.put(item)
+
+    def _store(self, item):
+        article_data = build_article(item['title'], item['revid'], None, item.pop('metadata'),
+                                     sections=item['sections'])
+        self.pipeline._store_article(item['lang'], item['title'], item['revid'], article_data)
+        self.score_queue.put(item)
+
+    def _score(self):
+        """
+        Scoring loop: gather queued sources until a chunk of pairs is full or the queue is empty, then score all of
+        their pairs in one inference stream.
+        """
+        pairs_per_chunk = self.pipeline.pairs_per_chunk
+        stopping = False
+        while not stopping:
+            item = self.score_queue.get()
+            if item is _STOP:
+                return
+            items = [item]
+            num_pairs = len(item['targets'])
+            while num_pairs < pairs_per_chunk:
+                try:
+                    item = self.score_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+                num_pairs += len(item['targets'])
+
+            jobs = []
+            try:
+                for item in items:
+                    item_jobs = [{
+                        'sections': item['sections'],
+                        'article_title': item['title'],
+                        'target_title': target_title,
+                        'target_lead': target_lead,
+                    } for target_title, target_lead in item['targets']]
+                    self.pipeline.add_known_scores(item['lang'], item['article_id'], item['title'], item['revid'],
+                                                   item_jobs)
+                    jobs.extend(item_jobs)
+                all_scores = iter(self.pipeline.scorer.get_sentence_scores_batch(jobs) if jobs else [])
+            except Exception as e:
+                for item in items:
+                    self._finish(item, e)
+                continue
+            for item in items:
+                item.pop('sections')
+                item['scores'] = [next(all_scores) for _ in item['targets']]
+                self.write_queue.put(item)
+
+    def _write(self, item):
+        self.pipeline.store_scores(item['lang'], item['article_id'], item['targets'], item.pop('scores'))
+        self._finish(item)
+
+    def run(self, items):
+        """
+        Process an iterable of work items, each a dict with the keys 'lang', 'title', 'revid', 'article_id',
+        'exists' (whether the article is already in the DB) and 'targets'.
+        """
+        process_pool = ProcessPoolExecutor(self.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+        for name in self.queue_depths():
+            metrics.register_gauge("queue_depth", lambda name=name: self.queue_depths()[name], queue=name)
+        metrics.register_gauge("items_in_flight", lambda: self._outstanding)
+        stages = [
+            (self.fetch_queue, self._fetch, self.fetch_workers),
+            (self.parse_queue, lambda item: self._parse(item, process_pool), self.parse_workers),
+            (self.store_queue, self._store, self.write_workers),
+            (self.write_queue, self._write, self.write_workers),
+        ]
+        threads = []
+        for in_queue, handle, workers in stages:
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self._stage, args=(in_queue, handle), daemon=True))
+        score_thread = threading.Thread(target=self._score, daemon=True)
+        for thread in threads + [score_thread]:
+            thread.start()
+
+        try:
+            for item in items:
+                with self._done:
+                    self._outstanding += 1
+                # Blocks while the fetch stage is saturated
+                self.fetch_queue.put(item)
+            with self._done:
+                while self._outstanding:
+                    self._done.wait(timeout=30)
+                    logging.info(f"Staged pipeline: {self.completed} done, {self.failed} failed, "
+                                 f"{self._outstanding} in flight, queue depths {self.queue_depths()}")
+        finally:
+            for in_queue, _, workers in stages:
+                for _ in range(workers):
+                    in_queue.put(_STOP)
+            self.score_queue.put(_STOP)
+            for thread in threads + [score_thread]:
+                thread.join()
+            process_pool.shutdown()
+            self.pipeline.db.flush()
+            metrics.unregister_gauges("queue_depth")
+            metrics.unregister_gauges("items_in_flight")
+        logging.info(f"Staged pipeline finished: {self.completed} sources done, {self.failed} failed.")
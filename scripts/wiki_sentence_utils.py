@@ -1,11 +1,17 @@
 import logging
+import re
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List
 from urllib import parse
 
 import pandas as pd
-import requests
 from lxml import html
 from mwtokenizer.tokenizer import Tokenizer
 
+from pipeline_metrics import metrics, trace_sampled
+from wiki_fetch import get_default_fetcher
+
 xpath_condition = """
     //div[@id='mw-content-text']//text()[
         not(ancestor-or-self::noscript)
@@ -69,6 +75,22 @@ xpath_section = """preceding::h2[
     ][1]
     """
 
+# Element-level form of xpath_condition, used by the single-pass walker in extract_section_texts
+EXCLUDED_TAGS = {'noscript', 'h2', 'h3', 'style', 'cite', 'script', 'table', 'img', 'figure', 'sup'}
+EXCLUDED_CLASSES = {'mw-headline', 'mw-headline mw-heading2', 'mw-editsection', 'mw-bandeau', 'reflist', 'map'}
+EXCLUDED_DIV_CLASSES = (
+    'js-interprojects', 'galleryext', 'mw-headline', 'thumb', 'navbox', 'toc', 'reflist', 'printfooter', 'soslink',
+    'bandeau', 'infobox', 'references', 'side-box', 'plainlinks', 'sisterbox'
+)
+EXCLUDED_DIV_ROLES = ('navigation', 'note')
+EXCLUDED_DIV_STYLES = ('float:', 'display:none')
+
+# Element-level form of xpath_section
+HEADING_EXCLUDED_TAGS = {'noscript', 'style', 'cite', 'script', 'table'}
+HEADING_EXCLUDED_DIV_CLASSES = ('thumb', 'navbox', 'toc', 'reflist', 'printfooter', 'soslink')
+HEADING_EXCLUDED_DIV_ROLES = ('navigation',)
+HEADING_EXCLUDED_DIV_STYLES = ('float:',)
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -80,45 +102,113 @@ import os
 # Paths to input parquet files; change these as needed
 SOURCE_ARTICLES_PATH = os.environ.get("SOURCE_ARTICLES_PATH", "/path/to/source_articles.parquet")
 SCORED_DATA_PATH = os.environ.get("SCORED_DATA_PATH", "/path/to/score_data.parquet")
+# Base URL of the wiki to fetch from, e.g. a local stub server for testing
+WIKI_URL_TEMPLATE = os.environ.get("WIKI_URL_TEMPLATE", "https://{lang}.wikipedia.org")
+# Maximum number of titles the MediaWiki API accepts in one query
+METADATA_BATCH_SIZE = 50
 
 
 def fix_title(title):
     return parse.unquote(title).replace('_', ' ')
 
-def normalize_html_text(text):
-    # Remove spaces and tabs before and after line breaks
-    text = text.replace('\r\n', '\n')  # Normalize line breaks
-    lines = text.split('\n')
-    lines = [line.strip() for line in lines]
-    text = ' '.join(lines)
+# Line breaks with the whitespace around them, runs of spaces and tabs, and single tabs
+_WHITESPACE_PATTERN = re.compile(r'\s*\n\s*|[ \t]{2,}|\t')
 
-    # Replace tabs with spaces
-    text = text.replace('\t', ' ')
 
-    # Remove duplicate spaces
-    while '  ' in text:
-        text = text.replace('  ', ' ')
+def normalize_html_text(text):
+    # Replace line breaks with the whitespace around them, tabs and repeated spaces by a single space in one pass
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
 
-    # Trim leading and trailing spaces
-    return text.strip()
 
+def _element_exclusion(element):
+    """
+    Return whether the element itself excludes its text (xpath_condition) and its h2 headings (xpath_section).
+    """
+    tag = element.tag
+    # Comments and processing instructions never exclude anything
+    if not isinstance(tag, str):
+        return False, False
+    css_class = element.get('class')
+    text_excluded = tag in EXCLUDED_TAGS or css_class in EXCLUDED_CLASSES
+    heading_excluded = tag in HEADING_EXCLUDED_TAGS
+    if tag == 'div':
+        css_class = css_class or ''
+        role = element.get('role') or ''
+        style = element.get('style') or ''
+        text_excluded = (text_excluded
+                         or any(name in css_class for name in EXCLUDED_DIV_CLASSES)
+                         or any(name in role for name in EXCLUDED_DIV_ROLES)
+                         or any(name in style for name in EXCLUDED_DIV_STYLES))
+        heading_excluded = (heading_excluded
+                            or any(name in css_class for name in HEADING_EXCLUDED_DIV_CLASSES)
+                            or any(name in role for name in HEADING_EXCLUDED_DIV_ROLES)
+                            or any(name in style for name in HEADING_EXCLUDED_DIV_STYLES))
+    return text_excluded, heading_excluded
+
+
+def extract_section_texts(tree):
+    """
+    Walk `mw-content-text` once in document order and yield (section_title, text) for every content text node.
 
-def build_sections(text_nodes, xpath_section):
+    This is the single-pass equivalent of evaluating xpath_condition and then xpath_section from the parent of
+    every text node: the exclusion state of the ancestors is kept on the walk stack and the last completed h2
+    heading is tracked as the walk goes. Like the `preceding::h2` query, a tail text takes the heading that was
+    current where its element starts, so h2 headings inside that element do not count.
+    """
+    section_title = "lead"
+    # Document position of the current heading, a nested h2 completes before its parent but still wins
+    section_position = -1
+    position = 0
+    content_roots = tree.xpath("//div[@id='mw-content-text'][not(ancestor::div[@id='mw-content-text'])]")
+    for root in content_roots:
+        text_excluded = False
+        heading_excluded = False
+        for element in root.iterancestors():
+            own_text_excluded, own_heading_excluded = _element_exclusion(element)
+            text_excluded = text_excluded or own_text_excluded
+            heading_excluded = heading_excluded or own_heading_excluded
+        own_text_excluded, own_heading_excluded = _element_exclusion(root)
+        root_excluded = text_excluded or own_text_excluded
+        if root.text and root.text.strip() and not root_excluded:
+            yield section_title, root.text
+
+        # Stack entries: element, child iterator, document position, exclusion state including the element,
+        # the parent's text exclusion (which applies to the tail) and the heading current where the element starts
+        stack = [(root, iter(root), position, root_excluded, heading_excluded or own_heading_excluded,
+                  text_excluded, section_title)]
+        while stack:
+            element, children, element_position, excluded, heading_excluded, parent_excluded, start_title = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                position += 1
+                own_text_excluded, own_heading_excluded = _element_exclusion(child)
+                child_excluded = excluded or own_text_excluded
+                stack.append((child, iter(child), position, child_excluded, heading_excluded or own_heading_excluded,
+                              excluded, section_title))
+                if isinstance(child.tag, str) and child.text and child.text.strip() and not child_excluded:
+                    yield section_title, child.text
+                continue
+
+            stack.pop()
+            if element.tag == 'h2' and not heading_excluded and element_position > section_position:
+                section_title = normalize_html_text(element.text_content())
+                section_position = element_position
+            if stack and element.tail and element.tail.strip() and not parent_excluded:
+                yield start_title, element.tail
+        position += 1
+
+
+def group_sections(section_texts):
+    """
+    Concatenate consecutive (section_title, text) pairs of the same section and compute their offsets.
+    """
     sections_data = []
     offset = 0
 
-    for node in text_nodes:
-        # Normalize the text node content
-        text = node
+    for section_title, text in section_texts:
         if text.strip() == '':
             continue
 
-        preceding_h2 = node.getparent().xpath(xpath_section)
-        if preceding_h2:
-            section_title = normalize_html_text(preceding_h2[0].text_content())
-        else:
-            section_title = "lead"
-
         # Check if we already have a section with this title
         if sections_data and sections_data[-1]['title'] == section_title:
             # Update the existing section
@@ -144,15 +234,55 @@ def build_sections(text_nodes, xpath_section):
     return sections_df
 
 
-def get_sentences(sections_df):
-    tokenizer = Tokenizer(language_code='en')
+def build_sections(text_nodes, xpath_section):
+    """
+    Reference implementation of the section extraction that queries `xpath_section` from every text node.
+
+    Its cost grows quadratically with the page size, parse_article uses extract_section_texts instead.
+    """
+    def section_texts():
+        for node in text_nodes:
+            if node.strip() == '':
+                continue
+            preceding_h2 = node.getparent().xpath(xpath_section)
+            if preceding_h2:
+                yield normalize_html_text(preceding_h2[0].text_content()), node
+            else:
+                yield "lead", node
+
+    return group_sections(section_texts())
+
+
+@lru_cache(maxsize=None)
+def get_segmenter(lang='en'):
+    """
+    Return the sentence tokenizer of a language, created once per process and language.
+
+    Setting up a tokenizer loads its abbreviation list, which costs far more than segmenting a section. The
+    tokenizer keeps no state between calls, so threads of a process share it.
+    """
+    return Tokenizer(language_code=lang)
+
+
+def segment_texts(texts: Iterable[str], lang='en') -> List[List[str]]:
+    """
+    Split each text into its sentences with the tokenizer of `lang`.
+    """
+    tokenizer = get_segmenter(lang)
+    return [list(tokenizer.sentence_tokenize(text, use_abbreviation=True)) for text in texts]
+
+
+def get_sentences(sections_df, lang='en'):
     sections = []
+    if sections_df.empty:
+        return sections
     current_offset = 0
     sen_idx = 0
-    for _, section in sections_df.iterrows():
-        section_data = {'title': section['title']}
+    titles = sections_df['title'].tolist()
+    for title, sentences in zip(titles, segment_texts(sections_df['text'].tolist(), lang)):
+        section_data = {'title': title}
         section_sentences = []
-        for sentence in tokenizer.sentence_tokenize(section['text'], use_abbreviation=True):
+        for sentence in sentences:
             sentence_data = {
                 'idx': sen_idx,
                 'start': current_offset,
@@ -169,7 +299,7 @@ def get_sentences(sections_df):
 
 
 def build_wiki_url(lang, title, revid):
-    base_url = f"https://{lang}.wikipedia.org/w/index.php?"
+    base_url = f"{WIKI_URL_TEMPLATE.format(lang=lang)}/w/index.php?"
     if title is not None and revid is not None:
         return f"{base_url}title={title}&oldid={revid}"
     elif title is not None:
@@ -181,56 +311,156 @@ def build_wiki_url(lang, title, revid):
 
 
 def build_meta_data_endpoint(lang, title):
-    return f"https://{lang}.wikipedia.org/w/api.php?action=query&format=json&formatversion=2&list=&piprop=thumbnail&prop=pageimages%7Cdescription&titles={title}"
+    return f"{WIKI_URL_TEMPLATE.format(lang=lang)}/w/api.php?action=query&format=json&formatversion=2&list=&piprop=thumbnail&prop=pageimages%7Cdescription&titles={title}"
+
 
+def build_batch_meta_data_endpoint(lang, titles):
+    # Titles are quoted since a batch joins them with '|' and any of them may contain '&' or '+'
+    return build_meta_data_endpoint(lang, '%7C'.join(parse.quote(title, safe='') for title in titles))
+
+
+def fetch_article_html(lang, title, revid, fetcher=None):
+    fetcher = fetcher or get_default_fetcher()
+    # Only a fixed revision is immutable and safe to cache
+    cache = fetcher.cache if revid is not None else None
+    if cache:
+        html_content = cache.get_text('html', lang, title, revid)
+        if html_content is not None:
+            metrics.count('fetch_cache_hits')
+            return html_content
+        metrics.count('fetch_cache_misses')
 
-def parse_article(lang='en', title=None, revid=None):
     url = build_wiki_url(lang, title, revid)
 
     logging.info(f"Extracting sentences from {url}")
 
     # Fetch the Wikipedia article
-    html_content = requests.get(url).text
+    with metrics.timer('fetch'):
+        html_content = fetcher.get_text(url)
+    if cache:
+        cache.put_text('html', lang, title, revid, text=html_content)
+    return html_content
 
 
+def parse_article_html_timed(html_content, lang='en'):
+    """
+    Return the sentences of an article and the seconds spent parsing it and segmenting its sections, for callers
+    in another process than the metrics registry, e.g. a parse worker pool.
+    """
+    started = time.perf_counter()
     # Parse the HTML
     tree = html.fromstring(html_content)
 
-    # Extract text nodes
-    text_nodes = tree.xpath(xpath_condition)
-
-    # Build sections
-    sections_df = build_sections(text_nodes, xpath_section)
+    # Build sections from the content text nodes in a single walk over the document
+    sections_df = group_sections(extract_section_texts(tree))
+    parsed = time.perf_counter()
 
     # Get sentences
-    sections = get_sentences(sections_df)
-    # print the type of sections
+    sections = get_sentences(sections_df, lang)
+    return sections, {'parse': (parsed - started, 1), 'segment': (time.perf_counter() - parsed, len(sections_df))}
+
+
+def record_timings(timings):
+    for stage, (seconds, items) in timings.items():
+        metrics.observe(stage, seconds, items)
+
+
+def parse_article_html(html_content, lang='en'):
+    sections, timings = parse_article_html_timed(html_content, lang)
+    record_timings(timings)
+    return sections
 
+
+def build_article(title, revid, html_content, metadata, sections=None, lang='en'):
     article = {
         'title': title,
         'revid': revid,
-        'sections': sections
+        'sections': sections if sections is not None else parse_article_html(html_content, lang),
+        'thumbnail': metadata['thumbnail'],
+        'description': metadata['description'],
     }
-
-    metadata = fetch_article_metadata(lang, title)
-    article['thumbnail'] = metadata['thumbnail']
-    article['description'] = metadata['description']
-    logging.info(article)
+    num_sentences = sum(len(section['sentences']) for section in article['sections'])
+    logging.info(f"Built article {title}:{revid} with {len(article['sections'])} sections and "
+                 f"{num_sentences} sentences")
+    # The whole article only for a sample of the articles
+    if trace_sampled():
+        logging.info(f"Trace: {article}")
 
     return article
 
 
-def fetch_article_metadata(lang: str, title: str) -> dict:
+def parse_article(lang='en', title=None, revid=None, fetcher=None):
+    html_content = fetch_article_html(lang, title, revid, fetcher)
+    metadata = fetch_article_metadata(lang, title, fetcher)
+    return build_article(title, revid, html_content, metadata, lang=lang)
+
+
+def _page_metadata(page: dict) -> dict:
+    return {"thumbnail": page.get('thumbnail', {}), "description": page.get('description', '')}
+
+
+def fetch_article_metadata(lang: str, title: str, fetcher=None) -> dict:
+    fetcher = fetcher or get_default_fetcher()
+    if fetcher.cache:
+        metadata = fetcher.cache.get_json('metadata', lang, title)
+        if metadata is not None:
+            metrics.count('fetch_cache_hits')
+            return metadata
+        metrics.count('fetch_cache_misses')
+
     # Construct metadata endpoint
     meta_data_url = build_meta_data_endpoint(lang, title)
-    meta_data = requests.get(meta_data_url).json()
+    with metrics.timer('fetch'):
+        meta_data = fetcher.get_json(meta_data_url)
     logging.info(f"Extracting metadata from {meta_data}")
-    thumbnail = {}
-    description = ''
+    metadata = {"thumbnail": {}, "description": ''}
     if 'query' in meta_data and 'pages' in meta_data['query']:
         pages = meta_data['query']['pages']
         if pages:
-            page = pages[0]
-            thumbnail = page.get('thumbnail', {})
-            description = page.get('description', '')
-    return {"thumbnail": thumbnail, "description": description}
+            metadata = _page_metadata(pages[0])
+    if fetcher.cache:
+        fetcher.cache.put_json('metadata', lang, title, value=metadata)
+    return metadata
+
+
+def fetch_articles_metadata(lang: str, titles, fetcher=None) -> Dict[str, dict]:
+    """
+    Resolve the metadata of many titles, METADATA_BATCH_SIZE titles per API request.
+
+    Titles are deduplicated and looked up in the cache first, the remaining batches are requested concurrently on
+    the fetcher's worker pool. Returns a dict mapping every requested title to its metadata; titles the API does
+    not know get an empty thumbnail and description, like fetch_article_metadata.
+    """
+    fetcher = fetcher or get_default_fetcher()
+    metadata = {}
+    missing = []
+    for title in dict.fromkeys(titles):
+        cached = fetcher.cache.get_json('metadata', lang, title) if fetcher.cache else None
+        if cached is not None:
+            metadata[title] = cached
+        else:
+            missing.append(title)
+    if fetcher.cache:
+        metrics.count('fetch_cache_hits', len(metadata))
+        metrics.count('fetch_cache_misses', len(missing))
+
+    batches = [missing[i:i + METADATA_BATCH_SIZE] for i in range(0, len(missing), METADATA_BATCH_SIZE)]
+
+    def fetch(batch):
+        with metrics.timer('fetch', len(batch)):
+            return fetcher.get_json(build_batch_meta_data_endpoint(lang, batch))
+
+    for batch, meta_data, error in fetcher.imap_unordered(fetch, batches):
+        if error:
+            raise error
+        query = meta_data.get('query', {})
+        # The API answers with normalized titles, e.g. 'foo bar' comes back as 'Foo bar'
+        normalized = {entry['from']: entry['to'] for entry in query.get('normalized', [])}
+        pages = {page.get('title'): page for page in query.get('pages', [])}
+        for title in batch:
+            page = pages.get(normalized.get(title, title), {})
+            metadata[title] = _page_metadata(page)
+            if fetcher.cache:
+                fetcher.cache.put_json('metadata', lang, title, value=metadata[title])
+        logging.info(f"Resolved metadata for {len(batch)} titles")
+    return metadata
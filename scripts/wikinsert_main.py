@@ -1,15 +1,27 @@
-import hashlib
+import argparse
 import logging
 import os
 import re
+import threading
+import time
 
-import _md5
-import pandas as pd
 from dotenv import load_dotenv
 
-from sentence_score import SentenceScorer
-from wiki_mongo_db import WikiMongoDB
-from wiki_sentence_utils import fetch_article_metadata, parse_article, fix_title
+from heatmap_payloads import build_heatmap_payload
+from pipeline_metrics import MetricsReporter, metrics
+from wiki_fetch import WikiFetcher
+from wiki_inputs import input_batch_size, iter_scoring_pairs, iter_source_articles
+from wiki_ledger import FETCHED, PAIR, PARSED, SCORED, SOURCE, STORED, open_ledger
+from wiki_mongo_db import WikiMongoDB, article_id_for, pair_id_for, target_id_for
+from wiki_pipeline_runner import StagedPipeline
+from wiki_sentence_utils import (build_article, fetch_article_html, fetch_article_metadata, fetch_articles_metadata,
+                                 parse_article, fix_title)
+
+# Pipeline commands: extract the source articles, score the pairs of extracted sources, or both
+EXTRACT = "extract"
+SCORE = "score"
+ALL = "all"
+COMMANDS = (EXTRACT, SCORE, ALL)
 
 # --- Utility ---------------------------------------------------------------
 LANGUAGE_CODES = {
@@ -49,20 +61,68 @@ def extract_lang_from_filename(file_path: str) -> str:
 
 
 class WikiPipeline:
-    def __init__(self, mongo_uri=None, db_name=None):
+    def __init__(self, mongo_uri=None, db_name=None, ledger_spec=None, lease_seconds=None, bulk_writes=None,
+                 load_model=True):
         import os
         mongo_uri = mongo_uri or os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
         db_name = db_name or os.environ.get("DB_NAME", "wikinsert")
         # Load environment variables from .env file
         load_dotenv()
+        # Optional durable record of the work items of a run: 'mongo' or 'sqlite:<path>'
+        self.ledger_spec = ledger_spec or os.environ.get("WORK_LEDGER", "")
+        # Seconds a worker waits before looking for claimable work items again
+        self.poll_seconds = float(os.environ.get("WORKER_POLL_SECONDS", "10"))
         # Paths to input parquet files; change these as needed
         self.source_path = os.environ.get("SOURCE_ARTICLES_PATH", "/path/to/source_articles.parquet")
         self.scored_path = os.environ.get("SCORED_DATA_PATH", "/path/to/score_data.parquet")
-        MENTION_MAP_PATH = os.environ.get("MENTION_MAP_PATH", "/path/to/mention_map.parquet")
-        MODEL_DIR = os.environ.get("MODEL_DIR", "/path/to/model_dir")
-        self.db = WikiMongoDB(mongo_uri, db_name)
-        self.scorer = SentenceScorer(MODEL_DIR, MENTION_MAP_PATH)
+        self.mention_map_path = os.environ.get("MENTION_MAP_PATH", "/path/to/mention_map.parquet")
+        self.model_dir = os.environ.get("MODEL_DIR", "/path/to/model_dir")
+        # Reuse the scores of sentence windows unchanged since an earlier revision of the same article
+        self.incremental = os.environ.get("INCREMENTAL_SCORING", "").lower() in ("1", "true", "yes")
+        # Write a compressed, ready-to-serve heatmap payload next to the scores of every pair
+        self.heatmap_payloads = os.environ.get("HEATMAP_PAYLOADS", "").lower() in ("1", "true", "yes")
+        self.heatmap_encoding = os.environ.get("HEATMAP_PAYLOAD_ENCODING", "gzip")
+        # Number of (source, target) pairs whose sentences are packed into one scoring stream
+        self.pairs_per_chunk = int(os.environ.get("PAIRS_PER_CHUNK", "64"))
+        self.db = WikiMongoDB(mongo_uri, db_name, bulk_writes)
+        self.fetcher = WikiFetcher()
+        # (lang, target_title) -> target_id of targets whose metadata is already stored
+        self.target_ids = {}
+        self.ledger = open_ledger(self.ledger_spec, self.db, lease_seconds=lease_seconds) if self.ledger_spec else None
+        # The model and the mention map are loaded on first use, runs that do not score never load them
+        self.load_model = load_model
+        self._scorer = None
+        self._scorer_lock = threading.Lock()
+        # Periodic snapshots of the stage timings, counters and gauges when METRICS_PATH is set
+        self.metrics_reporter = MetricsReporter.from_env()
+        if self.metrics_reporter:
+            self.metrics_reporter.start()
+
+    @property
+    def scorer(self):
+        """
+        The SentenceScorer, loaded with torch and transformers the first time it is needed.
+        """
+        if self._scorer is None:
+            if not self.load_model:
+                raise RuntimeError("This pipeline was created without a model and cannot score")
+            # Score and write stages of the staged pipeline may ask for it at the same time
+            with self._scorer_lock:
+                if self._scorer is None:
+                    from sentence_score import SentenceScorer
+                    self._scorer = SentenceScorer(self.model_dir, self.mention_map_path)
+        return self._scorer
 
+    @scorer.setter
+    def scorer(self, scorer):
+        self._scorer = scorer
+
+    def close(self):
+        try:
+            if self.metrics_reporter:
+                self.metrics_reporter.stop()
+        finally:
+            self.db.close()
 
     def extract_article(self, lang, title, revid):
         """
@@ -74,57 +134,259 @@ class WikiPipeline:
         """
         # Fix title for parsing
         title = fix_title(title)
-        article_id = _md5.md5(f"{lang}{title}{revid}".encode()).hexdigest()
+        article_id = article_id_for(lang, title, revid)
 
         article_meta_data = self.db.get_article_meta_data(article_id)
         if article_meta_data:
             logging.info(f"Article {lang}:{title}:{revid} already in DB (ID={article_id}). Skipping extraction.")
             return article_id
 
-        article_data = parse_article(lang, title, revid)
-        article_id = self.db.add_article_meta_data(lang, title, revid, article_data["thumbnail"],
-                                                   article_data["description"])
-        self.db.add_sections(article_id, article_data["sections"])
+        article_data = parse_article(lang, title, revid, self.fetcher)
+        return self._store_article(lang, title, revid, article_data)
+
+    def _store_article(self, lang, title, revid, article_data):
+        with metrics.timer('write'):
+            article_id = self.db.add_article_meta_data(lang, title, revid, article_data["thumbnail"],
+                                                       article_data["description"])
+            self.db.add_sections(article_id, article_data["sections"])
         return article_id
 
-    def score_and_store(self, source_id, target_title, target_lead):
+    def extract_articles(self, articles, on_state=None):
+        """
+        Extract many (lang, title, revid) articles, fetching them concurrently.
+
+        Articles already in the DB are skipped. The HTML and metadata of the others are downloaded on the
+        fetcher's worker pool while completed downloads are parsed and stored here, so network I/O overlaps
+        with parsing. Returns a dict mapping (lang, title, revid) with the fixed title to the article_id;
+        articles that could not be fetched or parsed are left out. `on_state(key, state)` is called when an
+        article has been fetched and when it has been parsed.
+        """
+        # Fix titles for parsing
+        keys = list(dict.fromkeys((lang, fix_title(title), revid) for lang, title, revid in articles))
+        candidate_ids = {key: article_id_for(*key) for key in keys}
+        # One id-only query per chunk of articles instead of a lookup per article
+        existing = self.db.existing_article_ids(list(candidate_ids.values()))
+        article_ids = {key: article_id for key, article_id in candidate_ids.items() if article_id in existing}
+        to_fetch = [key for key in keys if key not in article_ids]
+        logging.info(f"{len(article_ids)} of {len(keys)} articles already in DB, extracting {len(to_fetch)}.")
+
+        def fetch(key):
+            lang, title, revid = key
+            return (fetch_article_html(lang, title, revid, self.fetcher),
+                    fetch_article_metadata(lang, title, self.fetcher))
+
+        for key, result, error in self.fetcher.imap_unordered(fetch, to_fetch):
+            lang, title, revid = key
+            if error:
+                logging.error(f"Failed to fetch article {lang}:{title}:{revid}: {error}")
+                continue
+            if on_state:
+                on_state(key, FETCHED)
+            html_content, metadata = result
+            try:
+                article_data = build_article(title, revid, html_content, metadata, lang=lang)
+            except Exception as e:
+                logging.error(f"Failed to parse article {lang}:{title}:{revid}: {e}")
+                continue
+            if on_state:
+                on_state(key, PARSED)
+            article_ids[key] = self._store_article(lang, title, revid, article_data)
+        return article_ids
+
+    def score_and_store(self, source_id, target_title, target_lead, rebuild_payloads=False):
         """
         1) Check if there's an existing 'scores' document for (source_article_id, target_title).
         2) If needed, fetch sections of the source article, parse or load the target article to get
            relevant info (like lead section, if desired).
         3) Run scoring, store results in 'scores'.
+        With `rebuild_payloads`, the heatmap payload of an existing pair is rebuilt from its stored scores.
         """
-        # Fix title
-        target_title = fix_title(target_title)
-        # Check if scores already exist
-        article_meta = self.db.get_article_meta_data(source_id)
-        lang = article_meta["lang"]
-        target_metadata = fetch_article_metadata(lang, target_title)
+        self.score_and_store_many([(source_id, target_title, target_lead)], rebuild_payloads)
 
-        target_id = self.db.add_target_meta(target_title, lang, target_lead, target_metadata["thumbnail"],
-                                            target_metadata["description"])
+    def score_and_store_many(self, pairs, rebuild_payloads=False):
+        """
+        Score many (source_id, target_title, target_lead) pairs in one inference stream.
 
-        pair_id = hashlib.md5(f"{lang}{target_id}{source_id}".encode()).hexdigest()
+        Pairs whose scores already exist are skipped, or only get their heatmap payload rebuilt with
+        `rebuild_payloads`. The sentences of all remaining pairs are packed into shared batches by the scorer
+        and the results are stored per pair.
+        """
+        article_metas = self.db.get_articles_meta_data([source_id for source_id, _, _ in pairs])
+        candidates = {}
+        for source_id, target_title, target_lead in pairs:
+            if source_id not in article_metas:
+                logging.warning(f"Source article {source_id} not in DB; skipping pair with {target_title}.")
+                continue
+            # Fix title
+            target_title = fix_title(target_title)
+            lang = article_metas[source_id]["lang"]
+            pair_id = pair_id_for(lang, target_id_for(lang, target_title), source_id)
+            candidates.setdefault(pair_id, (source_id, target_title, target_lead))
 
-        existing = self.db.get_scores(pair_id)
+        # Check which scores already exist with a single id-only query
+        existing = self.db.existing_pair_ids(list(candidates))
         if existing:
-            logging.info(f"Scores for pair_id={pair_id} exist. Skipping.")
+            logging.info(f"Scores for {len(existing)} pairs exist. Skipping.")
+            if rebuild_payloads:
+                self.rebuild_heatmap_payloads(existing)
+
+        source_sections = {}
+        jobs = []
+        job_sources = []
+        for pair_id, (source_id, target_title, target_lead) in candidates.items():
+            if pair_id in existing:
+                continue
+            # Retrieve source sections once per source, they are shared by all of its targets
+            if source_id not in source_sections:
+                source_sections[source_id] = self.db.get_sections(source_id)
+
+            jobs.append({
+                'sections': source_sections[source_id],
+                'article_title': article_metas[source_id]["title"],
+                'target_title': target_title,
+                'target_lead': target_lead,
+            })
+            job_sources.append(source_id)
+
+        if not jobs:
+            return
+
+        for source_id in source_sections:
+            meta = article_metas[source_id]
+            self.add_known_scores(meta["lang"], source_id, meta["title"], meta["revid"],
+                                  [job for job, job_source in zip(jobs, job_sources) if job_source == source_id])
+
+        all_scores = self.scorer.get_sentence_scores_batch(jobs)
+        for source_id, job, scores in zip(job_sources, jobs, all_scores):
+            self.store_scores(article_metas[source_id]["lang"], source_id,
+                              [(job['target_title'], job['target_lead'])], [scores])
+
+    def _target_id(self, lang, target_title, target_lead):
+        target_id = self.target_ids.get((lang, target_title))
+        if target_id is None:
+            target_metadata = fetch_article_metadata(lang, target_title, self.fetcher)
+            target_id = self.db.add_target_meta(target_title, lang, target_lead, target_metadata["thumbnail"],
+                                                target_metadata["description"])
+            self.target_ids[(lang, target_title)] = target_id
+        return target_id
+
+    def store_scores(self, lang, source_id, targets, all_scores):
+        """
+        Store the scored DataFrames of (target_title, target_lead) targets of one source and link the targets.
+        """
+        for (target_title, target_lead), scores in zip(targets, all_scores):
+            target_title = fix_title(target_title)
+            target_id = self._target_id(lang, target_title, target_lead)
+            # Save to DB
+            with metrics.timer('write'):
+                records = scores.to_dict('records')
+                self.db.add_scores(source_id, target_id, records, lang,
+                                   self.scorer.prefix_hash(target_title, target_lead))
+                if self.heatmap_payloads:
+                    self.db.add_heatmap_payload(pair_id_for(lang, target_id, source_id), source_id, target_id,
+                                                build_heatmap_payload(records, self.heatmap_encoding))
+                self.db.update_article_targets(source_id, target_title)
+
+    def rebuild_heatmap_payloads(self, pair_ids=None):
+        """
+        Build the heatmap payloads of pairs whose scores are already stored, of all of them if `pair_ids` is None.
+        """
+        query = {"_id": {"$in": list(pair_ids)}} if pair_ids is not None else {}
+        rebuilt = 0
+        for document in self.db.scores_collection.find(query, {"source_id": 1, "target_id": 1}):
+            records = self.db.get_score_records(document["_id"])
+            self.db.add_heatmap_payload(document["_id"], document["source_id"], document["target_id"],
+                                        build_heatmap_payload(records, self.heatmap_encoding))
+            rebuilt += 1
+        self.db.flush()
+        logging.info(f"Rebuilt {rebuilt} heatmap payloads.")
+
+    def add_known_scores(self, lang, source_id, title, revid, jobs):
+        """
+        In incremental mode, attach to the scoring jobs of one source the scores of an earlier revision of the same
+        article against the same targets.
+
+        The scores of the latest other revision scored against a target are keyed by the section+context input of
+        their sentence. Sentences of the new revision with the same input reuse that score and keep their own idx,
+        start and end, only changed windows are scored again. Scores stored with a different target prefix (e.g.
+        another lead) are not reused.
+        """
+        if not self.incremental or not jobs:
+            return
+        revisions = [article for article in self.db.get_article_revisions(lang, title)
+                     if article["_id"] != source_id and article.get("targets")]
+        if not revisions:
             return
 
-        # Retrieve source sections:
-        source_title = article_meta["title"]
+        def revision_order(article):
+            other = str(article["revid"])
+            # Prefer the latest revision before this one, then later ones
+            if other.isdigit() and str(revid).isdigit():
+                return int(other) < int(revid), int(other)
+            return False, 0
 
-        source_sections = self.db.get_sections(source_id)
+        revisions.sort(key=revision_order, reverse=True)
+        window_inputs = {}
+        for job in jobs:
+            target_title = job['target_title']
+            prefix_hash = self.scorer.prefix_hash(target_title, job['target_lead'])
+            for article in revisions:
+                if target_title not in article["targets"]:
+                    continue
+                pair_id = pair_id_for(lang, target_id_for(lang, target_title), article["_id"])
+                stored = self.db.get_scores(pair_id)
+                # Scores stored without a prefix hash may come from another model or target lead
+                if not stored or stored[0].get("prefix_hash") != prefix_hash:
+                    continue
+                if article["_id"] not in window_inputs:
+                    window_inputs[article["_id"]] = self.scorer.window_inputs(self.db.get_sections(article["_id"]))
+                inputs = window_inputs[article["_id"]]
+                job['known_scores'] = {inputs[record["idx"]]: record["score"]
+                                       for record in self.db.get_score_records(pair_id) if record["idx"] in inputs}
+                logging.info(f"Found {len(job['known_scores'])} scores of {lang}:{title} revision "
+                             f"{article['revid']} against {target_title}.")
+                break
 
-        scores = self.scorer.get_sentence_scores(
-            source_sections,
-            source_title,
-            target_title,
-            target_lead,
-        )
-        # Save to DB
-        self.db.add_scores(source_id, target_id, scores.to_dict('records'))
-        self.db.update_article_targets(source_id, target_title)
+    def plan_missing_pairs(self, lang, pairs):
+        """
+        Return the (source_id, target_title, target_lead) pairs of `lang` sources whose scores are not stored yet.
+
+        All pair ids are computed up front and checked with chunked id-only queries, so a restart of a mostly
+        finished run does not need a lookup per pair.
+        """
+        pair_ids = [pair_id_for(lang, target_id_for(lang, fix_title(target_title)), source_id)
+                    for source_id, target_title, _ in pairs]
+        existing = self.db.existing_pair_ids(pair_ids)
+        missing = [pair for pair, pair_id in zip(pairs, pair_ids) if pair_id not in existing]
+        logging.info(f"{len(pairs) - len(missing)} of {len(pairs)} pairs already scored, {len(missing)} to score.")
+        return missing
+
+    def prefetch_target_metadata(self, lang, targets):
+        """
+        Resolve and store the metadata of many (target_title, target_lead) targets before scoring starts.
+
+        Unique titles are looked up in batched API requests and upserted in bulk, so score_and_store_many does not
+        need a metadata round trip per pair.
+        """
+        leads = {}
+        for target_title, target_lead in targets:
+            leads[fix_title(target_title)] = target_lead
+        titles = [title for title in leads if (lang, title) not in self.target_ids]
+        if not titles:
+            return
+        metadata = fetch_articles_metadata(lang, titles, self.fetcher)
+        target_ids = self.db.add_targets_meta([
+            {
+                'target_title': title,
+                'lang': lang,
+                'lead': leads[title],
+                'thumbnail': metadata[title]['thumbnail'],
+                'description': metadata[title]['description'],
+            }
+            for title in titles
+        ])
+        self.target_ids.update({(lang, title): target_id for title, target_id in zip(titles, target_ids)})
+        logging.info(f"Stored metadata for {len(titles)} targets.")
 
     def full_pipeline_example(self):
         """
@@ -152,51 +414,375 @@ class WikiPipeline:
         for (source_id, target_id) in pairs_to_score:
             self.score_and_store(source_id, target_id, )
 
-    def full_pipeline(self, testing):
+    def _load_inputs(self, testing):
         """
-         Pipeline run:
-        - Extract source articles from SOURCE_ARTICLES_PATH
-        - Score pairs from SCORED_DATA_PATH
+        Read the source articles and return them with a lazy iterator over the unique
+        (source_title, revid, target_title, target_lead) pairs to score.
+
+        The scoring data is streamed in record batches of its four columns, so it never has to fit in memory.
         """
         # Determine language from source file name
         lang = extract_lang_from_filename(self.source_path)
-        # Load source articles
-        df_sources = pd.read_parquet(self.source_path)
         # take only the first 20 for testing
-        if testing:
-            df_sources = df_sources.head(20)
-            #df_sources = df_sources.sample(n=3, random_state=42)
-        id_map = {}
-        for _, row in df_sources.iterrows():
-            title = fix_title(row['source_title'])
-            revid = str(row['first_version'])
-            src_id = self.extract_article(lang, title, revid)
-            id_map[(title, revid)] = src_id
-        # Load scoring data
-        df_scores = pd.read_parquet(self.scored_path)
-        # Process each unique source-target pair
-        for _, row in df_scores[
-            ['source_title', 'first_version', 'target_title', 'target_lead']].drop_duplicates().iterrows():
-            src_title = fix_title(row['source_title'])
-            src_rev = str(row['first_version'])
-            src_id = id_map.get((src_title, src_rev))
+        sources = list(iter_source_articles(self.source_path, limit=20 if testing else None))
+        return lang, sources, iter_scoring_pairs(self.scored_path)
+
+    def _missing_pair_windows(self, lang, source_pairs, source_ids):
+        """
+        Map streamed pairs to (source_id, target_title, target_lead) with `source_ids` and yield them in windows of
+        INPUT_BATCH_SIZE pairs, keeping only pairs without stored scores and with their target metadata resolved.
+        """
+        window = []
+        for src_title, src_rev, tgt_title, tgt_lead in source_pairs:
+            src_id = source_ids.get((src_title, src_rev))
             if not src_id:
                 logging.warning(f"Source {src_title} rev {src_rev} not found; skipping.")
                 continue
-            tgt_title = row['target_title']
-            tgt_lead = row['target_lead']
-            self.score_and_store(src_id, tgt_title, tgt_lead)
-            logging.info(f"Scored {src_title} (rev {src_rev}) against {tgt_title}.")
+            window.append((src_id, tgt_title, tgt_lead))
+            if len(window) >= input_batch_size():
+                yield self._plan_window(lang, window)
+                window = []
+        if window:
+            yield self._plan_window(lang, window)
+
+    def _plan_window(self, lang, pairs):
+        # Plan the work up front, only pairs without stored scores are scored
+        pairs = self.plan_missing_pairs(lang, pairs)
+        # Resolve the target metadata of the window at once instead of once per pair
+        self.prefetch_target_metadata(lang, ((tgt_title, tgt_lead) for _, tgt_title, tgt_lead in pairs))
+        return pairs
+
+    def full_pipeline(self, testing, command=ALL):
+        """
+         Pipeline run:
+        - Extract source articles from SOURCE_ARTICLES_PATH
+        - Score pairs from SCORED_DATA_PATH
+        The 'extract' command only runs the first step, the 'score' command only the second one, for the sources
+        already in the DB.
+        """
+        if self.ledger:
+            self.ledger_pipeline(testing, command)
+            return
+        lang, sources, source_pairs = self._load_inputs(testing)
+        if command == SCORE:
+            id_map = self._stored_source_ids(lang, sources)
+        else:
+            extracted = self.extract_articles((lang, title, revid) for title, revid in sources)
+            id_map = {(title, revid): src_id for (_, title, revid), src_id in extracted.items()}
+        if command != EXTRACT:
+            self.score_pairs(lang, source_pairs, id_map)
+        # Persist writes still buffered in bulk-write mode
+        self.db.flush()
+
+    def _stored_source_ids(self, lang, sources):
+        """
+        Map the (title, revid) of the sources already extracted into the DB to their article_id.
+        """
+        article_ids = {(title, revid): article_id_for(lang, title, revid) for title, revid in sources}
+        existing = self.db.existing_article_ids(list(article_ids.values()))
+        logging.info(f"{len(existing)} of {len(article_ids)} source articles are in the DB and can be scored.")
+        return {key: article_id for key, article_id in article_ids.items() if article_id in existing}
+
+    def score_pairs(self, lang, source_pairs, id_map):
+        """
+        Score the streamed (source_title, revid, target_title, target_lead) pairs whose source is in `id_map`.
+        """
+        for pairs in self._missing_pair_windows(lang, source_pairs, id_map):
+            # Score chunks of pairs in a shared inference stream
+            for i in range(0, len(pairs), self.pairs_per_chunk):
+                chunk = pairs[i:i + self.pairs_per_chunk]
+                self.score_and_store_many(chunk)
+                logging.info(f"Scored a chunk of {len(chunk)} pairs.")
+
+    def seed_ledger(self, testing):
+        """
+        Record every source revision and (source, target) pair of the input files in the work ledger.
+        Items already in the ledger keep their state, so seeding again after a restart is safe.
+        """
+        lang, sources, source_pairs = self._load_inputs(testing)
+        new_sources = self.ledger.seed(SOURCE, (
+            (article_id_for(lang, title, revid), {'lang': lang, 'title': title, 'revid': revid})
+            for title, revid in sources
+        ))
+        source_ids = {(title, revid): article_id_for(lang, title, revid) for title, revid in sources}
+        new_pairs = self.ledger.seed(PAIR, (
+            (pair_id_for(lang, target_id_for(lang, fix_title(tgt_title)), source_ids[(src_title, src_rev)]),
+             {'lang': lang, 'source_id': source_ids[(src_title, src_rev)], 'target_title': fix_title(tgt_title),
+              'target_lead': tgt_lead})
+            for src_title, src_rev, tgt_title, tgt_lead in source_pairs if (src_title, src_rev) in source_ids
+        ))
+        logging.info(f"Seeded {new_sources} new sources and {new_pairs} new pairs into the work ledger.")
+
+    def run_ledger_sources(self):
+        """
+        Claim and extract source revisions from the work ledger until none are left.
+        """
+        while True:
+            claimed = self.ledger.claim(SOURCE, self.fetcher.concurrency * 4)
+            if not claimed:
+                return
+            item_ids = {(payload['lang'], payload['title'], payload['revid']): item_id
+                        for item_id, payload, _ in claimed}
+            extracted = self.extract_articles(
+                item_ids, on_state=lambda key, state: self.ledger.advance([item_ids[key]], state))
+            # Articles must be durable before the ledger says so
+            self.db.flush()
+            self.ledger.complete([item_id for key, item_id in item_ids.items() if key in extracted])
+            failed = [item_id for key, item_id in item_ids.items() if key not in extracted]
+            if failed:
+                self.ledger.release(failed, "extraction failed")
+
+    def run_ledger_pairs(self):
+        """
+        Claim and score (source, target) pairs from the work ledger until none are left.
+
+        A pair is marked scored once its scores are durable and stored once the source lists the target, so a
+        pair whose run stopped in between only gets its article targets repaired.
+        """
+        while True:
+            claimed = self.ledger.claim(PAIR, self.pairs_per_chunk)
+            if not claimed:
+                return
+            item_ids = [item_id for item_id, _, _ in claimed]
+            try:
+                claimed = self._defer_unextracted_pairs(claimed)
+                item_ids = [item_id for item_id, _, _ in claimed]
+                to_score = [payload for _, payload, state in claimed if state != SCORED]
+                for lang in {payload['lang'] for payload in to_score}:
+                    self.prefetch_target_metadata(lang, ((payload['target_title'], payload['target_lead'])
+                                                         for payload in to_score if payload['lang'] == lang))
+                self.score_and_store_many([(payload['source_id'], payload['target_title'], payload['target_lead'])
+                                           for payload in to_score])
+                self.db.flush()
+                scored = set(self.db.existing_pair_ids(item_ids))
+                self.ledger.advance([item_id for item_id in item_ids if item_id in scored], SCORED)
+                for item_id, payload, _ in claimed:
+                    if item_id in scored:
+                        # Idempotent, repairs pairs whose scores were stored before a crash
+                        self.db.update_article_targets(payload['source_id'], payload['target_title'])
+                self.db.flush()
+                self.ledger.complete([item_id for item_id in item_ids if item_id in scored])
+                missing = [item_id for item_id in item_ids if item_id not in scored]
+                if missing:
+                    self.ledger.release(missing, "scoring failed")
+            except Exception as e:
+                logging.exception(f"Failed to score a chunk of {len(claimed)} pairs")
+                self.ledger.release(item_ids, str(e))
+            logging.info(f"Work ledger: {self.ledger.counts(PAIR)}")
+
+    def _defer_unextracted_pairs(self, claimed):
+        """
+        Hand back claimed pairs whose source article is not in the DB and return the others.
+
+        When the source is still being extracted, e.g. by another worker, the pair is deferred without counting an
+        attempt; when its extraction failed for good, the pair is released as failed.
+        """
+        source_ids = {payload['source_id'] for _, payload, state in claimed if state != SCORED}
+        missing = source_ids - self.db.existing_article_ids(list(source_ids))
+        if not missing:
+            return claimed
+        waiting = self.ledger.unfinished_ids(list(missing))
+        deferred = [item_id for item_id, payload, state in claimed
+                    if state != SCORED and payload['source_id'] in waiting]
+        failed = [item_id for item_id, payload, state in claimed
+                  if state != SCORED and payload['source_id'] in missing and payload['source_id'] not in waiting]
+        if deferred:
+            self.ledger.defer(deferred, self.poll_seconds)
+        if failed:
+            self.ledger.release(failed, "source article could not be extracted")
+        return [(item_id, payload, state) for item_id, payload, state in claimed
+                if state == SCORED or payload['source_id'] not in missing]
+
+    def ledger_pipeline(self, testing, command=ALL):
+        """
+        Resumable pipeline run driven by the work ledger: seed it from the input files, then work through the
+        unfinished source revisions and pairs, only one of them with the 'extract' and 'score' commands. After a
+        crash, rerunning continues where the run stopped.
+        """
+        self.seed_ledger(testing)
+        self.ledger.retry_failed(SOURCE)
+        self.ledger.retry_failed(PAIR)
+        if command != SCORE:
+            self.run_ledger_sources()
+        if command != EXTRACT:
+            self.run_ledger_pairs()
+        logging.info(f"Work ledger sources: {self.ledger.counts(SOURCE)}, pairs: {self.ledger.counts(PAIR)}")
+
+    def run_worker(self, command=ALL):
+        """
+        Worker mode: claim source revisions and pairs from the shared work ledger and process them until every item
+        is stored or out of attempts. An 'extract' worker only claims source revisions and a 'score' worker only
+        pairs, so fetching and parsing can run on machines without the model.
+
+        Any number of workers, on one or several hosts, can run against the same ledger and database, each with its
+        own scorer. Claims are leases kept alive by heartbeats, so the items of a worker that dies are picked up by
+        the others once its lease expires. When the remaining items are claimed by other workers or wait for their
+        source to be extracted, the worker polls the ledger every WORKER_POLL_SECONDS.
+        """
+        kinds = {EXTRACT: [SOURCE], SCORE: [PAIR], ALL: [SOURCE, PAIR]}[command]
+        logging.info(f"Worker {self.ledger.owner} started ({command}).")
+        self.ledger.start_heartbeat()
+        try:
+            while True:
+                if SOURCE in kinds:
+                    self.run_ledger_sources()
+                if PAIR in kinds:
+                    self.run_ledger_pairs()
+                remaining = sum(self.ledger.unfinished(kind) for kind in kinds)
+                if not remaining:
+                    break
+                logging.info(f"Worker {self.ledger.owner}: {remaining} items claimed elsewhere or waiting, "
+                             f"polling again in {self.poll_seconds:.0f}s.")
+                time.sleep(self.poll_seconds)
+        finally:
+            self.ledger.stop_heartbeat()
+            self.db.flush()
+        logging.info(f"Worker {self.ledger.owner} finished, no work left.")
+
+    def coordinate(self, testing, report_interval=30.0):
+        """
+        Coordinator mode: seed the shared work ledger from SOURCE_ARTICLES_PATH and SCORED_DATA_PATH, then report
+        the progress of the workers until every item is stored or out of attempts.
+        """
+        self.seed_ledger(testing)
+        self.ledger.retry_failed(SOURCE)
+        self.ledger.retry_failed(PAIR)
+        last_stored, last_time = None, time.monotonic()
+        while True:
+            sources, pairs = self.ledger.counts(SOURCE), self.ledger.counts(PAIR)
+            total = sum(n for state, n in pairs.items() if state != "failed")
+            now = time.monotonic()
+            rate = (pairs[STORED] - last_stored) / (now - last_time) if last_stored is not None else 0.0
+            eta = f", ETA {(total - pairs[STORED] - pairs['failed']) / rate / 60:.1f} min" if rate > 0 else ""
+            logging.info(f"Progress: sources {sources}, pairs {pairs}, {pairs[STORED]}/{total} pairs stored, "
+                         f"{rate:.2f} pairs/s{eta}")
+            if not self.ledger.unfinished(SOURCE) and not self.ledger.unfinished(PAIR):
+                break
+            last_stored, last_time = pairs[STORED], now
+            time.sleep(report_interval)
+        logging.info(f"All work items are finished, {sources['failed']} sources and {pairs['failed']} pairs failed.")
+
+    def staged_pipeline(self, testing):
+        """
+        Same run as full_pipeline, but fetching, parsing, scoring and writing overlap in a StagedPipeline.
+
+        Work items are built lazily from windows of the streamed pairs, one per source with the targets of the
+        window. A source whose pairs show up again in a later window is already in the pipeline; those late pairs
+        are held back until they fill a window, then the ones of sources stored by then go in as new work items of
+        the stored article. Late pairs of sources still in flight wait for a later window and the rest are scored
+        once the staged run is done.
+        """
+        lang, sources, source_pairs = self._load_inputs(testing)
+        article_ids = {(title, revid): article_id_for(lang, title, revid) for title, revid in sources}
+        titles = {article_id: (title, revid) for (title, revid), article_id in article_ids.items()}
+        existing_articles = self.db.existing_article_ids(list(article_ids.values()))
+        late_pairs = []
+
+        def item(article_id, targets):
+            title, revid = titles[article_id]
+            return {
+                'lang': lang,
+                'title': title,
+                'revid': revid,
+                'article_id': article_id,
+                'exists': article_id in existing_articles,
+                'targets': targets,
+            }
+
+        def stored_late_items():
+            # The articles of stored sources are in the DB, their late pairs can be scored like an existing article
+            stored = self.db.existing_article_ids(list({src_id for src_id, _, _ in late_pairs}))
+            targets = {}
+            waiting = []
+            for src_id, tgt_title, tgt_lead in late_pairs:
+                if src_id in stored:
+                    targets.setdefault(src_id, []).append((fix_title(tgt_title), tgt_lead))
+                else:
+                    waiting.append((src_id, tgt_title, tgt_lead))
+            late_pairs[:] = waiting
+            for article_id, source_targets in targets.items():
+                yield dict(item(article_id, source_targets), exists=True)
+
+        def items():
+            queued = set()
+            for pairs in self._missing_pair_windows(lang, source_pairs, article_ids):
+                targets = {}
+                for src_id, tgt_title, tgt_lead in pairs:
+                    if src_id in queued:
+                        late_pairs.append((src_id, tgt_title, tgt_lead))
+                    else:
+                        targets.setdefault(src_id, []).append((fix_title(tgt_title), tgt_lead))
+                for article_id, source_targets in targets.items():
+                    queued.add(article_id)
+                    yield item(article_id, source_targets)
+                if len(late_pairs) >= input_batch_size():
+                    yield from stored_late_items()
+            # Sources that are stored and fully scored need no work
+            for article_id in titles:
+                if article_id not in existing_articles and article_id not in queued:
+                    yield item(article_id, [])
+
+        StagedPipeline(self).run(items())
+        if late_pairs:
+            logging.info(f"Scoring {len(late_pairs)} pairs of sources already handed to the staged pipeline.")
+            for i in range(0, len(late_pairs), self.pairs_per_chunk):
+                self.score_and_store_many(late_pairs[i:i + self.pairs_per_chunk])
+            self.db.flush()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Wikinsert data pipeline")
+    parser.add_argument("command", nargs="?", choices=COMMANDS, default=ALL,
+                        help="extract the source articles, score the pairs of extracted sources, or both (default)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--worker", action="store_true",
+                      help="claim and process work items from the shared work ledger until none are left")
+    mode.add_argument("--coordinator", action="store_true",
+                      help="seed the shared work ledger from the input files and report the workers' progress")
+    mode.add_argument("--rebuild-heatmaps", action="store_true",
+                      help="rebuild the heatmap payloads of all stored scores and exit")
+    parser.add_argument("--report-interval", type=float, default=30.0,
+                        help="seconds between progress reports of the coordinator")
+    return parser.parse_args(argv)
+
 
 def main():
     logging.basicConfig(level=logging.INFO)
-    pipeline = WikiPipeline()
+    args = parse_args()
+    if args.rebuild_heatmaps:
+        pipeline = WikiPipeline(load_model=False)
+        try:
+            pipeline.rebuild_heatmap_payloads()
+        finally:
+            pipeline.close()
+        return
+    if args.worker or args.coordinator:
+        # Workers share the ledger in the database by default and keep short leases alive with heartbeats. Their
+        # writes are buffered, so a pair written again by a worker that lost its lease is skipped as a duplicate.
+        pipeline = WikiPipeline(ledger_spec=os.environ.get("WORK_LEDGER") or "mongo",
+                                lease_seconds=float(os.environ.get("WORKER_LEASE_SECONDS", "120")),
+                                bulk_writes=True, load_model=args.worker and args.command != EXTRACT)
+        try:
+            if args.worker:
+                pipeline.run_worker(args.command)
+            else:
+                pipeline.coordinate(testing=False, report_interval=args.report_interval)
+        finally:
+            pipeline.close()
+        return
+
+    pipeline = WikiPipeline(load_model=args.command != EXTRACT)
 
     # Uncomment the line below to run the full pipeline with parquet files
     # pipeline.full_pipeline(testing=True)
     # logging.info("Finished testing")
     # withouth testing
-    pipeline.full_pipeline(testing=False)
+    try:
+        if args.command == ALL and os.environ.get("STAGED_PIPELINE", "").lower() in ("1", "true", "yes"):
+            pipeline.staged_pipeline(testing=False)
+        else:
+            pipeline.full_pipeline(testing=False, command=args.command)
+    finally:
+        pipeline.close()
 
 
 if __name__ == "__main__":